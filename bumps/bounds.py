@@ -52,7 +52,8 @@ functions::
 from __future__ import division
 __all__ = ['pm','pmp','pm_raw','pmp_raw', 'nice_range', 'init_bounds',
            'Unbounded', 'Bounded', 'BoundedAbove', 'BoundedBelow',
-           'Distribution', 'Normal', 'BoundedNormal', 'SoftBounded']
+           'Distribution', 'Normal', 'BoundedNormal', 'SoftBounded',
+           'BoundsVector']
 
 import math
 import numpy
@@ -549,7 +550,7 @@ class BoundedNormal(Bounds):
         """
         Return a randomly generated valid value, or an array of values
         """
-        return self.get01(rand(n))
+        return self.put01(RNG.rand(n))
     def nllf(self, value):
         """
         Return the negative log likelihood of seeing this value, with
@@ -570,8 +571,7 @@ class BoundedNormal(Bounds):
         For the truncated normal distribution, we can just use the normal
         residuals.
         """
-        mean,std = self.dist.args
-        return (value-mean)/std
+        return (value-self.mu)/self.sigma
     def start_value(self):
         """
         Return a default starting value if none given.
@@ -639,6 +639,254 @@ class SoftBounded(Bounds):
 
 
 
+# Bounds types for BoundsVector
+_UNBOUNDED, _BELOW, _ABOVE, _BOUNDED, _NORMAL, _BOUNDED_NORMAL, _SOFT, _OTHER \
+    = range(8)
+class BoundsVector(object):
+    """
+    Bounds for a whole parameter vector.
+
+    *bounds* is the list of bounds objects, one for each parameter.
+
+    The bounds are stored as arrays of limits, bounds type and distribution
+    parameters so that populations of points can be processed using
+    array operations rather than parameter by parameter.  Each method
+    accepts either a single point of shape (Nvar,) or a population of
+    shape (Npop, Nvar).  Bounds types which are not known to the vector,
+    such as scipy.stats distributions, are handled by calling the bounds
+    object for the corresponding column.
+
+    The vector is a snapshot of the bounds at the time it is created.  It
+    needs to be rebuilt if the bounds on the parameters change.
+    """
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        n = len(self.bounds)
+        self.lo = numpy.array([b.limits[0] for b in self.bounds], 'd')
+        self.hi = numpy.array([b.limits[1] for b in self.bounds], 'd')
+        self.mu = numpy.zeros(n, 'd')
+        self.sigma = numpy.ones(n, 'd')
+        self.scale = numpy.zeros(n, 'd')
+        self.type = numpy.empty(n, 'i')
+        for k, b in enumerate(self.bounds):
+            if isinstance(b, Unbounded):
+                self.type[k] = _UNBOUNDED
+            elif isinstance(b, BoundedBelow):
+                self.type[k] = _BELOW
+            elif isinstance(b, BoundedAbove):
+                self.type[k] = _ABOVE
+            elif isinstance(b, Bounded):
+                self.type[k] = _BOUNDED
+            elif isinstance(b, Normal):
+                self.type[k] = _NORMAL
+                self.mu[k], self.sigma[k] = b.dist.args
+                self.scale[k] = b._nllf_scale
+            elif isinstance(b, BoundedNormal):
+                self.type[k] = _BOUNDED_NORMAL
+                self.mu[k], self.sigma[k] = b.mu, b.sigma
+                self.scale[k] = b._nllf_scale
+            elif isinstance(b, SoftBounded):
+                self.type[k] = _SOFT
+                # Soft bounds have limits (-inf, inf), with the soft range
+                # stored as [mu, soft_hi] and the tail width as sigma.
+                self.mu[k], self.sigma[k] = b._lo, b._std
+                self.scale[k] = b._nllf_scale
+            else:
+                self.type[k] = _OTHER
+        self._soft_hi = numpy.array([b._hi if t == _SOFT else inf
+                                     for b, t in zip(self.bounds, self.type)],
+                                    'd')
+        self._index = dict((t, numpy.flatnonzero(self.type == t))
+                           for t in range(_OTHER+1))
+
+    def __len__(self):
+        return len(self.bounds)
+
+    @property
+    def limits(self):
+        """Array of [low, high] limits, with shape (2, Nvar)."""
+        return numpy.array([self.lo, self.hi])
+
+    def contains(self, points):
+        """
+        Return True for each point which is within the limits.
+        """
+        points = numpy.asarray(points)
+        return numpy.all((points >= self.lo) & (points <= self.hi), axis=-1)
+
+    def nllf(self, points):
+        """
+        Return the negative log likelihood of seeing each point, with inf
+        for points outside the limits.  See :meth:`Bounds.nllf`.
+        """
+        points = numpy.asarray(points, 'd')
+        x = numpy.atleast_2d(points)
+        cost = numpy.zeros(x.shape[0], 'd')
+        for t in (_NORMAL, _BOUNDED_NORMAL):
+            k = self._index[t]
+            if len(k):
+                z = (x[:, k] - self.mu[k])/self.sigma[k]
+                cost += numpy.sum(0.5*z**2 + self.scale[k], axis=1)
+        k = self._index[_SOFT]
+        if len(k):
+            z = self._soft_distance(x, k)
+            cost += numpy.sum(0.5*z**2 + self.scale[k], axis=1)
+        for k in self._index[_OTHER]:
+            cost += self._apply('nllf', k, x[:, k])
+        cost[~self.contains(x)] = inf
+        return cost if points.ndim > 1 else cost[0]
+
+    def residual(self, points):
+        """
+        Return the parameter residuals for each point.
+        See :meth:`Bounds.residual`.
+        """
+        points = numpy.asarray(points, 'd')
+        x = numpy.atleast_2d(points)
+        r = numpy.zeros(x.shape, 'd')
+        k = self._index[_BELOW]
+        r[:, k] = numpy.where(x[:, k] < self.lo[k], -4, 0)
+        k = self._index[_ABOVE]
+        r[:, k] = numpy.where(x[:, k] > self.hi[k], 4, 0)
+        k = self._index[_BOUNDED]
+        r[:, k] = numpy.select([x[:, k] < self.lo[k], x[:, k] > self.hi[k]],
+                               [-4, 4], 0)
+        for t in (_NORMAL, _BOUNDED_NORMAL):
+            k = self._index[t]
+            r[:, k] = (x[:, k] - self.mu[k])/self.sigma[k]
+        k = self._index[_SOFT]
+        r[:, k] = self._soft_distance(x, k)
+        for k in self._index[_OTHER]:
+            r[:, k] = self._apply('residual', k, x[:, k])
+        return r if points.ndim > 1 else r[0]
+
+    def get01(self, points):
+        """
+        Convert each point into [0,1] for bounds constrained optimizers.
+        See :meth:`Bounds.get01`.
+        """
+        points = numpy.asarray(points, 'd')
+        x = numpy.atleast_2d(points)
+        v = numpy.empty(x.shape, 'd')
+        k = self._index[_UNBOUNDED]
+        v[:, k] = _get01_inf_vector(x[:, k])
+        k = self._index[_BELOW]
+        v[:, k] = _get01_below_vector(x[:, k] - self.lo[k])
+        k = self._index[_ABOVE]
+        v[:, k] = 1 - _get01_below_vector(self.hi[k] - x[:, k])
+        k = self._index[_BOUNDED]
+        width = self.hi[k] - self.lo[k]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            v[:, k] = numpy.where(width > 0, (x[:, k]-self.lo[k])/width, 0)
+        k = self._index[_SOFT]
+        v[:, k] = numpy.clip((x[:, k]-self.mu[k])/(self._soft_hi[k]-self.mu[k]),
+                             0, 1)
+        for k in numpy.hstack((self._index[_NORMAL],
+                               self._index[_BOUNDED_NORMAL],
+                               self._index[_OTHER])):
+            v[:, k] = self._apply('get01', k, x[:, k])
+        return v if points.ndim > 1 else v[0]
+
+    def put01(self, points):
+        """
+        Convert each point from [0,1] into parameter values.
+        See :meth:`Bounds.put01`.
+        """
+        points = numpy.asarray(points, 'd')
+        v = numpy.atleast_2d(points)
+        x = numpy.empty(v.shape, 'd')
+        k = self._index[_UNBOUNDED]
+        x[:, k] = _put01_inf_vector(v[:, k])
+        k = self._index[_BELOW]
+        x[:, k] = _put01_below_vector(v[:, k]) + self.lo[k]
+        k = self._index[_ABOVE]
+        x[:, k] = self.hi[k] - _put01_below_vector(1 - v[:, k])
+        k = self._index[_BOUNDED]
+        x[:, k] = (self.hi[k]-self.lo[k])*v[:, k] + self.lo[k]
+        k = self._index[_SOFT]
+        x[:, k] = (self._soft_hi[k]-self.mu[k])*v[:, k] + self.mu[k]
+        for k in numpy.hstack((self._index[_NORMAL],
+                               self._index[_BOUNDED_NORMAL],
+                               self._index[_OTHER])):
+            x[:, k] = self._apply('put01', k, v[:, k])
+        return x if points.ndim > 1 else x[0]
+
+    def random(self, n=1):
+        """
+        Return a population of *n* random points, with shape (n, Nvar).
+        See :meth:`Bounds.random`.
+        """
+        x = numpy.empty((n, len(self)), 'd')
+        k = self._index[_UNBOUNDED]
+        x[:, k] = RNG.rand(n, len(k))
+        k = self._index[_BELOW]
+        x[:, k] = self.lo[k] + RNG.rand(n, len(k))
+        k = self._index[_ABOVE]
+        x[:, k] = self.hi[k] - RNG.rand(n, len(k))
+        k = self._index[_BOUNDED]
+        x[:, k] = RNG.uniform(self.lo[k], self.hi[k], size=(n, len(k)))
+        k = self._index[_NORMAL]
+        x[:, k] = self.mu[k] + self.sigma[k]*RNG.randn(n, len(k))
+        for k in self._index[_BOUNDED_NORMAL]:
+            x[:, k] = self.bounds[k].put01(RNG.rand(n))
+        k = self._index[_SOFT]
+        x[:, k] = RNG.uniform(self.mu[k], self._soft_hi[k], size=(n, len(k)))
+        for k in self._index[_OTHER]:
+            x[:, k] = self.bounds[k].random(n)
+        return x
+
+    def _soft_distance(self, x, k):
+        lo, hi = self.mu[k], self._soft_hi[k]
+        return (numpy.maximum(lo - x[:, k], 0)
+                + numpy.maximum(x[:, k] - hi, 0))/self.sigma[k]
+
+    def _apply(self, method, k, values):
+        """
+        Apply the bounds *method* for parameter *k* to a column of values,
+        trying the whole column first and falling back to one at a time.
+        """
+        fn = getattr(self.bounds[k], method)
+        try:
+            result = numpy.asarray(fn(values), 'd')
+            if result.shape == values.shape:
+                return result
+        except Exception:
+            pass
+        return numpy.array([fn(v) for v in values], 'd')
+
+def _get01_inf_vector(x):
+    """Vectorized version of _get01_inf."""
+    m, e = numpy.frexp(x)
+    s = numpy.sign(m)
+    v = (e - _e_min + m*s)*s
+    v = v/(4.*_e_max) + 0.5
+    v[e < _e_min] = 0
+    v[e > _e_max] = 1
+    return v
+
+def _put01_inf_vector(v):
+    """Vectorized version of _put01_inf."""
+    v = (v-0.5)*4*_e_max
+    s = numpy.sign(v)
+    v = v*s
+    e = numpy.floor(v)
+    m = v-e
+    return numpy.ldexp(s*m, e.astype('i')+_e_min)
+
+def _get01_below_vector(dx):
+    """Vectorized version of BoundedBelow.get01 for *dx* = x - base."""
+    m, e = numpy.frexp(dx)
+    v = (e + m)/(2.*_e_max)
+    return numpy.where((m >= 0) & (e <= _e_max), v,
+                       numpy.where(m < 0, 0., 1.))
+
+def _put01_below_vector(v):
+    """Vectorized version of BoundedBelow.put01 returning x - base."""
+    v = v*2*_e_max
+    e = numpy.floor(v)
+    m = v-e
+    return numpy.ldexp(m, e.astype('i'))
+
 _e_min = -1023
 _e_max = 1024
 def _get01_inf(x):
@@ -669,3 +917,23 @@ def _put01_inf(v):
     x = math.ldexp(s*m,e+_e_min)
     #print "< x,e,m,s,v",x,e+_e_min,s*m,s,v
     return x
+
+def test():
+    bounds = [Unbounded(), BoundedBelow(2.), BoundedAbove(-1.), Bounded(0,5),
+              Normal(1,2), BoundedNormal(sigma=2, mu=1, limits=(-1,4)),
+              SoftBounded(0,3,std=0.5)]
+    V = BoundsVector(bounds)
+    x = numpy.array([[0.3, 2.5, -3., 1., 0.2, 0.5, 3.5],
+                     [-10., 200., -1.5, 4.9, 3., 3.9, -1]])
+    for method in ('nllf', 'residual', 'get01'):
+        target = numpy.array([[getattr(b, method)(v) for b, v in zip(bounds, row)]
+                              for row in x])
+        if method == 'nllf': target = numpy.sum(target, axis=1)
+        assert numpy.allclose(getattr(V, method)(x), target), method
+    v = V.get01(x)
+    target = numpy.array([[b.put01(u) for b, u in zip(bounds, row)] for row in v])
+    assert numpy.allclose(V.put01(v), target)
+    x[0,3] = 6
+    assert (V.contains(x) == [False, True]).all()
+    assert V.nllf(x)[0] == inf and V.nllf(x[1]) == V.nllf(x)[1]
+    assert V.contains(V.random(100)).all()
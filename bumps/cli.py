@@ -20,8 +20,9 @@ import numpy
 
 from . import fitters
 from .fitters import FIT_OPTIONS, FitDriver, StepMonitor, ConsoleMonitor
+from .monitor import BackgroundMonitor
 from .fitproblem import load_problem
-from .mapper import MPMapper, AMQPMapper, MPIMapper, SerialMapper
+from .mapper import MPMapper, AMQPMapper, MPIMapper, SerialMapper, SharedMapper
 from . import util
 from . import initpop
 from . import __version__
@@ -248,6 +249,7 @@ class BumpsOpts(ParseOpts):
     FLAGS = set(("preview", "chisq", "profiler", "timer",
                  "simulate", "simrandom", "shake",
                  "worker", "batch", "overwrite", "parallel", "stepmon",
+                 "background",
                  "cov", "remote", "staj", "edit", "mpi",
                  "multiprocessing-fork", # passed in when app is a frozen image
                  "i",
@@ -333,6 +335,9 @@ Options:
         number of burn-in iterations before accumulating stats
     --thin=1        [dream]
         number of fit iterations between steps
+    --history=0     [dream]
+        number of thinned generations to keep in memory; the full chain
+        is streamed to the store.  Use 0 to keep them all.
     --nT=25
     --Tmin=0.1
     --Tmax=10       [pt]
@@ -340,8 +345,22 @@ Options:
         nT if your fit is getting stuck in local minima
     --CR=0.9        [de, rl, pt]
         crossover ratio for population mixing
+    --deriv=forward [newton]
+        finite difference gradient: forward with n evaluations or
+        central with 2n evaluations, done in parallel with --parallel
+    --trials=1      [newton]
+        line search step lengths to evaluate at once; with --parallel,
+        use the number of processors
+    --vertices=0    [amoeba]
+        simplex vertices to update at once; 0 uses one per processor
+        with --parallel
     --starts=1      [%(fitter)s]
         number of times to run the fit from random starting points
+    --rounds=0      [%(fitter)s]
+        alternate between fitting the fast parameters and taking
+        --outer_steps steps on the slow parameters for up to n rounds
+    --outer_steps=10 [%(fitter)s]
+        fit steps on the slow parameters in each round
     --init=lhs      [dream]
         population initialization method:
           eps:    ball around initial parameter set
@@ -350,6 +369,9 @@ Options:
           random: uniformly distributed within parameter ranges
     --stepmon
         show details for each step
+    --background
+        run the console and step monitors in a separate thread so that
+        reporting does not slow the fit
     --resynth=0
         run resynthesis error analysis for n generations
 
@@ -373,8 +395,8 @@ Options:
      'plotter':'|'.join(PLOTTERS),
      }
 
-#    --transport=mp  {amqp|mp|mpi}
-#        use amqp/multiprocessing/mpi for parallel evaluation
+#    --transport=mp  {amqp|mp|mpi|shm}
+#        use amqp/multiprocessing/mpi/shared memory for parallel evaluation
 #    --mesh=var OR var+var
 #        plot chisq line or plane
 #    --meshsteps=n
@@ -404,7 +426,7 @@ Options:
                              %(value,"|".join(sorted(FIT_OPTIONS.keys()))))
         self._fitter = value
     fit = property(fget=lambda self: self._fitter, fset=_set_fitter)
-    TRANSPORTS = 'amqp','mp','mpi','celery'
+    TRANSPORTS = 'amqp','mp','mpi','celery','shm'
     _transport = 'mp'
     def _set_transport(self, value):
         if value not in self.TRANSPORTS:
@@ -449,16 +471,23 @@ def initial_model(opts):
 def resynth(fitdriver, problem, mapper, opts):
     make_store(problem,opts,exists_handler=store_overwrite_query)
     fid = open(problem.output_path+".rsy",'at')
-    fitdriver.mapper = mapper.start_mapper(problem, opts.args)
-    for i in range(opts.resynth):
-        problem.resynth_data()
-        best, fbest = fitdriver.fit()
-        print("step %d chisq %g"%(i,2*fbest/problem.dof))
+    # Run the refits in parallel, one per process, rather than
+    # parallelizing the function evaluations within each refit.
+    if opts.parallel and mapper in (MPMapper, SharedMapper):
+        import multiprocessing
+        fitdriver.cpus = multiprocessing.cpu_count()
+    else:
+        fitdriver.mapper = mapper.start_mapper(problem, opts.args)
+    def record(k, best, fbest):
+        print("step %d chisq %g"%(k,2*fbest/problem.dof))
         fid.write('%.15g '%(2*fbest/problem.dof))
         fid.write(' '.join('%.15g'%v for v in best))
         fid.write('\n')
-    problem.restore_data()
-    fid.close()
+        fid.flush()
+    try:
+        fitdriver.resynth(opts.resynth, callback=record)
+    finally:
+        fid.close()
 
 def set_mplconfig(appdatadir):
     r"""
@@ -575,6 +604,8 @@ def main():
             mapper = AMQPMapper
         elif opts.transport == 'mp':
             mapper = MPMapper
+        elif opts.transport == 'shm':
+            mapper = SharedMapper
         elif opts.transport == 'celery':
             mapper = CeleryMapper
     else:
@@ -623,9 +654,15 @@ def main():
             fid = open(problem.output_path+'.log', 'w')
             fitdriver.monitors = [ConsoleMonitor(problem),
                                StepMonitor(problem,fid,fields=['step','value'])]
+        if opts.background:
+            monitors = fitdriver.monitors or [ConsoleMonitor(problem)]
+            fitdriver.monitors = [BackgroundMonitor(monitors)]
 
         #import time; t0=time.clock()
         fitdriver.mapper = mapper.start_mapper(problem, opts.args)
+        if opts.parallel and mapper in (MPMapper, SharedMapper):
+            import multiprocessing
+            fitdriver.cpus = multiprocessing.cpu_count()
         best, fbest = fitdriver.fit(resume=resume_path)
         #print("time=%g"%(time.clock()-t0),file=sys.__stdout__)
         remember_best(fitdriver, problem, best)
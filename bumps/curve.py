@@ -6,7 +6,7 @@ __all__ = [ "Curve", "PoissonCurve" ]
 import inspect
 
 import numpy
-from numpy import log
+from numpy import log, sqrt, pi
 
 from .parameter import Parameter
 
@@ -31,6 +31,32 @@ class Curve(object):
     default is taken from the function definition (if the function uses
     par=value to define the parameter) or is set to zero if no default is
     given in the function.
+
+    If *vectorized* is True, then the function can be called with each
+    fitted parameter as a column vector with one row per population member,
+    returning one row of theory per member.  This allows population based
+    fitters to evaluate the whole population in a single call rather than
+    updating the model one point at a time.
+
+    If *deriv* is given, then *deriv(x,p1,p2,...)* should return the
+    derivative of *fn* with respect to each parameter, in the order they
+    appear in the function definition, as a sequence with one entry per
+    parameter the same shape as the theory.  This allows Levenberg-Marquardt
+    and quasi-Newton fitters to use analytic derivatives rather than
+    numerical derivatives.
+
+    If *fast* is given, then the theory is computed in two stages, with
+    *fast(x,theory,q1,q2,...)* applying the cheap parameters q1, q2, ...
+    (for example, scale and background) to the theory returned by *fn*.
+    The parameters of *fast* which do not appear in *fn* are tagged as
+    fast (see :attr:`parameter.Parameter.fast`), and the theory from *fn*
+    is reused when only they change.  If *vectorized* is True, then *fast*
+    must be vectorized as well.  Analytic derivatives are not available
+    with a fast stage.
+
+    The *vectorized*, *deriv* and *fast* keywords are only treated as model
+    options if the function has no parameter of the same name.  Otherwise
+    they set the initial value of that parameter.
     """
     def __init__(self, fn, x, y, dy=None, name="", **fnkw):
         self.x, self.y = numpy.asarray(x), numpy.asarray(y)
@@ -54,14 +80,38 @@ class Curve(object):
         # TODO: need "self" handling for passed methods
         # assume the first argument is x
         pnames = pnames[1:]
-                
+
+        # Separate the model options from the parameter initializers.  The
+        # fast stage is needed first since its parameters are also
+        # initializers.
+        def option(key, default):
+            return fnkw.pop(key) if key in fnkw and key not in pnames else default
+        fast = option('fast', None)
+        # The fast stage takes x and the theory, then its own parameters
+        if fast is not None:
+            qnames,vararg,varkw,qvalues = inspect.getargspec(fast)
+            if vararg or varkw:
+                raise TypeError("Function cannot have *args or **kwargs in declaration")
+            qnames = qnames[2:]
+            if qvalues and len(qvalues) > len(qnames):
+                qvalues = qvalues[len(qvalues)-len(qnames):]
+        else:
+            qnames, qvalues = [], None
+        fast_names = [q for q in qnames if q not in pnames]
+        slow_names = pnames
+        pnames = pnames + fast_names
+        vectorized = option('vectorized', False)
+        deriv = option('deriv', None)
+
         # Parameters default to zero
         init = dict( (p,0) for p in pnames)
         # If the function provides default values, use those
+        if qvalues:
+            init.update(zip(qnames[-len(qvalues):],qvalues))
         if pvalues:
             # ignore default value for "x" parameter
-            if len(pvalues) > len(pnames): pvalues = pvalues[1:]
-            init.update(zip(pnames[-len(pvalues):],pvalues))
+            if len(pvalues) > len(slow_names): pvalues = pvalues[1:]
+            init.update(zip(slow_names[-len(pvalues):],pvalues))
         # Regardless, use any values specified in the constructor, but first
         # check that they exist as function parameters.
         invalid = set(fnkw.keys()) - set(pnames)
@@ -69,8 +119,10 @@ class Curve(object):
             raise TypeError("Invalid initializers: %s"%", ".join(sorted(invalid)))
         init.update(fnkw)
 
-        # Build parameters out of ranges and initial values
-        pars = dict( (p,Parameter.default(init[p],name=name+p)) 
+        # Build parameters out of ranges and initial values.  Parameters
+        # supplied by the caller keep their own fast/slow tag.
+        pars = dict( (p,Parameter.default(init[p],name=name+p,
+                                          fast=p in fast_names))
                      for p in pnames)
 
         # Make parameters accessible as model attributes
@@ -82,11 +134,24 @@ class Curve(object):
         # Remember the function, parameters, and number of parameters
         self._function = fn
         self._pnames = pnames
+        self._slow_names = slow_names
+        self._fast_function = fast
+        self._fast_names = qnames
+        self._vectorized = vectorized
+        self._deriv = deriv
         self._cached_theory = None
+        self._cached_slow = None
 
     def update(self):
         self._cached_theory = None
-        
+        self._cached_slow = None
+
+    def update_fast(self):
+        # Keep the theory from the slow stage.  It is checked against the
+        # slow parameter values before reuse, since a slow parameter may
+        # be an expression involving a fast one.
+        self._cached_theory = None
+
     def parameters(self):
         return dict((p,getattr(self, p)) for p in self._pnames)
 
@@ -94,12 +159,30 @@ class Curve(object):
         return numpy.prod(self.y.shape)
 
     def theory(self, x=None):
+        if x is not None:
+            return self._evaluate(x)
         if self._cached_theory is None:
-            if x is None: x = self.x
-            kw = dict( (p,getattr(self,p).value) for p in self._pnames )
-            self._cached_theory = self._function(x, **kw)
+            if self._fast_function is None:
+                self._cached_theory = self._evaluate(self.x)
+            else:
+                kw = self._values(self._slow_names)
+                if self._cached_slow is None or self._cached_slow[0] != kw:
+                    self._cached_slow = kw, self._function(self.x, **kw)
+                self._cached_theory = self._fast_function(
+                    self.x, self._cached_slow[1],
+                    **self._values(self._fast_names))
         return self._cached_theory
 
+    def _values(self, names):
+        return dict( (p,getattr(self,p).value) for p in names )
+
+    def _evaluate(self, x):
+        theory = self._function(x, **self._values(self._slow_names))
+        if self._fast_function is not None:
+            theory = self._fast_function(x, theory,
+                                         **self._values(self._fast_names))
+        return theory
+
     def residuals(self):
         return (self.theory() - self.y)/self.dy
          
@@ -107,6 +190,67 @@ class Curve(object):
         R = self.residuals()
         return 0.5*numpy.sum(R**2)
 
+    def theory_deriv(self, parameters):
+        """
+        Return the derivative of the theory with respect to *parameters*
+        as an Npoints x Nparameters array.
+
+        Raises NotImplementedError if no derivative function was given, or
+        if one of *parameters* enters the function through an expression.
+        """
+        if self._deriv is None or self._fast_function is not None:
+            raise NotImplementedError
+        index = dict((id(p),k) for k,p in enumerate(parameters))
+        kw = self._values(self._pnames)
+        dtheory = self._deriv(self.x, **kw)
+        D = numpy.zeros((self.numpoints(), len(parameters)), 'd')
+        for name, d in zip(self._pnames, dtheory):
+            p = getattr(self, name)
+            if id(p) in index:
+                D[:,index[id(p)]] += numpy.broadcast_to(d, self.y.shape).flat
+            elif any(id(q) in index for q in p.parameters()):
+                raise NotImplementedError
+        return D
+
+    def residuals_deriv(self, parameters):
+        D = self.theory_deriv(parameters)
+        dy = numpy.broadcast_to(self.dy, self.y.shape).flatten()
+        return D/dy[:,None]
+
+    def theory_batch(self, parameters, points):
+        """
+        Return the theory for each point in the Npop x Nvar population,
+        with the columns of *points* corresponding to *parameters*.
+
+        Raises NotImplementedError if the function is not vectorized, or
+        if one of the function parameters is an expression.
+        """
+        if not self._vectorized:
+            raise NotImplementedError
+        index = dict((id(p),k) for k,p in enumerate(parameters))
+        # One column per population member, broadcast across x
+        shape = (points.shape[0],) + (1,)*self.x.ndim
+        kw = {}
+        for name in self._pnames:
+            p = getattr(self, name)
+            if id(p) in index:
+                kw[name] = points[:,index[id(p)]].reshape(shape)
+            elif p.parameters() == [p]:
+                kw[name] = p.value
+            else:
+                raise NotImplementedError
+        theory = self._function(self.x, **dict((k, kw[k])
+                                               for k in self._slow_names))
+        if self._fast_function is not None:
+            theory = self._fast_function(self.x, theory,
+                                         **dict((k, kw[k])
+                                                for k in self._fast_names))
+        return numpy.broadcast_to(theory, shape[:1]+self.y.shape)
+
+    def nllf_batch(self, parameters, points):
+        R = (self.theory_batch(parameters, points) - self.y)/self.dy
+        return 0.5*numpy.sum(R.reshape(R.shape[0],-1)**2, axis=1)
+
     def save(self, basename):
         data = numpy.vstack((self.x,self.y,self.dy,self.theory()))
         numpy.savetxt(basename+'.dat', data.T)
@@ -147,4 +291,119 @@ class PoissonCurve(Curve):
         theory = self.theory()
         if (theory<=0).any(): return 1e308
         return -sum( self.y*log(theory) - theory ) + self._logfacty
+    def nllf_deriv(self, parameters):
+        theory = numpy.asarray(self.theory(), 'd').flatten()
+        D = self.theory_deriv(parameters)
+        return numpy.dot(1 - self.y.flatten()/theory, D)
+    def nllf_batch(self, parameters, points):
+        theory = numpy.array(self.theory_batch(parameters, points), 'd')
+        theory = theory.reshape(theory.shape[0],-1)
+        y = self.y.flatten()
+        bad = (theory<=0).any(axis=1)
+        theory[bad] = 1
+        cost = -numpy.sum(y*log(theory) - theory, axis=1) + self._logfacty
+        cost[bad] = 1e308
+        return cost
+
+
+
+def _line(x, m, b): return m*x + b
+def test_fast():
+    from .fitproblem import FitProblem
+    calls = []
+    def peak(x, center=1, width=0.5):
+        calls.append(center)
+        return numpy.exp(-0.5*(x-center)**2/width**2)
+    def scaled(x, theory, scale=2, background=0.1):
+        return scale*theory + background
+    x = numpy.linspace(0, 2, 11)
+    y = scaled(x, peak(x))
+    M = Curve(peak, x, y, 0.1, fast=scaled, center=(0, 2), width=0.5)
+    assert M.scale.fast and M.background.fast and not M.center.fast
+    assert sorted(M.parameters()) == ['background', 'center', 'scale', 'width']
+    M.scale.range(0, 5)
+    M.background.range(0, 1)
+    problem = FitProblem(M)
+    assert problem.labels() == ['background', 'center', 'scale']
+    assert problem.fast_mask().tolist() == [True, False, True]
+
+    problem.setp([0.1, 1, 2])
+    assert problem.nllf() < 1e-20
+    # Changing only the fast parameters reuses the slow theory
+    expected = [scaled(x, peak(x), 3, 0.3), scaled(x, peak(x, 1.5), 2.5, 0.2)]
+    del calls[:]
+    problem.setp([0.3, 1, 3])
+    assert numpy.allclose(M.theory(), expected[0])
+    problem.setp([0.2, 1, 2.5])
+    problem.nllf()
+    assert calls == []
+    problem.setp([0.2, 1.5, 2.5])
+    assert numpy.allclose(M.theory(), expected[1])
+    assert calls == [1.5]
+
+    # Batch evaluation gives the same nllf as the serial evaluation
+    V = Curve(_line, x, y, 0.1, vectorized=True, fast=scaled,
+              m=(0, 2), scale=(0, 5))
+    problem = FitProblem(V)
+    points = numpy.random.RandomState(1).rand(5, 2)*[2, 5]
+    serial = [problem.nllf(p) for p in points]
+    assert numpy.allclose(problem.nllf_batch(points), serial)
+
+def _quadratic(x, a, b, c): return a*x**2 + b*x + c
+def _quadratic_deriv(x, a, b, c): return [x**2, x, 1]
+def test_deriv():
+    from .fitproblem import FitProblem
+    x = numpy.linspace(1, 2, 7)
+    y = _quadratic(x, 1, 2, 3)
+    dy = 0.1*y
+    def numeric(fn, p, h=1e-6):
+        D = []
+        for k in range(len(p)):
+            dp = numpy.zeros(len(p)); dp[k] = h
+            problem.setp(p+dp); hi = numpy.array(fn())
+            problem.setp(p-dp); lo = numpy.array(fn())
+            D.append((hi - lo)/(2*h))
+        problem.setp(p)
+        return numpy.array(D).T
+
+    M = Curve(_quadratic, x, y, dy, deriv=_quadratic_deriv,
+              a=(0, 2), b=(0, 4), c=(0, 5))
+    problem = FitProblem(M)
+    p = numpy.array([1.5, 2.5, 2.])
+    problem.setp(p)
+    J = problem.residuals_deriv()
+    assert J.shape == (len(x), 3)
+    assert numpy.allclose(J, numeric(problem.residuals, p), rtol=1e-6)
+    assert numpy.allclose(M.residuals_deriv([M.b, M.a]), J[:, [1, 0]])
+    assert numpy.allclose(M.theory_deriv([M.c]), 1)
+
+    # The Poisson nllf gradient uses the same theory derivative
+    P = PoissonCurve(_quadratic, x, numpy.round(y), deriv=_quadratic_deriv,
+                     a=(0, 2), b=(0, 4), c=(0, 5))
+    problem = FitProblem(P)
+    problem.setp(p)
+    assert numpy.allclose(P.nllf_deriv([P.a, P.b, P.c]),
+                          numeric(problem.nllf, p), rtol=1e-6)
+
+    # Parameters inside expressions have no analytic derivative
+    M = Curve(_quadratic, x, y, dy, deriv=_quadratic_deriv, a=(0, 2), b=2)
+    M.c = 2*M.a
+    try:
+        FitProblem(M).residuals_deriv()
+    except NotImplementedError:
+        pass
+    else:
+        raise AssertionError("expected NotImplementedError")
 
+    # Function parameters may share their names with the model options
+    def fn(x, deriv, vectorized, fast=1): return deriv*x + vectorized + fast
+    M = Curve(fn, x, y, dy, deriv=(0, 2), vectorized=3)
+    assert sorted(M.parameters()) == ['deriv', 'fast', 'vectorized']
+    assert M.vectorized.value == 3 and M.fast.value == 1
+    assert M._deriv is None and not M._vectorized
+    try:
+        M.theory_deriv([M.deriv])
+    except NotImplementedError:
+        pass
+    else:
+        raise AssertionError("expected NotImplementedError")
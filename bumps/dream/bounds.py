@@ -32,7 +32,7 @@ def make_bounds_handler(bounds, style='reflect'):
     outside the bounds (which can happen if the step size is too large),
     and a random uniform value is used instead.
     """
-    if bounds == None:
+    if bounds is None:
         return IgnoreBounds()
 
     low,high = bounds
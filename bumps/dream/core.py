@@ -106,7 +106,6 @@ import time
 
 from .state import MCMCDraw
 from .metropolis import metropolis, metropolis_dr, dr_step
-from .gelman import gelman
 from .crossover import AdaptiveCrossover
 from .diffev import de_step
 from .bounds import make_bounds_handler
@@ -163,6 +162,14 @@ class Dream(object):
     goalseek_optimizer=None
     goalseek_interval=1e100 # close enough to never
     goalseek_minburn=1000
+    # Streaming state to disk.  If *stream* is a file name, then the state
+    # is written to disk every *stream_chunk* generations as it is collected
+    # (see :class:`state.StateWriter`).  With the full history on disk, the
+    # number of thinned generations kept in memory can be limited to
+    # *stream_history* (the --history option for the DREAM fitter).
+    stream = None
+    stream_chunk = 100
+    stream_history = None
 
 
     def __init__(self, **kw):
@@ -186,6 +193,10 @@ class Dream(object):
             run_dream(self, abort_test=abort_test)
         except KeyboardInterrupt:
             pass
+        finally:
+            if self.state is not None:
+                self.state.close_stream()
+                self.state._unroll()
         return self.state
 
 def run_dream(dream, abort_test=None):
@@ -194,7 +205,7 @@ def run_dream(dream, abort_test=None):
     # [PAK] I moved this out of dream so that the user can use whatever
     # complicated sampling scheme they want.  Unfortunately, this means
     # the user needs to know some complex sampling scheme.
-    if dream.population == None:
+    if dream.population is None:
         raise ValueError("initial population not defined")
 
     # Remember the problem dimensions
@@ -208,9 +219,14 @@ def run_dream(dream, abort_test=None):
     apply_bounds = make_bounds_handler(dream.model.bounds,
                                        style=dream.bounds_style)
 
-    # Record initial state
+    # Record initial state.  A resumed state is written to the stream
+    # before it is trimmed to the in-memory window.
+    if dream.stream is not None and dream.state is not None:
+        dream.state.stream_to(dream.stream, chunk=dream.stream_chunk)
     allocate_state(dream)
     state = dream.state
+    if dream.stream is not None and state._writer is None:
+        state.stream_to(dream.stream, chunk=dream.stream_chunk)
     state.labels = dream.model.labels
     previous_draws = state.draws
     if previous_draws:
@@ -318,8 +334,7 @@ def run_dream(dream, abort_test=None):
         # ---------------------------------------------------------------------
 
         # Calculate Gelman and Rubin convergence diagnostic
-        _, points, _ = state.chains()
-        R_stat = gelman(points, portion=0.5)
+        R_stat = state.gelman(portion=0.5)
 
         if state.draws <= 0.1 * dream.draws:
             # Adapt the crossover ratio, but only during burn-in.
@@ -349,6 +364,11 @@ def allocate_state(dream):
     Nupdate = int(draws/(steps*Nchain)) + 1
     Ngen = Nupdate * steps
     Nthin = int(Ngen/thinning) + 1
+    if dream.stream is not None and dream.stream_history is not None:
+        # Older generations are on disk, so only keep a window in memory
+        Nthin = min(Nthin, dream.stream_history)
+        Ngen = min(Ngen, Nthin*thinning)
+        Nupdate = min(Nupdate, int(Ngen/steps) + 1)
     #print Ngen, Nthin, Nupdate, draws, steps, Npop, Nvar
 
     if dream.state != None:
@@ -65,7 +65,7 @@ class Corr2d:
                      fontproperties=FontProperties(size=16))
         self.ax = _plot(fig, self.hists, self.labels, self.N)
 
-def _hists(data, ranges=None, **kw):
+def _hists(data, ranges=None, bins=10, **kw):
     """
     Generate pair-wise correlation histograms
     """
@@ -73,10 +73,52 @@ def _hists(data, ranges=None, **kw):
     if ranges == None:
         low,high = numpy.min(data,axis=1), numpy.max(data,axis=1)
         ranges = [(l,h) for l,h in zip(low,high)]
-    return dict(((i,j), numpy.histogram2d(data[i], data[j],
-                                    range=[ranges[i],ranges[j]], **kw))
-                for i in range(0,N)
-                for j in range(i+1,N))
+    if kw or not numpy.isscalar(bins):
+        # Weighted, normed or irregular histograms go through histogram2d
+        return dict(((i,j), numpy.histogram2d(data[i], data[j], bins=bins,
+                                        range=[ranges[i],ranges[j]], **kw))
+                    for i in range(0,N)
+                    for j in range(i+1,N))
+    return _pair_hists(data, ranges, bins)
+
+def _pair_hists(data, ranges, bins):
+    """
+    Generate pair-wise correlation histograms from one binning of each
+    variable.
+
+    The bin number of every sample is found once per variable, and each
+    pair is then counted with a single bincount, rather than redoing the
+    search for both variables for every pair as histogram2d does.  The
+    bins follow histogram2d, with the last bin closed on the right and
+    samples outside the range ignored.
+    """
+    N = len(data)
+    edges, index, inside = [], [], []
+    for k in range(N):
+        x = numpy.asarray(data[k])
+        lo, hi = ranges[k]
+        if lo == hi:
+            lo, hi = lo-0.5, hi+0.5
+        e = numpy.linspace(lo, hi, bins+1)
+        idx = numpy.searchsorted(e, x, side='right') - 1
+        idx[x == e[-1]] = bins-1
+        out = (idx < 0) | (idx >= bins)
+        edges.append(e)
+        index.append(idx)
+        inside.append(None if not out.any() else ~out)
+    hists = {}
+    for i in range(0,N):
+        for j in range(i+1,N):
+            pair = index[i]*bins + index[j]
+            if inside[i] is not None or inside[j] is not None:
+                keep = True
+                if inside[i] is not None: keep = keep & inside[i]
+                if inside[j] is not None: keep = keep & inside[j]
+                pair = pair[keep]
+            counts = numpy.bincount(pair, minlength=bins*bins)
+            hists[i,j] = (counts.reshape(bins,bins).astype('d'),
+                          edges[i], edges[j])
+    return hists
 
 def _plot(fig, hists, labels, N, show_ticks=False):
     """
@@ -169,3 +211,20 @@ def zoom(event,step):
         lo, hi = rescale(lo,hi,event.ydata,step)
         ax.set_ylim((lo,hi))
     ax.figure.canvas.draw_idle()
+
+def test():
+    from numpy.random import RandomState
+    rng = RandomState(1)
+    data = rng.normal(size=(4, 10000))
+    data[2] = 1.5
+    fast = _hists(data, bins=20)
+    ranges = [(-1,1), (-2,3), (1,2), (-0.5,0.5)]
+    fast_ranged = _hists(data, ranges=ranges, bins=20)
+    for (i,j),(counts,xe,ye) in fast.items():
+        low,high = numpy.min(data,axis=1), numpy.max(data,axis=1)
+        H,X,Y = numpy.histogram2d(data[i], data[j], bins=20,
+                                  range=[(low[i],high[i]),(low[j],high[j])])
+        assert (counts == H).all() and (xe == X).all() and (ye == Y).all()
+        H,X,Y = numpy.histogram2d(data[i], data[j], bins=20,
+                                  range=[ranges[i],ranges[j]])
+        assert (fast_ranged[i,j][0] == H).all()
@@ -1,11 +1,13 @@
 from __future__ import division
 
 from numpy import zeros, ones, dot, cov, eye, sqrt, sum, all
-from numpy import where, select
+from numpy import where, select, empty, arange, any, flatnonzero
 from numpy.linalg import norm, cholesky, LinAlgError
 from .util import draw
 from numpy import random as RNG
 
+SNOOKER, DE, DIRECT = 0, 1, 2
+
 def de_step(Nchain,pop,CR,max_pairs=2,eps=0.05,snooker_rate=0.1,noise=1e-6):
     """
     Generates offspring using METROPOLIS HASTINGS monte-carlo markov chain
@@ -13,6 +15,150 @@ def de_step(Nchain,pop,CR,max_pairs=2,eps=0.05,snooker_rate=0.1,noise=1e-6):
     The number of chains may be smaller than the population size if the
     population is selected from both the current generation and the
     ancestors.
+
+    The proposals for all chains are generated at once.  The move types
+    and step sizes follow the same distributions as the chain by chain
+    version :func:`_de_step_loop`, but the random number stream is
+    consumed in a different order, so results will not match for the
+    same seed.
+    """
+    Npop, Nvar = pop.shape
+
+    # Initialize the delta update to zero
+    delta_x = zeros( (Nchain,Nvar) )
+    step_alpha = ones( Nchain )
+
+    # Choose snooker, de or direct according to snooker_rate, and 80:20
+    # ratio of de to direct.
+    u = RNG.rand(Nchain)
+    de_rate = 0.8 * (1-snooker_rate)
+    alg = select([u < snooker_rate, u < snooker_rate+de_rate],
+                 [SNOOKER,DE], default=DIRECT)
+    use_de_step = (alg == DE)
+
+    # Use DE with cross-over ratio
+    qq = flatnonzero(alg == DE)
+    if len(qq):
+        n = len(qq)
+
+        # Select to number of vector pair differences to use in update
+        # using k ~ discrete U[1,max pairs], with no more pairs than there
+        # are other members in the population
+        max_pairs = max(min(max_pairs, (Npop-1)//2), 1)
+        k = RNG.randint(max_pairs, size=n)+1
+
+        # Select 2*max_pairs members at random different from the current
+        # member, and use only the first k pairs for each chain
+        perm = _draw_others(qq, 2*max_pairs, Npop)
+        r1, r2 = perm[:,:max_pairs], perm[:,max_pairs:]
+        in_use = arange(max_pairs)[None,:] < k[:,None]
+        step = sum((pop[r1]-pop[r2])*in_use[:,:,None], axis=1)
+
+        # Select the dims to update based on the crossover ratio, making
+        # sure at least one dim is selected
+        vars = RNG.rand(n,Nvar) > (1-CR[qq])[:,None]
+        empty_rows = flatnonzero(~any(vars, axis=1))
+        vars[empty_rows, RNG.randint(Nvar, size=len(empty_rows))] = True
+
+        # Weight the size of the jump inversely proportional to the
+        # number of contributions, both from the parameters being
+        # updated and from the population defining the step direction.
+        gamma = 2.38/sqrt(2 * sum(vars, axis=1) * k)
+
+        # Apply that step with F scaling and noise
+        jiggle = 1 + eps * (2 * RNG.rand(n,Nvar) - 1)
+        delta_x[qq] = where(vars, jiggle*gamma[:,None]*step, 0.)
+
+    # Use snooker update
+    qq = flatnonzero(alg == SNOOKER)
+    if len(qq):
+        n = len(qq)
+
+        # Select current and three others
+        perm = _draw_others(qq, 3, Npop)
+        xi = pop[qq]
+        z,R1,R2 = pop[perm[:,0]], pop[perm[:,1]], pop[perm[:,2]]
+
+        # Find the step direction and scale it to the length of the
+        # projection of R1-R2 onto the step direction.
+        step = xi - z
+        denom = sum(step**2, axis=1)
+        same = flatnonzero(denom == 0)
+        if len(same):
+            step[same] = noise*RNG.randn(len(same),Nvar)
+            denom[same] = sum(step[same]**2, axis=1)
+        scale = sum( (R1-R2)*step, axis=1 ) / denom
+
+        # Step using gamma of 2.38/sqrt(2) + U(-0.5,0.5)
+        gamma = 1.2 + RNG.rand(n)
+        delta_x[qq] = (gamma * scale)[:,None] * step
+
+        # Scale Metropolis probability by (||xi* - z||/||xi - z||)^(d-1)
+        step_alpha[qq] = (norm(delta_x[qq]+step, axis=1)
+                          / norm(step, axis=1))**((Nvar-1)/2)
+
+    # Use one pair and all dimensions
+    qq = flatnonzero(alg == DIRECT)
+    if len(qq):
+        # Note that there is no F scaling, dimension selection or noise
+        perm = _draw_others(qq, 2, Npop)
+        delta_x[qq] = pop[perm[:,0]] - pop[perm[:,1]]
+
+    # If no step was specified (exceedingly unlikely!), then
+    # select a delta at random from a gaussian approximation to the
+    # current population
+    qq = flatnonzero(all(delta_x == 0, axis=1))
+    if len(qq):
+        try:
+            # Compute the Cholesky Decomposition of x_old
+            R = (2.38/sqrt(Nvar)) * cholesky(cov(pop.T) + noise*eye(Nvar))
+            # Generate jump using multinormal distribution
+            delta_x[qq] = dot(RNG.randn(len(qq),Nvar), R)
+        except LinAlgError:
+            print("Bad cholesky")
+            delta_x[qq] = RNG.randn(len(qq),Nvar)
+
+    # Update x_old with delta_x and noise
+    x_new = pop[:Nchain] + delta_x + noise*RNG.randn(Nchain,Nvar)
+
+    # [PAK] The noise term needs to depend on the fitting range
+    # of the parameter rather than using a fixed noise value for all
+    # parameters.  See the note in _de_step_loop.
+
+    return x_new, step_alpha, use_de_step
+
+def _draw_others(qq, k, Npop):
+    """
+    For each chain in *qq*, select *k* distinct members of a population
+    of size *Npop*, none of which is the chain itself.
+
+    Returns an array of shape (len(qq), k).  All chains draw at the same
+    time, with any duplicates within a row redrawn until the row is unique.
+
+    Raises ValueError if *k* is more than the *Npop-1* members available.
+    """
+    if k > Npop-1:
+        raise ValueError("cannot draw %d distinct members from %d others"
+                         % (k, Npop-1))
+    n = len(qq)
+    result = empty((n,k), 'i')
+    for j in range(k):
+        col = RNG.randint(Npop-1, size=n)
+        dup = any(result[:,:j] == col[:,None], axis=1)
+        while dup.any():
+            col[dup] = RNG.randint(Npop-1, size=dup.sum())
+            dup = any(result[:,:j] == col[:,None], axis=1)
+        result[:,j] = col
+    # Skip over the current member
+    result += (result >= qq[:,None])
+    return result
+
+def _de_step_loop(Nchain,pop,CR,max_pairs=2,eps=0.05,snooker_rate=0.1,noise=1e-6):
+    """
+    Chain by chain version of :func:`de_step`.
+
+    This is the original implementation, retained as a reference for
+    checking and benchmarking the vectorized version.
     """
     Npop, Nvar = pop.shape
 
@@ -143,5 +289,77 @@ population.
         vstr = " ".join("%4d"%(int(v/100+0.5)) for v in x_new[i]-pop[i])
         print(rstr+vstr)
 
+def _benchmark(Nvar=20, Nchain=None, Nstep=200):
+    """
+    Time the vectorized :func:`de_step` against :func:`_de_step_loop`.
+    """
+    import time
+    if Nchain is None: Nchain = 10*Nvar
+    pop = RNG.randn(Nchain, Nvar)
+    CR = RNG.choice([1./3, 2./3, 1.], size=Nchain)
+    for fn in (_de_step_loop, de_step):
+        t0 = time.time()
+        for _ in range(Nstep):
+            fn(Nchain, pop, CR, max_pairs=3)
+        dt = (time.time() - t0)/Nstep
+        print("%14s Nvar=%d Nchain=%d: %.3f ms/step"
+              % (fn.__name__, Nvar, Nchain, dt*1000))
+
+def _move_stats(fn, Nchain, pop, CR, Nstep):
+    import numpy
+    moves, alpha, used = [], [], []
+    for _ in range(Nstep):
+        x, a, u = fn(Nchain, pop, CR, max_pairs=3, noise=0)
+        moves.append(x - pop[:Nchain])
+        alpha.append(a)
+        used.append(u)
+    moves, alpha, used = [numpy.vstack(v) for v in (moves, alpha, used)]
+    return (numpy.mean(used),
+            numpy.mean(moves != 0, axis=0),
+            numpy.mean(abs(moves), axis=0),
+            numpy.mean(numpy.log(alpha)))
+
+def test():
+    import numpy
+    state = RNG.get_state()
+    RNG.seed(1)
+    try:
+        Nchain, Nvar, Nstep = 20, 4, 400
+        pop = RNG.randn(40, Nvar) * numpy.arange(1, Nvar+1)
+        CR = numpy.linspace(0.2, 1, Nchain)
+        vec = _move_stats(de_step, Nchain, pop, CR, Nstep)
+        loop = _move_stats(_de_step_loop, Nchain, pop, CR, Nstep)
+    finally:
+        RNG.set_state(state)
+
+    # Proportion of DE moves is 0.8*(1-snooker_rate)
+    assert abs(vec[0] - 0.72) < 0.02 and abs(loop[0] - 0.72) < 0.02
+    # Portion of dimensions changed and size of the changes agree
+    assert numpy.all(abs(vec[1] - loop[1]) < 0.03), (vec[1], loop[1])
+    assert numpy.all(abs(vec[2]/loop[2] - 1) < 0.1), (vec[2], loop[2])
+    # Snooker acceptance scaling agrees
+    assert abs(vec[3] - loop[3]) < 0.05, (vec[3], loop[3])
+
+    # Each draw excludes the current member and has no duplicates
+    qq = numpy.arange(10)
+    perm = _draw_others(qq, 6, 12)
+    assert numpy.all(perm != qq[:,None])
+    assert numpy.all([len(set(row)) == 6 for row in perm])
+    # Drawing every other member is allowed, but drawing more is an error
+    perm = _draw_others(qq, 11, 12)
+    assert numpy.all(numpy.sort(perm, axis=1)
+                     == [numpy.delete(numpy.arange(12), q) for q in qq])
+    try:
+        _draw_others(qq, 12, 12)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError for k > Npop-1")
+    # Small populations limit the number of DE pairs
+    x_new, _, _ = de_step(4, RNG.randn(5, 3), numpy.ones(4), max_pairs=3)
+    assert numpy.all(numpy.isfinite(x_new))
+
 if __name__ == "__main__":
     _check()
+    for Nvar in (5, 20, 100):
+        _benchmark(Nvar)
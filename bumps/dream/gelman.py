@@ -1,4 +1,3 @@
-
 """
 Convergence test statistic from Gelman and Rubin, 1992.
 """
@@ -6,6 +5,7 @@ Convergence test statistic from Gelman and Rubin, 1992.
 from __future__ import division
 
 from numpy import var, mean, ones, sqrt,sum,transpose,reshape,cov,corrcoef
+from numpy import zeros, maximum
 
 def gelman(sequences, portion=0.5):
     """
@@ -27,33 +27,108 @@ def gelman(sequences, portion=0.5):
 
     if chain_len < 2:
         # Set the R-statistic to a large value
-        R_stat = -2 * ones(Nvar)
-    else:
-        # Step 1: Determine the sequence means
-        meanSeq = mean(sequences, axis=0)
+        return -2 * ones(Nvar)
+
+    # Step 1: Determine the sequence means
+    meanSeq = mean(sequences, axis=0)
+
+    # Step 2: Compute the variance of the various sequences
+    varSeq = var(sequences, axis=0, ddof=1)
+
+    return gelman_moments(meanSeq, varSeq, chain_len)
 
-        # Step 1: Determine the variance between the sequence means
-        B = chain_len * var(meanSeq, axis=0, ddof=1)
+def gelman_moments(meanSeq, varSeq, chain_len):
+    """
+    Calculates the R-statistic from the per-chain means and variances.
+
+    *meanSeq* and *varSeq* are Nchains x Nvar arrays of the mean and the
+    unbiased variance of each variable in each chain, computed over the
+    last *chain_len* samples.
+    """
+    Nchains,Nvar = meanSeq.shape
+    if chain_len < 2:
+        # Set the R-statistic to a large value
+        return -2 * ones(Nvar)
 
-        # Step 2: Compute the variance of the various sequences
-        varSeq = var(sequences, axis=0, ddof=1)
+    # Step 1: Determine the variance between the sequence means
+    B = chain_len * var(meanSeq, axis=0, ddof=1)
 
-        # Step 2: Calculate the average of the within sequence variances
-        W = mean(varSeq,axis=0)
+    # Step 2: Calculate the average of the within sequence variances
+    W = mean(varSeq,axis=0)
 
-        # Step 3: Estimate the target mean
-        #mu = mean(meanSeq)
+    # Step 3: Estimate the target mean
+    #mu = mean(meanSeq)
 
-        # Step 4: Estimate the target variance (Eq. 3)
-        sigma2 = ((chain_len - 1)/chain_len) * W + (1/chain_len) * B
+    # Step 4: Estimate the target variance (Eq. 3)
+    sigma2 = ((chain_len - 1)/chain_len) * W + (1/chain_len) * B
 
-        # Step 5: Compute the R-statistic
-        R_stat = sqrt((Nchains + 1)/Nchains * sigma2 / W - (chain_len-1)/Nchains/chain_len);
-        #par=2
-        #print chain_len,B[par],varSeq[...,par],W[par],R_stat[par]
+    # Step 5: Compute the R-statistic
+    R_stat = sqrt((Nchains + 1)/Nchains * sigma2 / W - (chain_len-1)/Nchains/chain_len);
+    #par=2
+    #print chain_len,B[par],varSeq[...,par],W[par],R_stat[par]
 
     return R_stat
 
+class RunningMoments(object):
+    """
+    Per-chain running mean and sum of squared deviations.
+
+    *sequences* is a chain_len x Nchains x Nvar array of initial samples,
+    which may be empty.  Samples can be added and removed one generation
+    at a time using the updating formulas of Welford (1962), so the moments
+    can follow a moving window over the chain history in O(Nchains*Nvar)
+    per generation.
+    """
+    def __init__(self, sequences):
+        self.n = sequences.shape[0]
+        if self.n > 0:
+            self.mean = mean(sequences, axis=0)
+            self.M2 = sum((sequences - self.mean)**2, axis=0)
+        else:
+            self.mean = zeros(sequences.shape[1:])
+            self.M2 = zeros(sequences.shape[1:])
+
+    def add(self, x):
+        """
+        Add the Nchains x Nvar generation *x* to the moments.
+        """
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta/self.n
+        self.M2 += delta*(x - self.mean)
+
+    def remove(self, x):
+        """
+        Remove the Nchains x Nvar generation *x* from the moments.
+
+        Removal is less stable than addition, so *M2* is clipped at zero
+        to protect against round-off.  Rebuild the moments from the samples
+        from time to time to stop the error from accumulating.
+        """
+        self.n -= 1
+        if self.n == 0:
+            self.mean[:] = 0
+            self.M2[:] = 0
+        else:
+            delta = x - self.mean
+            self.mean -= delta/self.n
+            self.M2 -= delta*(x - self.mean)
+            maximum(self.M2, 0, out=self.M2)
+
+    def var(self):
+        """
+        Return the unbiased variance of each variable in each chain.
+        """
+        return self.M2/(self.n-1)
+
+    def R_stat(self):
+        """
+        Return the Gelman-Rubin R-statistic for the samples in the window.
+        """
+        if self.n < 2:
+            return -2 * ones(self.mean.shape[1])
+        return gelman_moments(self.mean, self.var(), self.n)
+
 def test():
     from numpy import reshape, arange, transpose
     from numpy.linalg import norm
@@ -72,5 +147,19 @@ def test():
     R = gelman(S, portion=.1)
     assert norm(R - [-2, -2, -2, -2, -2, -2]) == 0
 
+    # Running moments over a moving window match the direct calculation
+    moments = RunningMoments(S[:5])
+    for x in S[5:]: moments.add(x)
+    for x in S[:3]: moments.remove(x)
+    assert norm(moments.R_stat() - gelman(S[3:], portion=1)) < 1e-10
+
+    # Removing nearly identical samples leaves a non-negative variance
+    from numpy.random import RandomState
+    S = 1e8 + 1e-3*RandomState(0).randn(40, 1, 1)
+    moments = RunningMoments(S[:0])
+    for x in S: moments.add(x)
+    for x in S[:-1]: moments.remove(x)
+    assert (moments.M2 >= 0).all()
+
 if __name__ == "__main__":
     test()
@@ -11,13 +11,17 @@ The results may be queried as follows::
     acceptance_rate() returns draws, AR
     chains()          returns draws, chains, logp
     R_stat()          returns draws, R
+    gelman(portion)   returns R for the current chains
     CR_weight()       returns draws, CR_weight
     best()            returns best_x, best_logp
     outliers()        returns outliers
     show()/save(file)/load(file)
 
 Data is stored in circular arrays, which keeps the last N generations and
-throws the rest away.
+throws the rest away.  Queries return views into the arrays when they
+have not wrapped, or copies in generation order when they have.  The
+arrays are only rotated in place by an explicit unroll, which happens
+at the end of sampling and when the state is saved.
 
 draws is the total number of draws from the sampler.
 
@@ -67,18 +71,21 @@ best_x is the corresponding point at which it was observed.
 
 generation is the last generation number
 """
-#TODO: state should be collected in files as we go
 from __future__ import division, print_function
 
-__all__ = ['MCMCDraw','load_state','save_state']
+__all__ = ['MCMCDraw','load_state','save_state',
+           'text_to_binary_state','binary_to_text_state','StateWriter']
 
+import os
 import re
 import gzip
+import json
 
 import numpy
 from numpy import empty, sum, asarray, inf, argmax, hstack, dstack
 from numpy import savetxt,loadtxt, reshape
 from .outliers import identify_outliers
+from .gelman import RunningMoments
 from .util import draw, RNG
 
 #EXT = ".mc.gz"
@@ -86,12 +93,374 @@ from .util import draw, RNG
 EXT = ".mc"
 CREATE = open
 
+# Binary state is stored as a set of .npy files, one per array, with the
+# dimensions and scalar values in a JSON header.  The .npy files can be
+# memory mapped on load so that only the portion of the chain which is
+# used needs to be read from disk.
+HEADER_EXT = "-state.json"
+BINARY_FORMAT = "bumps-dream-state"
+BINARY_VERSION = 1
+
+# State can also be streamed to disk during sampling by a StateWriter.
+# Each table is an append-only file of float64 rows, with the number of
+# complete rows recorded in the JSON stream header.  The header is replaced
+# after each flush, so rows beyond the recorded count from an interrupted
+# flush are ignored on load.
+STREAM_EXT = "-stream.json"
+STREAM_FORMAT = "bumps-dream-stream"
+STREAM_TABLES = ('gen', 'thin', 'update')
+
 class NoTrace:
     def write(self, data): pass
     def flush(self): pass
     def close(self): pass
 
-def save_state(state, filename):
+def save_state(state, filename, binary=False):
+    """
+    Save the MCMC state to files starting with *filename*.
+
+    The state is saved as text in the -chain, -point and -stats files.
+    If *binary*, then the arrays are saved as .npy files with a JSON
+    header (see :data:`HEADER_EXT`) instead.  If the state was streamed
+    to *filename* during sampling, the stream already holds the chains,
+    so a binary save only brings the stream up to date with the state.
+    """
+    stream = state._stream
+    if binary and stream is not None and stream.filename == filename:
+        stream.finish(state)
+        return
+    state._unroll()
+    if binary:
+        _save_binary(state, filename)
+    else:
+        _save_text(state, filename)
+
+def load_state(filename, skip=0, report=0, portion=None, vars=None, mmap=True):
+    """
+    Load the MCMC state from files starting with *filename*.
+
+    The binary format is used if it exists, otherwise the stream written
+    during sampling by :class:`StateWriter`, otherwise the text format.
+
+    *skip* is the number of thinned generations to skip at the start of
+    the chains, and *portion* is the fraction of the remaining thinned
+    generations to keep, counting from the end.  *vars* is a list of the
+    variable indices to load.  For the binary format, the arrays are memory
+    mapped if *mmap* is True, and only the selected portion is read from
+    disk.  The stream and text formats must be read in full, so *portion*
+    and *vars* are applied after loading.
+
+    *report* prints progress every *report* generations while loading the
+    text format.
+    """
+    if os.path.exists(filename+HEADER_EXT):
+        return _load_binary(filename, skip=skip, portion=portion,
+                            vars=vars, mmap=mmap)
+    elif os.path.exists(filename+STREAM_EXT):
+        state = _load_stream(filename, skip=skip)
+    else:
+        state = _load_text(filename, skip=skip, report=report)
+    if portion is not None or vars is not None:
+        state = _select(state, portion=portion, vars=vars)
+    return state
+
+def text_to_binary_state(filename):
+    """
+    Convert the state saved as text in *filename* to binary.
+    """
+    _save_binary(_load_text(filename), filename)
+
+def binary_to_text_state(filename):
+    """
+    Convert the state saved as binary in *filename* to text.
+    """
+    _save_text(_load_binary(filename, mmap=False), filename)
+
+def _save_binary(state, filename):
+    draws, logp = state.logp(full=True)
+    _, AR = state.acceptance_rate()
+    thin_draws, point, thin_logp = state.chains()
+    update_draws, R_stat = state.R_stat()
+    _, CR_weight = state.CR_weight()
+    best_x, best_logp = state.best()
+    Nthin,Npop,Nvar = point.shape
+    header = dict(
+        format=BINARY_FORMAT,
+        version=BINARY_VERSION,
+        Ngen=len(draws), Nthin=Nthin, Nupdate=len(update_draws),
+        Npop=Npop, Nvar=Nvar, Ncr=CR_weight.shape[1],
+        draws=int(state.draws),
+        thinning=int(state.thinning),
+        labels=state._labels,
+        title=state.title,
+        outliers=[[int(v) for v in row] for row in state._outliers],
+        best_logp=float(best_logp),
+        best_x=None if best_x is None else [float(v) for v in best_x],
+        )
+    arrays = dict(
+        gen_draws=draws, gen_logp=logp, gen_acceptance_rate=AR,
+        thin_draws=thin_draws, thin_point=point, thin_logp=thin_logp,
+        update_draws=update_draws, update_R_stat=R_stat,
+        update_CR_weight=CR_weight,
+        )
+    if os.path.exists(filename+HEADER_EXT):
+        os.remove(filename+HEADER_EXT)
+    for name, value in arrays.items():
+        numpy.save(filename+'-'+name+'.npy', numpy.ascontiguousarray(value))
+    # Write the header last so that an interrupted save is not mistaken
+    # for a complete one.
+    with open(filename+HEADER_EXT, 'w') as fid:
+        json.dump(header, fid)
+
+def _load_binary(filename, skip=0, portion=None, vars=None, mmap=True):
+    with open(filename+HEADER_EXT, 'r') as fid:
+        header = json.load(fid)
+    if header.get('format') != BINARY_FORMAT:
+        raise ValueError("%s is not a DREAM state file"%(filename+HEADER_EXT))
+    if header['version'] > BINARY_VERSION:
+        raise ValueError("DREAM state file %s is from a newer version"
+                         %(filename+HEADER_EXT))
+
+    # Copy-on-write mapping, so that keep_best, etc. can modify the
+    # loaded chains without changing the file.
+    mode = 'c' if mmap else None
+    def load(name):
+        return numpy.load(filename+'-'+name+'.npy', mmap_mode=mode)
+
+    Nthin = header['Nthin']
+    start = min(skip, Nthin)
+    if portion is not None:
+        start += int((1-portion)*(Nthin-start))
+    thin_draws = load('thin_draws')[start:]
+    thin_point = load('thin_point')[start:]
+    thin_logp = load('thin_logp')[start:]
+    update_R_stat = load('update_R_stat')
+    best_x = header['best_x']
+    labels = header['labels']
+    if vars is not None:
+        thin_point = thin_point[:,:,vars]
+        update_R_stat = update_R_stat[:,vars]
+        if best_x is not None: best_x = [best_x[v] for v in vars]
+        if labels is not None: labels = [labels[v] for v in vars]
+
+    state = MCMCDraw(0,0,0,0,0,0,header['thinning'])
+    state.draws = header['draws']
+    state.generation = header['Ngen']
+    state._gen_index = 0
+    state._gen_draws = load('gen_draws')
+    state._gen_acceptance_rate = load('gen_acceptance_rate')
+    state._gen_logp = load('gen_logp')
+    state._thin_count = len(thin_draws)
+    state._thin_index = 0
+    state._thin_draws = thin_draws
+    state._thin_point = thin_point
+    state._thin_logp = thin_logp
+    state._update_count = header['Nupdate']
+    state._update_index = 0
+    state._update_draws = load('update_draws')
+    state._update_R_stat = update_R_stat
+    state._update_CR_weight = load('update_CR_weight')
+    state._outliers = [tuple(v) for v in header['outliers']]
+    state._best_logp = header['best_logp']
+    state._best_x = numpy.asarray(best_x, 'd') if best_x is not None else None
+    state._labels = labels
+    state.title = header['title']
+    return state
+
+def _replace(src, dst):
+    """
+    Move *src* to *dst*, replacing *dst* if it exists.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+class StateWriter(object):
+    """
+    Append-only writer for the MCMC state during sampling.
+
+    The writer is attached to the state with :meth:`MCMCDraw.stream_to`.
+    Each generation, thinned generation and update is buffered, and the
+    buffers are appended to the stream files starting with *filename*
+    every *chunk* generations.  A sampler which is interrupted can be
+    reloaded using :func:`load_state` with the state as of the last flush.
+
+    Any data already in the state (for example, when resuming) is written
+    first.  The rows go to temporary files which replace the existing
+    files at the first flush, so a sampler that is interrupted before
+    then leaves the previous stream or saved state intact.
+
+    When sampling is complete, :meth:`finish` records changes made to the
+    state afterwards, such as by :meth:`MCMCDraw.keep_best`, so that the
+    stream can be used as the saved state.
+    """
+    def __init__(self, state, filename, chunk=100):
+        self.filename = filename
+        self.chunk = chunk
+        self.Npop, self.Nvar, self.Ncr = state.Npop, state.Nvar, state.Ncr
+        self.thinning = state.thinning
+        self.counts = dict((k, 0) for k in STREAM_TABLES)
+        self._buffer = dict((k, []) for k in STREAM_TABLES)
+        self._staged = True
+
+        for table in STREAM_TABLES:
+            open(self._path(table)+'.tmp', 'wb').close()
+        draws, logp = state.logp(full=True)
+        _, AR = state.acceptance_rate()
+        for row in zip(draws, AR, logp):
+            self.generation(*row)
+        draws, point, logp = state.chains()
+        for row in zip(draws, point, logp):
+            self.thinned(*row)
+        draws, R_stat = state.R_stat()
+        _, CR_weight = state.CR_weight()
+        for row in zip(draws, R_stat, CR_weight):
+            self.update(*row)
+        self._write_rows()
+
+    def _path(self, table):
+        return "%s-stream-%s.dat"%(self.filename, table)
+
+    def generation(self, draws, AR, logp):
+        self._buffer['gen'].append(hstack((draws, AR, logp)))
+    def thinned(self, draws, x, logp):
+        self._buffer['thin'].append(hstack((draws, logp, x.flatten())))
+    def update(self, draws, R_stat, CR_weight):
+        self._buffer['update'].append(hstack((draws, R_stat, CR_weight)))
+    def pending(self):
+        return len(self._buffer['gen']) >= self.chunk
+
+    def flush(self, state):
+        """
+        Append the buffered rows to the stream and record the new counts.
+        """
+        self._write_rows()
+        if self._staged:
+            # Retire the old header before its tables are replaced, since
+            # its counts would not match the new tables.
+            if os.path.exists(self.filename+STREAM_EXT):
+                os.remove(self.filename+STREAM_EXT)
+            for table in STREAM_TABLES:
+                _replace(self._path(table)+'.tmp', self._path(table))
+            self._staged = False
+        self._write_header(state)
+        if os.path.exists(self.filename+HEADER_EXT):
+            # A stale binary state under the same name would otherwise
+            # hide the stream from load_state.
+            os.remove(self.filename+HEADER_EXT)
+
+    def finish(self, state):
+        """
+        Update the stream to match the sampled *state*.
+
+        The thinned generations held in memory are the last rows of the
+        stream, so only these are rewritten, followed by the header.
+        """
+        self.flush(state)
+        draws, point, logp = state.chains()
+        Nthin = len(draws)
+        start = self.counts['thin'] - Nthin
+        if start < 0:
+            raise ValueError("state has more generations than the stream")
+        rows = hstack((draws[:,None], logp, point.reshape(Nthin, -1)))
+        with open(self._path('thin'), 'r+b') as fid:
+            fid.seek(start*rows.shape[1]*rows.itemsize)
+            asarray(rows, 'd').tofile(fid)
+        self._write_header(state)
+
+    def _write_rows(self):
+        suffix = '.tmp' if self._staged else ''
+        for table in STREAM_TABLES:
+            rows = self._buffer[table]
+            if rows:
+                with open(self._path(table)+suffix, 'ab') as fid:
+                    asarray(rows, 'd').tofile(fid)
+                self.counts[table] += len(rows)
+                self._buffer[table] = []
+
+    def _write_header(self, state):
+        best_x, best_logp = state.best()
+        header = dict(
+            format=STREAM_FORMAT,
+            version=BINARY_VERSION,
+            Npop=self.Npop, Nvar=self.Nvar, Ncr=self.Ncr,
+            thinning=self.thinning,
+            counts=self.counts,
+            draws=int(state.draws),
+            labels=state._labels,
+            title=state.title,
+            outliers=[[int(v) for v in row] for row in state._outliers],
+            best_logp=float(best_logp),
+            best_x=None if best_x is None else [float(v) for v in best_x],
+            )
+        with open(self.filename+STREAM_EXT+'.tmp', 'w') as fid:
+            json.dump(header, fid)
+        _replace(self.filename+STREAM_EXT+'.tmp', self.filename+STREAM_EXT)
+
+def _load_stream(filename, skip=0):
+    with open(filename+STREAM_EXT, 'r') as fid:
+        header = json.load(fid)
+    if header.get('format') != STREAM_FORMAT:
+        raise ValueError("%s is not a DREAM stream file"%(filename+STREAM_EXT))
+    Npop, Nvar, Ncr = header['Npop'], header['Nvar'], header['Ncr']
+    counts = header['counts']
+    def load(table, width):
+        path = "%s-stream-%s.dat"%(filename, table)
+        data = numpy.fromfile(path, 'd', count=counts[table]*width)
+        return data.reshape(counts[table], width)
+    gen = load('gen', 2+Npop)
+    thin = load('thin', 1+Npop+Npop*Nvar)[skip:]
+    update = load('update', 1+Nvar+Ncr)
+
+    state = MCMCDraw(0,0,0,0,0,0,header['thinning'])
+    state.draws = header['draws']
+    state.generation = len(gen)
+    state._gen_index = 0
+    state._gen_draws = asarray(gen[:,0], 'i')
+    state._gen_acceptance_rate = gen[:,1]
+    state._gen_logp = gen[:,2:]
+    state._thin_count = len(thin)
+    state._thin_index = 0
+    state._thin_draws = asarray(thin[:,0], 'i')
+    state._thin_logp = thin[:,1:1+Npop]
+    state._thin_point = thin[:,1+Npop:].reshape(len(thin), Npop, Nvar)
+    state._update_count = len(update)
+    state._update_index = 0
+    state._update_draws = asarray(update[:,0], 'i')
+    state._update_R_stat = update[:,1:1+Nvar]
+    state._update_CR_weight = update[:,1+Nvar:]
+    state._outliers = [tuple(v) for v in header['outliers']]
+    state._best_logp = header['best_logp']
+    best_x = header['best_x']
+    state._best_x = numpy.asarray(best_x, 'd') if best_x is not None else None
+    state._labels = header['labels']
+    state.title = header['title']
+    return state
+
+def _select(state, portion=None, vars=None):
+    """
+    Restrict a fully loaded state to a portion of the chain and a subset
+    of the variables.
+    """
+    if portion is not None:
+        start = int((1-portion)*state.Nthin)
+        state._thin_draws = state._thin_draws[start:]
+        state._thin_point = state._thin_point[start:]
+        state._thin_logp = state._thin_logp[start:]
+        state._thin_count = state.Nthin
+    if vars is not None:
+        state._thin_point = state._thin_point[:,:,vars]
+        state._update_R_stat = state._update_R_stat[:,vars]
+        if state._best_x is not None:
+            state._best_x = state._best_x[vars]
+        if state._labels is not None:
+            state._labels = [state._labels[v] for v in vars]
+    return state
+
+def _save_text(state, filename):
     trace = NoTrace()
     #trace = open(filename+"-trace.mc","w")
 
@@ -182,7 +551,7 @@ def loadtxt(file, report=0):
         fh.close()
     return asarray(res)
 
-def load_state(filename, skip=0, report=0):
+def _load_text(filename, skip=0, report=0):
     # Read chain file
     chain = loadtxt(filename+'-chain'+EXT)
 
@@ -233,6 +602,28 @@ def load_state(filename, skip=0, report=0):
 
     return state
 
+def _ring(index, count, size):
+    """
+    Return *start*, *n* for a circular buffer of length *size* with write
+    cursor *index* after *count* items have been written.  The i-th oldest
+    item is stored at (start+i)%size for i in 0 ... n-1.
+    """
+    if count == index:
+        return 0, count
+    return index, size
+
+def _chronological(arrays, index, count):
+    """
+    Return the items in the circular buffers *arrays* in generation order.
+
+    If the buffers have not wrapped, the returned values are views into
+    the buffers, otherwise they are copies joined from the two segments.
+    """
+    start, n = _ring(index, count, len(arrays[0]))
+    if start == 0:
+        return [v[:n] for v in arrays]
+    return [numpy.concatenate((v[start:], v[:start])) for v in arrays]
+
 class MCMCDraw(object):
     """
     """
@@ -288,6 +679,25 @@ class MCMCDraw(object):
         # outlier chains from the set.
         self._good_chains = slice(None,None)
 
+        # Optional StateWriter for streaming the state to disk.  The
+        # writer is kept in _stream when streaming stops, so that saving
+        # to the same file can update the stream rather than copy it.
+        self._writer = None
+        self._stream = None
+
+        # Running per-chain moments over the last portion of the thinned
+        # chains, for the R-statistic.  These are built on the first call
+        # to gelman() and updated as thinned generations are added.  Set
+        # to None whenever the thinned arrays are modified directly.
+        self._moments = None
+        self._moments_portion = None
+
+        # The most recent draw() and its arguments.  Statistics computed
+        # on a draw are cached with it, so repeated requests for the same
+        # draw, such as for plotting and for the reported uncertainties,
+        # share the work.  Set to None when the chains are modified.
+        self._draw_cache = None
+
     @property
     def Ngen(self): return self._gen_draws.shape[0]
     @property
@@ -311,6 +721,8 @@ class MCMCDraw(object):
         assert self.generation == self.Ngen and self._update_count == self.Nupdate and self._thin_count == self.Nthin
 
         self.thinning = thinning
+        self._moments = None
+        self._draw_cache = None
 
         if Ngen > self.Ngen:
             self._gen_index = self.Ngen # must happen before resize!!
@@ -342,8 +754,24 @@ class MCMCDraw(object):
             self._update_R_stat = self._update_R_stat[-Nupdate:,:].copy()
             self._update_CR_weight = self._update_CR_weight[-Nupdate:,:].copy()
 
-    def save(self, filename):
-        save_state(self,filename)
+    def save(self, filename, binary=False):
+        save_state(self, filename, binary=binary)
+
+    def stream_to(self, filename, chunk=100):
+        """
+        Write the state to *filename* as it is collected, flushing to disk
+        every *chunk* generations.  See :class:`StateWriter`.
+        """
+        self._writer = StateWriter(self, filename, chunk=chunk)
+        self._stream = None
+
+    def close_stream(self):
+        """
+        Flush any pending generations to the stream and stop streaming.
+        """
+        if self._writer is not None:
+            self._writer.flush(self)
+            self._stream, self._writer = self._writer, None
 
     def show(self, portion=1.0, figfile=None):
         from .views import plot_all
@@ -383,6 +811,9 @@ class MCMCDraw(object):
         self._gen_draws[i] = self.draws
         self._gen_acceptance_rate[i] = 100*sum(accept)/new_draws
         self._gen_logp[i] = logp
+        if self._writer is not None:
+            self._writer.generation(self.draws, self._gen_acceptance_rate[i],
+                                    logp)
         i = i+1
         if i == len(self._gen_draws):
             i = 0
@@ -392,11 +823,15 @@ class MCMCDraw(object):
         self._thin_timer += 1
         if self._thin_timer == self.thinning or force_keep:
             self._thin_timer = 0
+            if self._moments is not None:
+                self._slide_moments(x)
             self._thin_count += 1
             i = self._thin_index
             self._thin_draws[i] = self.draws
             self._thin_point[i] = x
             self._thin_logp[i] = logp
+            if self._writer is not None:
+                self._writer.thinned(self.draws, x, logp)
             i = i+1
             if i == len(self._thin_draws): i = 0
             self._thin_index = i
@@ -404,6 +839,9 @@ class MCMCDraw(object):
         else:
             self._gen_current = x+0 # force a copy
 
+        if self._writer is not None and self._writer.pending():
+            self._writer.flush(self)
+
 
     def _update(self, R_stat, CR_weight):
         """
@@ -416,20 +854,70 @@ class MCMCDraw(object):
         self._update_draws[i] = self.draws
         self._update_R_stat[i] = R_stat
         self._update_CR_weight[i] = CR_weight
+        if self._writer is not None:
+            self._writer.update(self.draws, self._update_R_stat[i],
+                                self._update_CR_weight[i])
         i = i+1
         if i == len(self._update_draws): i = 0
         self._update_index = i
 
+    def _slide_moments(self, x):
+        """
+        Update the running moments for the new thinned generation *x*.
+
+        The window covers the last portion of the retained generations, so
+        depending on whether the buffer is full and how the window length
+        rounds, the window grows by one or the oldest generation in it is
+        dropped.  The dropped generation is removed before *x* is stored
+        since it may be the one that *x* overwrites.
+
+        Each time the buffer wraps around the moments are discarded and
+        rebuilt by the next call to :meth:`gelman`, so round-off from the
+        removals does not accumulate over a long run.
+        """
+        Nthin = len(self._thin_draws)
+        if self._thin_index == 0 and self._thin_count >= Nthin:
+            self._moments = None
+            return
+        old_len = self._moments.n
+        new_len = int(min(self._thin_count+1, Nthin)*self._moments_portion)
+        # Generations of age new_len-1 through old_len-1 before the update
+        # fall out of the window; age 0 is the most recent.
+        for age in range(max(new_len-1, 0), old_len):
+            self._moments.remove(self._thin_point[(self._thin_index-1-age)%Nthin])
+        if new_len > 0:
+            self._moments.add(x)
+
+    def gelman(self, portion=0.5):
+        """
+        Return the Gelman-Rubin R-statistic for the last *portion* of the
+        thinned chains.
+
+        This is the same as :func:`gelman.gelman` applied to the chains,
+        but the per-chain moments are updated as each thinned generation
+        is added, so the cost does not grow with the length of the chain.
+        """
+        if self._moments is None or self._moments_portion != portion:
+            _, points, _ = self.chains()
+            chain_len = int(len(points)*portion)
+            self._moments = RunningMoments(points[len(points)-chain_len:])
+            self._moments_portion = portion
+        return self._moments.R_stat()
+
     def _replace_outlier(self, old, new):
         """
         Called from outliers.py when a chain is replaced by the
         clone of another.
         """
         self._outliers.append((self._thin_index,old,new))
+        self._draw_cache = None
 
         self._gen_logp[:,old] = self._gen_logp[:,new]
         self._thin_logp[:,old] = self._thin_logp[:,new]
         self._thin_point[:,old,:] = self._thin_point[:,new,:]
+        if self._moments is not None:
+            self._moments.mean[old] = self._moments.mean[new]
+            self._moments.M2[old] = self._moments.M2[new]
         # PAK: shouldn't we reduce the total number of draws since we
         # are throwing way an entire chain?
 
@@ -440,50 +928,46 @@ class MCMCDraw(object):
             return self._labels
     def _set_labels(self, v):
         self._labels = v
+        self._draw_cache = None
     labels = property(fget=_get_labels,fset=_set_labels)
 
     def _draw_pop(self, Npop):
         """
         Generate a population from current generation and all history.
         """
-        _, chains, _ = self.chains()
-        Ngen,Nchain,Nvar = chains.shape
-        points = reshape(chains,(Ngen*Nchain,Nvar))
+        Nthin,Nchain,Nvar = self._thin_point.shape
+        _,Ngen = _ring(self._thin_index, self._thin_count, Nthin)
 
         # There are two complications with the history buffer:
         # (1) due to thinning, not every generation is stored
         # (2) because it is circular, the cursor may be in the middle
-        # If the current generation isn't in the buffer (but is instead
-        # stored separately as _gen_current), then the entire buffer
-        # becomes the history pool.
-        # otherwise we need to exclude the current generation from
-        # the pool.  If (2) happens, we need to increment everything
-        # above the cursor by the number of chains.
-        if self._gen_current != None:
+        # Whether or not the buffer has wrapped, the stored generations
+        # are in rows 0 ... Ngen-1, and ancestors are drawn directly from
+        # those rows in buffer order; the order of the history doesn't
+        # matter for the pool.  If the current generation isn't in the
+        # buffer (but is instead stored separately as _gen_current), then
+        # the entire buffer becomes the history pool, otherwise we need to
+        # exclude the current generation, which is the row before the
+        # cursor.  Draws at or above the excluded row are shifted up by
+        # one row to skip it.  The cost is independent of the length of
+        # the history.
+        pop = empty((Npop,Nvar),'d')
+        if self._gen_current is not None:
             pool_size = Ngen*Nchain
             cursor = pool_size  # infinite
-        else:
-            pool_size = (Ngen-1)*Nchain
-            k = len(self._thin_draws)
-            cursor = Nchain*((k+self._thin_index-1)%k)
-
-        # Make a return population and fill it with the current generation
-        pop = empty((Npop,Nvar),'d')
-        if self._gen_current != None:
             pop[:Nchain] = self._gen_current
         else:
-            #print(pop.shape, points.shape, chains.shape)
-            pop[:Nchain] = points[cursor:cursor+Nchain]
+            pool_size = (Ngen-1)*Nchain
+            row = (self._thin_index-1)%Nthin
+            cursor = row*Nchain
+            pop[:Nchain] = self._thin_point[row]
 
         if Npop > Nchain:
             # Find the remainder with unique ancestors.
-            # Again, because this is a circular buffer, their may be random
-            # numbers generated at or above the cursor.  All of these must
-            # be shifted by Nchains to avoid the cursor.
             perm = draw(Npop-Nchain,pool_size)
             perm[perm>=cursor] += Nchain
-            #print("perm",perm; raw_input('wait'))
-            pop[Nchain:] = points[perm]
+            row, chain = divmod(perm, Nchain)
+            pop[Nchain:] = self._thin_point[row, chain]
 
         return pop
 
@@ -491,8 +975,11 @@ class MCMCDraw(object):
         """
         Unroll the circular queue so that data access can be done inplace.
 
-        Call this when done stepping, and before plotting.  Calls to
-        logp, sample, etc. assume the data is already unrolled.
+        This is called when sampling is complete and when the state is
+        saved.  Queries such as logp and chains work on the circular
+        buffers, copying the data if they have wrapped, so there is no need
+        to unroll during sampling.  Methods which modify the chains in
+        place must unroll first.
         """
         if self.generation > self._gen_index > 0:
             self._gen_draws[:] = numpy.roll(self._gen_draws,
@@ -564,6 +1051,7 @@ class MCMCDraw(object):
         in the outlier test.  The default is to include all of them.
         """
         _, chains, logp = self.chains()
+        self._draw_cache = None
 
         if test=='none':
             self._good_chains = slice(None,None)
@@ -596,11 +1084,8 @@ class MCMCDraw(object):
 
         If full is True, then return all chains, not just good chains.
         """
-        self._unroll()
-        retval = self._gen_draws, self._gen_logp
-        if self.generation == self._gen_index:
-            retval = [v[:self.generation] for v in retval]
-        draws,logp = retval
+        draws,logp = _chronological((self._gen_draws, self._gen_logp),
+                                    self._gen_index, self.generation)
         return draws,(logp if full else logp[:,self._good_chains])
 
     def acceptance_rate(self):
@@ -613,11 +1098,8 @@ class MCMCDraw(object):
             plot(draw, AR)
 
         """
-        self._unroll()
-        retval = self._gen_draws, self._gen_acceptance_rate
-        if self.generation == self._gen_index:
-            retval = [v[:self.generation] for v in retval]
-        return retval
+        return _chronological((self._gen_draws, self._gen_acceptance_rate),
+                              self._gen_index, self.generation)
 
     def chains(self):
         """
@@ -636,11 +1118,9 @@ class MCMCDraw(object):
         the log likelihood of observing the set of variable values given in
         chains.
         """
-        self._unroll()
-        retval = self._thin_draws, self._thin_point, self._thin_logp
-        if self._thin_count == self._thin_index:
-            retval = [v[:self._thin_count] for v in retval]
-        return retval
+        return _chronological((self._thin_draws, self._thin_point,
+                               self._thin_logp),
+                              self._thin_index, self._thin_count)
 
     def R_stat(self):
         """
@@ -653,11 +1133,8 @@ class MCMCDraw(object):
 
         See :module:`dream.gelman` and references detailed therein.
         """
-        self._unroll()
-        retval = self._update_draws, self._update_R_stat
-        if self._update_count == self._update_index:
-            retval = [v[:self._update_count] for v in retval]
-        return retval
+        return _chronological((self._update_draws, self._update_R_stat),
+                              self._update_index, self._update_count)
 
 
     def CR_weight(self):
@@ -671,11 +1148,8 @@ class MCMCDraw(object):
 
         See :module:`dream.crossover` for details.
         """
-        self._unroll()
-        retval = self._update_draws, self._update_CR_weight
-        if self._update_count == self._update_index:
-            retval = [v[:self._update_count] for v in retval]
-        return retval
+        return _chronological((self._update_draws, self._update_CR_weight),
+                              self._update_index, self._update_count)
 
     def outliers(self):
         """
@@ -712,7 +1186,9 @@ class MCMCDraw(object):
         and the best.
         """
 
-        # Get state as a 1D array
+        # Get state as a 1D array; unroll first so that the chains are
+        # views which can be updated in place.
+        self._unroll()
         _, chains, logp = self.chains()
         Ngen,Npop,Nvar = chains.shape
         points = reshape(chains,(Ngen*Npop,Nvar))
@@ -741,6 +1217,8 @@ class MCMCDraw(object):
         # spontaneously changes when the fit is complete.
         self._best_p = points[final]
         self._best_logp = logp[final]
+        self._moments = None
+        self._draw_cache = None
 
     def sample(self, **kw):
         """
@@ -772,8 +1250,22 @@ class MCMCDraw(object):
 
             draw = state.sample()
             plot(draw.points[:,0],draw.points[:,1],'.')
+
+        The draw is reused if it is requested again with the same arguments
+        before the chains change, so statistics computed for it with
+        :func:`stats.var_stats` are only computed once.  Treat the returned
+        points as read-only.
         """
-        return Draw(self, portion=portion, vars=vars, selection=selection)
+        key = (portion,
+               None if vars is None else tuple(vars),
+               None if not selection else
+                   dict((k, tuple(r)) for k, r in selection.items()),
+               self.generation, self._thin_count)
+        if self._draw_cache is not None and self._draw_cache[0] == key:
+            return self._draw_cache[1]
+        draw = Draw(self, portion=portion, vars=vars, selection=selection)
+        self._draw_cache = (key, draw)
+        return draw
 
 
     def derive_vars(self, fn, labels=None):
@@ -796,7 +1288,9 @@ class MCMCDraw(object):
 
             state.derive_vars(lambda p: p[0]+p[1], labels=["x+y"])
         """
-        # Grab all samples as a set of points
+        # Grab all samples as a set of points, in the same order as the
+        # stored points so that the new columns line up with them
+        self._unroll()
         _, chains, _ = self.chains()
         Ngen,Npop,Nvar = chains.shape
         points = reshape(chains,(Ngen*Npop,Nvar))
@@ -812,6 +1306,8 @@ class MCMCDraw(object):
 
         # Add new variables to the points
         self._thin_point = dstack( (self._thin_point, newvars) )
+        self._moments = None
+        self._draw_cache = None
 
         # Add labels for the new variables, if available.
         if labels != None:
@@ -923,9 +1419,125 @@ def test():
     #assert norm(logp[:,1] - pin[thinning-1::thinning,2]) == 0
     #assert norm(logp[:,2] - pin[thinning-1::thinning,2]) == 0
 
+    # Check that the running R-statistic follows the chains as the circular
+    # buffer wraps around
+    from .gelman import gelman
+    Ngen, Nthin = 40, 7
+    xin = rand(Ngen,Npop,Nvar)
+    for portion in (0.5, 1.0):
+        rstate = MCMCDraw(Ngen=Ngen, Nthin=Nthin, Nupdate=Nupdate,
+                          Nvar=Nvar, Npop=Npop, Ncr=Ncr, thinning=1)
+        for gen in range(Ngen):
+            rstate._generation(new_draws=Npop, x=xin[gen],
+                               logp=pin[gen%len(pin)], accept=accept[0])
+            # The moments are rebuilt each time the buffer wraps
+            if gen >= Nthin and gen%Nthin == 0:
+                assert rstate._moments is None
+            if gen%3 == 0:
+                points = xin[max(gen+1-Nthin, 0):gen+1]
+                R = rstate.gelman(portion=portion)
+                assert norm(R - gelman(points, portion=portion)) < 1e-10
+
+    # Queries on the wrapped buffer are in generation order, and do not
+    # rotate the buffer in place.
+    assert rstate._thin_index == Ngen%Nthin
+    assert norm(rstate.chains()[1] - xin[-Nthin:]) == 0
+    assert rstate._thin_index == Ngen%Nthin
+    pop = rstate._draw_pop(3*Npop)
+    assert norm(pop[:Npop] - xin[-1]) == 0
+    history = xin[-Nthin:-1].reshape(-1, Nvar)
+    for p in pop[Npop:]:
+        assert (abs(history - p).sum(axis=1) == 0).any()
+    rstate._unroll()
+    assert rstate._thin_index == 0
+    assert norm(rstate.chains()[1] - xin[-Nthin:]) == 0
     from .stats import var_stats, format_vars
     vstats = var_stats(state.draw())
     print (format_vars(vstats))
 
+    # Check that binary save/load preserves the chains
+    import tempfile, shutil, os
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'state')
+        state.save(filename, binary=True)
+        loaded = load_state(filename)
+        assert loaded.thinning == thinning
+        assert norm(loaded.chains()[1] - state.chains()[1]) == 0
+        assert norm(loaded.logp()[1] - state.logp()[1]) == 0
+        assert norm(loaded.R_stat()[1] - state.R_stat()[1]) == 0
+        partial = load_state(filename, portion=0.5, vars=[2,0])
+        start = int(0.5*state.Nthin)
+        assert norm(partial.chains()[1] - state.chains()[1][start:,:,[2,0]]) == 0
+        binary_to_text_state(filename)
+        text = _load_text(filename)
+        assert norm(text.chains()[1] - state.chains()[1]) == 0
+        # A state with no best point can still be restricted to some vars
+        text._best_x = None
+        partial = _select(text, vars=[2,0])
+        assert partial.best()[0] is None
+        assert norm(partial.chains()[1] - state.chains()[1][:,:,[2,0]]) == 0
+    finally:
+        shutil.rmtree(path)
+
+def test_stream():
+    from numpy.linalg import norm
+    from numpy.random import rand
+    import tempfile, shutil, os
+
+    Nvar, Npop, Ncr, Nstep = 2, 4, 2, 5
+    def run(state, Nupdate):
+        for _ in range(Nupdate):
+            state._update(R_stat=rand(Nvar), CR_weight=rand(Ncr))
+            for _ in range(Nstep):
+                state._generation(new_draws=Npop, x=rand(Npop, Nvar),
+                                  logp=rand(Npop), accept=rand(Npop) < 0.5)
+
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'state')
+        state = MCMCDraw(Ngen=40, Nthin=40, Nupdate=8, Nvar=Nvar,
+                         Npop=Npop, Ncr=Ncr, thinning=1)
+        state.stream_to(filename, chunk=3)
+        run(state, 2)
+        # Generations since the last flush are not yet in the stream
+        partial = load_state(filename)
+        assert partial.generation == 9
+        state.close_stream()
+        loaded = load_state(filename)
+        assert norm(loaded.chains()[1] - state.chains()[1]) == 0
+        assert norm(loaded.logp()[1] - state.logp()[1]) == 0
+        assert norm(loaded.R_stat()[1] - state.R_stat()[1]) == 0
+        assert norm(loaded.best()[0] - state.best()[0]) == 0
+
+        # Saving to the stream updates it in place rather than writing
+        # a second copy of the chains.
+        state.keep_best()
+        state.save(filename, binary=True)
+        assert not os.path.exists(filename+HEADER_EXT)
+        assert not os.path.exists(filename+'-thin_point.npy')
+        loaded = load_state(filename)
+        assert norm(loaded.chains()[1] - state.chains()[1]) == 0
+        assert norm(loaded.chains()[2] - state.chains()[2]) == 0
+
+        # Resuming keeps the old stream and saved state until the first
+        # flush, then continues the stream from the resumed state.
+        _save_binary(state, filename)
+        resumed = load_state(filename)
+        resumed.stream_to(filename, chunk=3)
+        assert os.path.exists(filename+HEADER_EXT)
+        assert norm(load_state(filename).chains()[1]
+                    - state.chains()[1]) == 0
+        run(resumed, 1)
+        resumed.close_stream()
+        assert not os.path.exists(filename+HEADER_EXT)
+        reloaded = load_state(filename)
+        assert reloaded.generation == 15
+        assert norm(reloaded.chains()[1][:10] - state.chains()[1]) == 0
+        assert norm(reloaded.chains()[1][10:]
+                    - resumed.chains()[1][-5:]) == 0
+    finally:
+        shutil.rmtree(path)
+
 if __name__ == "__main__":
     test()
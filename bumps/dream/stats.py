@@ -9,27 +9,52 @@ class VarStats(object):
         self.__dict__ = kw
 
 def var_stats(draw, vars=None):
-    if vars is None: vars = range(draw.points.shape[1])
-    return [_var_stats_one(draw, v) for v in vars]
+    """
+    Return the statistics for the variables *vars* in *draw*, or for all
+    variables if *vars* is None.
 
-ONE_SIGMA = 1 - 2*0.15865525393145705
-def _var_stats_one(draw, var):
-    weights, values = draw.weights, draw.points[:, var].flatten()
+    The statistics for all variables are computed together the first time
+    and cached on the draw, so later calls for plotting and reporting are
+    free.
+    """
+    cached = draw._stats
+    if cached is None or cached[0] is not draw.weights:
+        cached = draw._stats = (draw.weights, _var_stats_all(draw))
+    all_vstats = cached[1]
+    if vars is None: return list(all_vstats)
+    return [all_vstats[v] for v in vars]
 
-    best_idx = numpy.argmax(draw.logp)
-    best = values[best_idx]
+ONE_SIGMA = 1 - 2*0.15865525393145705
 
-    # Choose the interval for the histogram
-    p95,p68,p0 = credible_intervals(x=values, weights=weights, ci=[0.95,ONE_SIGMA,0.0])
-    #open('/tmp/out','a').write("in vstats: p68=%s, p95=%s, p0=%s, value range=%s\n"%(p68,p95,p0,(min(values),max(values))))
-    #if p0[0] != p0[1]: raise RuntimeError("wrong median %s"%(str(p0),))
+# Statistics are computed for a block of variables at a time so that the
+# temporary arrays for selecting the quantiles stay small even for very
+# large samples.  This is the number of values in each block.
+BLOCK_SIZE = 1<<22
 
-    mean, std = stats(x=values, weights=weights)
+def _var_stats_all(draw):
+    points, weights = draw.points, draw.weights
+    Nsamples, Nvar = points.shape
 
-    vstats = VarStats(label=draw.labels[var], index=var+1, p95=p95, p68=p68,
-                      median=p0[0], mean=mean, std=std, best=best)
+    best_idx = numpy.argmax(draw.logp)
+    best = points[best_idx]
 
-    return vstats
+    # Choose the interval for the histogram
+    ci = [0.95, ONE_SIGMA, 0.0]
+    intervals = numpy.empty((len(ci), 2, Nvar))
+    mean, std = numpy.empty(Nvar), numpy.empty(Nvar)
+    step = max(1, BLOCK_SIZE//max(Nsamples, 1))
+    for start in range(0, Nvar, step):
+        block = points[:, start:start+step]
+        intervals[:, :, start:start+step] = credible_intervals(
+            x=block, weights=weights, ci=ci)
+        mean[start:start+step], std[start:start+step] = stats(
+            x=block, weights=weights)
+
+    return [VarStats(label=draw.labels[k], index=k+1,
+                     p95=intervals[0,:,k], p68=intervals[1,:,k],
+                     median=intervals[2,0,k], mean=mean[k], std=std[k],
+                     best=best[k])
+            for k in range(Nvar)]
 
 def format_num(x, place):
     precision = 10**place
@@ -99,17 +124,20 @@ def stats(x, weights=None):
     """
     Find mean and standard deviation of a set of weighted samples.
 
+    If *x* is a 2D array of samples X variables, then return vectors of
+    the mean and standard deviation of each variable.
+
     Note that the median is not strictly correct (we choose an endpoint
     of the sample for the case where the median falls between two values
     in the sample), but this is good enough when the sample size is large.
     """
-    if weights == None:
-        x = numpy.sort(x)
-        mean, std = numpy.mean(x), numpy.std(x,ddof=1)
+    if weights is None:
+        mean, std = numpy.mean(x, axis=0), numpy.std(x, axis=0, ddof=1)
     else:
-        mean = numpy.mean(x*weights)/numpy.sum(weights)
+        w = weights if x.ndim == 1 else weights[:,None]
+        mean = numpy.mean(x*w, axis=0)/numpy.sum(weights)
         # TODO: this is biased by selection of mean; need an unbiased formula
-        var = numpy.sum((weights*(x-mean))**2)/numpy.sum(weights)
+        var = numpy.sum((w*(x-mean))**2, axis=0)/numpy.sum(weights)
         std = numpy.sqrt(var)
 
     return mean, std
@@ -122,9 +150,13 @@ def credible_intervals(x, ci, weights=None):
     Returns a 2D array of credible intervals, the minimum and maximum values of the interval.
     If *ci* is a vector, return a vector of intervals.
 
-    *x* are samples from the posterior distribution.
+    *x* are samples from the posterior distribution.  If *x* is a 2D array
+    of samples X variables, then the intervals for all variables are
+    found at once, and the returned array has an extra trailing dimension
+    for the variable.
 
-    This function is faster if the inputs are already sorted.
+    Unweighted intervals use partial sorting to select just the samples
+    at the ends of the intervals, which is O(n) rather than O(n log n).
 
     *ci* is a set of intervals in [0,1].  For a $1-\sigma$ interval use
     *ci=erf(1/sqrt(2))*, or 0.68. About 1e5 samples are needed for 2 digits
@@ -135,13 +167,17 @@ def credible_intervals(x, ci, weights=None):
     One could weight points according to temperature in a parallel tempering
     dataset.
     """
-    from numpy import asarray, vstack, sort, cumsum, searchsorted, round, clip
+    from numpy import asarray, vstack, cumsum, searchsorted, round, clip
     ci = asarray(ci, 'd')
     target = (1 + vstack((-ci, +ci))).T/2
 
     if weights is None:
-        idx = clip(round(target*(x.size-1)), 0, x.size-1).astype('i')
-        return sort(x)[idx]
+        n = x.shape[0]
+        idx = clip(round(target*(n-1)), 0, n-1).astype('i')
+        return numpy.partition(x, numpy.unique(idx), axis=0)[idx]
+    elif x.ndim > 1:
+        return numpy.stack([credible_intervals(x[:,k], ci, weights)
+                            for k in range(x.shape[1])], axis=-1)
     else:
         idx = numpy.argsort(x)
         x, weights = x[idx], weights[idx]
@@ -149,3 +185,38 @@ def credible_intervals(x, ci, weights=None):
         w = cumsum(weights/sum(weights))
         return x[searchsorted(w, target)]
 
+
+def test():
+    from numpy.random import rand
+    from .state import Draw
+
+    # Intervals for all variables at once match those for each variable.
+    x = rand(1001, 3)
+    ci = [0.95, ONE_SIGMA, 0.0]
+    p = credible_intervals(x, ci)
+    for k in range(3):
+        assert (p[:,:,k] == credible_intervals(x[:,k], ci)).all()
+        xs = numpy.sort(x[:,k])
+        assert p[2,0,k] == xs[500]
+        assert (p[0,:,k] == xs[[25, 975]]).all()
+    w = rand(1001)
+    p = credible_intervals(x, ci, weights=w)
+    for k in range(3):
+        assert (p[:,:,k] == credible_intervals(x[:,k], ci, weights=w)).all()
+
+    # Statistics are computed in blocks and cached on the draw.
+    global BLOCK_SIZE
+    draw = Draw.__new__(Draw)
+    draw.points, draw.logp, draw.weights = x, rand(1001), None
+    draw.labels, draw._stats = ["a", "b", "c"], None
+    saved, BLOCK_SIZE = BLOCK_SIZE, 2000
+    try:
+        vstats = var_stats(draw)
+    finally:
+        BLOCK_SIZE = saved
+    assert var_stats(draw, vars=[1])[0] is vstats[1]
+    for k, v in enumerate(vstats):
+        assert v.median == numpy.sort(x[:,k])[500]
+        assert abs(v.mean - numpy.mean(x[:,k])) < 1e-12
+        assert abs(v.std - numpy.std(x[:,k], ddof=1)) < 1e-12
+        assert v.best == x[numpy.argmax(draw.logp), k]
@@ -5,19 +5,31 @@ def draw(k,n):
     """
     Select k things from a pool of n without replacement.
     """
-    # At k == n/4, an extra 0.15*k draws are needed to get k unique draws
+    # At k == n/4, an extra 0.15*k draws are needed to get k unique draws.
+    # For small k relative to n, draw with replacement and redraw any
+    # repeats until all are unique.  This costs O(k log k) regardless of
+    # the size of the pool.  Since the procedure treats all members of
+    # the pool alike, every subset of size k is equally likely.
     if k > n/4:
         result = RNG.permutation(n)[:k]
     else:
-        s = set()
-        result = numpy.empty(k,'i')
-        for i in range(k):
-            p = RNG.randint(n)
-            while p in s: p = RNG.randint(n)
-            s.add(p)
-            result[i] = p
+        result = RNG.randint(n, size=k)
+        while True:
+            _, first = numpy.unique(result, return_index=True)
+            if len(first) == k:
+                break
+            repeat = numpy.ones(k, 'bool')
+            repeat[first] = False
+            result[repeat] = RNG.randint(n, size=k-len(first))
     return result
 
+def test():
+    for k,n in ((5,100000),(50,400),(10,10)):
+        for _ in range(20):
+            t = draw(k,n)
+            assert len(t) == k and len(set(t)) == k
+            assert t.min() >= 0 and t.max() < n
+
 def _check_uniform_draw():
     """
     Draws from history should
@@ -251,6 +251,66 @@ class kde_2d(kde.gaussian_kde):
         return dxy.reshape(X.shape)
     __call__ = evalxy
 
+# Number of samples above which kernel density estimates are computed by
+# binned_kde_1d rather than by scipy's gaussian_kde.
+KDE_THRESHOLD = 10000
+
+class binned_kde_1d(object):
+    """
+    Gaussian kernel density estimate using linear binning and FFT convolution.
+
+    This uses the same bandwidth as :class:`kde_1d`, but rather than
+    summing the kernel for every sample at every point, the samples are
+    binned onto a grid of *gridsize* points and the bins are convolved
+    with the kernel.  The cost is O(N + M log M) for N samples and M grid
+    points rather than O(N*M).  The estimate is interpolated from the grid
+    when evaluated.
+    """
+    def __init__(self, dataset, gridsize=1024):
+        x = numpy.asarray(dataset, 'd').flatten()
+        n = len(x)
+        # 2 * silverman factor * sample standard deviation, as in kde_1d
+        h = 2 * (n*3/4.)**(-1/5.) * numpy.std(x, ddof=1)
+        if not h > 0:
+            raise ValueError("kernel density estimate needs distinct values")
+        self.bandwidth = h
+
+        # Grid covering the data with four bandwidths on either side.
+        lo, hi = numpy.min(x) - 4*h, numpy.max(x) + 4*h
+        self.grid = linspace(lo, hi, gridsize)
+        dx = self.grid[1] - self.grid[0]
+
+        # Linear binning: split each sample between its neighbouring grid
+        # points in proportion to its distance from each.
+        pos = (x - lo)/dx
+        k = numpy.clip(numpy.floor(pos).astype('i'), 0, gridsize-2)
+        frac = pos - k
+        counts = (numpy.bincount(k, weights=1-frac, minlength=gridsize)
+                  + numpy.bincount(k+1, weights=frac, minlength=gridsize))
+
+        # Kernel sampled on the grid out to four bandwidths, convolved with
+        # the bins using zero padded FFTs so that the result does not wrap.
+        L = min(int(numpy.ceil(4*h/dx)), gridsize-1)
+        t = arange(-L, L+1)*dx/h
+        kernel = numpy.exp(-0.5*t**2)/(math.sqrt(2*math.pi)*h*n)
+        size = 2**int(math.ceil(math.log(gridsize + 2*L + 1, 2)))
+        full = numpy.fft.irfft(numpy.fft.rfft(counts, size)
+                               * numpy.fft.rfft(kernel, size), size)
+        self.density = numpy.maximum(full[L:L+gridsize], 0)
+
+    def evaluate(self, points):
+        return numpy.interp(points, self.grid, self.density, left=0, right=0)
+    __call__ = evaluate
+
+def density_1d(values):
+    """
+    Return a kernel density estimate for *values*, using :class:`kde_1d`
+    for small samples and :class:`binned_kde_1d` for large ones.
+    """
+    if len(values) > KDE_THRESHOLD:
+        return binned_kde_1d(values)
+    return kde_1d(values)
+
 def plot_corr(draw, vars=(0,1)):
     from pylab import axes, setp, MaxNLocator
 
@@ -260,11 +320,11 @@ def plot_corr(draw, vars=(0,1)):
 
     # Form kernel density estimates of the parameters
     xmin,xmax = min(values[0]),max(values[0])
-    density_x = kde_1d(values[0])
+    density_x = density_1d(values[0])
     x = linspace(xmin, xmax, 100)
     px = density_x(x)
 
-    density_y = kde_1d(values[1])
+    density_y = density_1d(values[1])
     ymin,ymax = min(values[1]),max(values[1])
     y = linspace(ymin, ymax, 100)
     py = density_y(y)
@@ -321,3 +381,14 @@ def plot_logp(state, portion=None):
     title(r'Log Likelihood History')
     xlabel('Generation number')
     ylabel('Log likelihood at x[k]')
+
+def test():
+    from numpy.random import RandomState
+    rng = RandomState(1)
+    values = numpy.hstack((rng.normal(0, 1, 20000), rng.normal(5, 0.5, 5000)))
+    x = linspace(-4, 7, 200)
+    exact = kde_1d(values)(x)
+    approx = binned_kde_1d(values)(x)
+    assert numpy.max(abs(approx - exact)) < 1e-3*numpy.max(exact)
+    assert isinstance(density_1d(values), binned_kde_1d)
+    assert isinstance(density_1d(values[:100]), kde_1d)
@@ -9,6 +9,7 @@ from __future__ import division, with_statement
 
 import sys
 import time
+from collections import OrderedDict
 
 from numpy import inf, isnan
 import numpy
@@ -148,29 +149,23 @@ class Result:
         up an array in Result.samples which contains the best fit to the
         resynthesized data.  *samples* is the number of samples to generate.
         *fitter* is the (local) optimizer to use. The kw are the parameters
-        for the optimizer.
+        for the optimizer.  Use *cpus* > 1 to run the refits in parallel.
         """
+        from .fitters import replicate_fits
+        cpus = kw.pop('cpus', 1)
         opt = fitter(self.problem)
-        points = []
-        try: # TODO: some solvers already catch KeyboardInterrupt
-            for i in range(samples):
-                print("== resynth %d of %d" % (i, samples))
-                self.problem.resynth_data()
-                if restart:
-                    self.problem.randomize()
-                else:
-                    self.problem.setp(self.solution)
-                x = opt.solve(**kw)
-                nllf = self.problem.nllf(x) # TODO: don't recalculate!
-                points.append(numpy.hstack((nllf,x)))
-                print(self.problem.summarize())
-                print("[chisq=%g]" % (nllf*2/self.problem.dof))
-        except KeyboardInterrupt:
-            pass
-        self.points = numpy.vstack([self.points] + points)
+        if restart:
+            starts = self.problem.randomize(samples)
+        else:
+            starts = numpy.tile(self.solution, (samples, 1))
+        def report(k, x, nllf):
+            print("== resynth %d of %d [chisq=%g]"
+                  % (k, samples, nllf*2/self.problem.dof))
+        points = replicate_fits(opt, starts, resynth=True, cpus=cpus,
+                                callback=report, **kw)
+        self.points = numpy.vstack((self.points, points))
 
         # Restore the original solution
-        self.problem.restore_data()
         self.problem.setp(self.solution)
 
     def show_stats(self):
@@ -247,6 +242,15 @@ class Fitness(object):
         be cleared and the model reevaluated.
         """
         raise NotImplementedError
+    def update_fast(self):
+        """
+        Called when only *fast* parameters have been updated.  Any cached
+        values which depend only on the slow parameters may be reused.
+        See :attr:`parameter.Parameter.fast`.
+
+        The default is to call :meth:`update`.
+        """
+        self.update()
     def numpoints(self):
         """
         Return the number of data points.
@@ -273,6 +277,31 @@ class Fitness(object):
         Return residuals for current theory minus data.  For levenburg-marquardt.
         """
         raise NotImplementedError
+    def residuals_deriv(self, parameters):
+        r"""
+        Return the derivative of the residuals with respect to *parameters*
+        as an Nresiduals x Nparameters array, with one column per parameter.
+        Parameters which the model does not depend on have a column of zeros.
+
+        This is optional.  Models without analytic derivatives should raise
+        NotImplementedError, and the fitters will use numerical derivatives.
+        Models whose nllf is not $\chi^2/2$ may also provide
+        *nllf_deriv(parameters)* returning the gradient of nllf.
+        """
+        raise NotImplementedError
+    def nllf_batch(self, parameters, points):
+        """
+        Return the negative log likelihood for each point in a population.
+
+        *parameters* is the list of fitted parameters, which gives the
+        column order of *points*, an Npop x Nvar array.  Model parameters
+        which are not in *parameters* keep their current values.
+
+        This is optional.  Models which cannot evaluate a population in
+        one call should raise NotImplementedError, and the fit problem will
+        evaluate the points one at a time with setp/update/nllf.
+        """
+        raise NotImplementedError
     def save(self, basename):
         """
         Save the model to a file based on basename+extension.  This will point to
@@ -291,10 +320,66 @@ class Fitness(object):
         pass
 
 
-def no_constraints(): 
+def no_constraints():
     """default constraints function for FitProblem"""
     return 0
 
+class ParameterCache(object):
+    """
+    Least recently used cache of values computed for a parameter vector.
+
+    Values are keyed by name and by the exact bytes of the parameter
+    vector, so only identical points will match.  *size* is the maximum
+    number of entries to keep, with zero disabling the cache.  The number
+    of cache *hits* and *misses* are recorded.
+
+    The cache does not know when the model changes.  It is cleared by the
+    fit problem on model_reset and when the data changes, but must be
+    cleared by the caller if fixed parameters are changed directly.
+    """
+    def __init__(self, size=0):
+        self.size = size
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+
+    def key(self, name, pvec):
+        return name, numpy.ascontiguousarray(pvec, 'd').tobytes()
+
+    def get(self, key):
+        """
+        Return the value stored for *key*, or None if it is not cached.
+        """
+        if self.size <= 0:
+            return None
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    # Don't send the cached values to remote workers
+    def __getstate__(self):
+        return self.size
+    def __setstate__(self, state):
+        self.__init__(state)
+
 # TODO: refactor FitProblem definition
 # deprecate the direct use of MultiFitProblem
 def FitProblem(*args, **kw):
@@ -356,6 +441,7 @@ class BaseFitProblem(object):
     """
     See :func:`FitProblem`
     """
+    cache_size = 0
     def __init__(self, fitness, name=None, constraints=no_constraints, 
                  penalty_nllf=1e6, soft_limit=numpy.inf, partial=False):
         self.constraints = constraints
@@ -373,6 +459,15 @@ class BaseFitProblem(object):
         self.penalty_nllf = penalty_nllf
         self.model_reset()
 
+    def set_cache(self, size):
+        """
+        Cache *size* nllf and residuals values for recent parameter vectors.
+
+        Use size=0 to turn caching off.  See :class:`ParameterCache`.
+        """
+        self.cache_size = size
+        self.cache = ParameterCache(size)
+
     def model_reset(self):
         """
         Prepare for the fit.
@@ -392,6 +487,14 @@ class BaseFitProblem(object):
         #print "varying",self._parameters
         self.bounded = [p for p in all_parameters
                         if not isinstance(p.bounds, mbounds.Unbounded)]
+        self._batch_prepare()
+        self._expressions = parameter.compile_expressions(self.model_parameters())
+        self._fast = numpy.array([p.fast for p in self._parameters], bool)
+        self._last_setp = None
+        self._setp_changed = None
+        if not hasattr(self, 'cache'):
+            self.cache = ParameterCache(self.cache_size)
+        self.cache.clear()
         self.dof = self.model_points()
         if not self.partial: self.dof -= len(self._parameters)
         if self.dof <= 0:
@@ -410,8 +513,18 @@ class BaseFitProblem(object):
     def model_update(self):
         """
         Update the model according to the changed parameters.
+
+        If :meth:`setp` only changed fast parameters, the fitness function
+        is told to update the fast parameters only.
         """
-        if hasattr(self.fitness, 'update'):
+        changed = self._setp_changed
+        fast_only = (changed is not None
+                     and not numpy.any(changed & ~self._fast))
+        self._fitness_update(fast_only)
+    def _fitness_update(self, fast_only=False):
+        if fast_only and hasattr(self.fitness, 'update_fast'):
+            self.fitness.update_fast()
+        elif hasattr(self.fitness, 'update'):
             self.fitness.update()
     def model_nllf(self):
         """
@@ -421,15 +534,25 @@ class BaseFitProblem(object):
 
     def simulate_data(self, noise=None):
         """Simulate data with added noise"""
+        self.cache.clear()
         self.fitness.simulate_data(noise=noise)
     def resynth_data(self):
         """Resynthesize data with noise from the uncertainty estimates."""
+        self.cache.clear()
         self.fitness.resynth_data()
     def restore_data(self):
         """Restore original data after resynthesis."""
+        self.cache.clear()
         self.fitness.restore_data()
     def valid(self, pvec):
-        return all(v in p.bounds for p,v in zip(self._parameters,pvec))
+        return bool(self._bounds_vector.contains(pvec))
+
+    def valid_batch(self, points):
+        """
+        Return a boolean vector showing which points in the Npop x Nvar
+        population are within the parameter bounds.
+        """
+        return self._bounds_vector.contains(points)
 
     def setp(self, pvec):
         """
@@ -441,21 +564,42 @@ class BaseFitProblem(object):
         otherwise returns False.
         """
         #TODO: do we have to leave the model in an invalid state?
-        # WARNING: don't try to conditionally update the model
-        # depending on whether any model parameters have changed.
-        # For one thing, the model_update below probably calls
-        # the subclass MultiFitProblem.model_update, which signals
-        # the individual models.  Furthermore, some parameters may
-        # related to others via expressions, and so a dependency
-        # tree needs to be generated.  Whether this is better than
-        # clicker() from SrFit I do not know.
+        # Record which parameters changed so that model_update can skip
+        # models which do not depend on them (see MultiFitProblem).  A
+        # parameter has changed if it differs from the value in the model
+        # or from the value given in the previous setp.  Calling
+        # model_update directly always updates everything.
+        self._setp_changed = self._changed_parameters(pvec)
         for v, p in zip(pvec, self._parameters):
             p.value = v
         # TODO: setp_hook is a hack to support parameter expressions in sasview
         # Don't depend on this existing long term.
-        setp_hook = getattr(self, 'setp_hook', no_constraints)
-        setp_hook()
+        setp_hook = getattr(self, 'setp_hook', None)
+        if setp_hook is not None:
+            # The hook may change anything, so update all models.
+            self._setp_changed = None
+            setp_hook()
+        self._expressions.update()
         self.model_update()
+        self._setp_changed = None
+
+    def _changed_parameters(self, pvec):
+        """
+        Return a boolean vector marking which fitted parameters are
+        changed by setting *pvec*.
+        """
+        pvec = numpy.array(pvec, 'd')
+        last, self._last_setp = self._last_setp, pvec
+        if last is None or last.shape != pvec.shape:
+            return numpy.ones(len(pvec), bool)
+        return (pvec != last) | (pvec != self.getp())
+
+    def fast_mask(self):
+        """
+        Returns a boolean vector marking the fast fitted parameters.
+        """
+        return self._fast.copy()
+
     def getp(self):
         """
         Returns the current value of the parameter vector.
@@ -463,7 +607,7 @@ class BaseFitProblem(object):
         return numpy.array([p.value for p in self._parameters], 'd')
 
     def bounds(self):
-        return numpy.array([p.bounds.limits for p in self._parameters],'d').T
+        return self._bounds_vector.limits
 
     def randomize(self, N=None):
         """
@@ -473,16 +617,17 @@ class BaseFitProblem(object):
         """
         # TODO: split into two: randomize and random_pop
         if N is not None:
-            return numpy.array([p.bounds.random(N) for p in self._parameters]).T
+            return self._bounds_vector.random(N)
         else:
             # Need to go through setp when updating model.
-            self.setp([p.bounds.random(1)[0] for p in self._parameters])
+            self.setp(self._bounds_vector.random(1)[0])
 
     def parameter_nllf(self):
         """
         Returns negative log likelihood of seeing parameters p.
         """
-        s = sum(p.nllf() for p in self.bounded)
+        s = self._bounds_vector.nllf(self.getp())
+        s += sum(p.nllf() for p in self._batch_fixed)
         #print "; ".join("%s %g %g"%(p,p.value,p.nllf()) for p in self.bounded)
         return s
 
@@ -492,6 +637,35 @@ class BaseFitProblem(object):
         """
         return self.constraints()
 
+    def _batch_prepare(self):
+        """
+        Sort the bounded parameters for vectorized prior evaluation.
+
+        Bounds on the fitted parameters are collected into a
+        :class:`bounds.BoundsVector` for evaluating the whole parameter
+        vector at once.  Fixed parameters contribute a constant.
+        Bounded parameter expressions depend on the fitted values in ways
+        we cannot vectorize, so their presence forces the point by point
+        evaluation in :meth:`nllf_batch`.
+        """
+        self._bounds_vector = mbounds.BoundsVector(
+            [p.bounds for p in self._parameters])
+        index = set(id(p) for p in self._parameters)
+        fixed = [p for p in self.bounded if id(p) not in index]
+        self._batch_fixed = fixed
+        self._batch_serial = any(p.parameters() != [p] for p in fixed)
+
+    def parameter_nllf_batch(self, points):
+        """
+        Returns negative log likelihood of seeing parameters for each
+        point in the Npop x Nvar population.
+
+        Points should already be within the bounds (see :meth:`valid_batch`).
+        """
+        pparameter = self._bounds_vector.nllf(points)
+        pparameter += sum(p.nllf() for p in self._batch_fixed)
+        return pparameter
+
     def parameter_residuals(self):
         """
         Returns negative log likelihood of seeing parameters p.
@@ -502,8 +676,87 @@ class BaseFitProblem(object):
         """
         Return the model residuals.
         """
+        key = self.cache.key('residuals', self.getp()) if self.cache.size else None
+        resid = self.cache.get(key) if key else None
+        if resid is None:
+            resid = self._model_residuals()
+            if key: self.cache.put(key, resid)
+        return resid.copy() if key else resid
+
+    def _model_residuals(self):
         return self.fitness.residuals()
 
+    def residuals_deriv(self):
+        """
+        Return the derivative of the model residuals with respect to the
+        fitted parameters at the current point as an Nresiduals x Nvar array.
+
+        Raises NotImplementedError if the model does not provide analytic
+        derivatives.  See :meth:`Fitness.residuals_deriv`.
+        """
+        return self._model_residuals_deriv()
+
+    def _model_residuals_deriv(self):
+        return _residuals_deriv(self.fitness, self._parameters)
+
+    def parameter_residuals_deriv(self):
+        """
+        Return the derivative of :meth:`parameter_residuals` with respect to
+        the fitted parameters as an Nbounded x Nvar array.
+
+        The parameter residuals are cheap, so this is computed numerically.
+        Bounded parameter expressions are treated as constant.
+        """
+        index = dict((id(p), k) for k, p in enumerate(self._parameters))
+        D = numpy.zeros((len(self.bounded), len(self._parameters)), 'd')
+        for i, p in enumerate(self.bounded):
+            k = index.get(id(p), None)
+            if k is not None:
+                v = p.value
+                h = 1e-6*max(abs(v), 1)
+                D[i, k] = (p.bounds.residual(v+h) - p.bounds.residual(v-h))/(2*h)
+        return D
+
+    def nllf_deriv(self):
+        r"""
+        Return the gradient of :meth:`nllf` with respect to the fitted
+        parameters at the current point.
+
+        The model gradient comes from the fitness *nllf_deriv* if it has one,
+        or $J^T r$ from :meth:`residuals_deriv` otherwise, which assumes
+        that the model nllf is $\chi^2/2$.  The gradient of the parameter
+        priors is computed numerically.  Raises NotImplementedError if the
+        model does not provide analytic derivatives or if the problem has
+        constraints, which cannot be differentiated.
+        """
+        if self.constraints is not no_constraints:
+            raise NotImplementedError
+        p = self.getp()
+        h = 1e-6*numpy.maximum(abs(p), 1)
+        points = numpy.vstack((p + numpy.diag(h), p - numpy.diag(h)))
+        n = len(p)
+        with numpy.errstate(invalid='ignore'):
+            prior = self._bounds_vector.nllf(points)
+            gprior = (prior[:n] - prior[n:])/(2*h)
+        gprior[~numpy.isfinite(gprior)] = 0
+        return self._model_nllf_deriv() + gprior
+
+    def _model_nllf_deriv(self):
+        return _nllf_deriv(self.fitness, self._parameters)
+
+    def residuals_batch(self, points):
+        """
+        Return the residuals for each point in the Npop x Nvar population
+        as an Npop x Nresiduals array.
+
+        The model is left set to the last point.
+        """
+        result = []
+        for p in points:
+            self.setp(p)
+            result.append(self.residuals())
+        return numpy.array(result, 'd')
+
     def chisq(self):
         """
         Return sum squared residuals normalized by the degrees of freedom.
@@ -537,6 +790,18 @@ class BaseFitProblem(object):
             else:
                 return inf
 
+        # The model is still set to pvec on a cache hit so that it is
+        # in the same state as it would be after evaluation.
+        if self.cache.size:
+            key = self.cache.key('nllf', self.getp())
+            cost = self.cache.get(key)
+            if cost is None:
+                cost = self._nllf()
+                self.cache.put(key, cost)
+            return cost
+        return self._nllf()
+
+    def _nllf(self):
         try:
             if isnan(self.parameter_nllf()):
                 print("Parameter nllf is wrong")
@@ -563,6 +828,101 @@ class BaseFitProblem(object):
         # print pvec, "cost",cost,"=",pparameter,"+",pconstraint,"+",pmodel
         return cost
 
+    def nllf_batch(self, points):
+        """
+        Compute the cost function for each point in the Npop x Nvar array.
+
+        This is equivalent to *[problem.nllf(p) for p in points]*, returning
+        the costs as a vector, but with the bounds check, the parameter
+        prior and the *soft_limit* penalty evaluated as array expressions.
+        If the fitness function provides *nllf_batch* then the model
+        likelihood is also computed for the whole population at once.
+        Otherwise the model is updated and evaluated one point at a time.
+
+        Points which are out of bounds or which evaluate to NaN are
+        assigned a cost of inf.  Problems with bounded parameter expressions
+        or a *setp_hook* are always evaluated one point at a time.
+        """
+        points = numpy.asarray(points, 'd')
+        cost = numpy.empty(points.shape[0], 'd')
+        cost.fill(inf)
+        # A setp_hook may change the model in ways only setp knows about.
+        if self._batch_serial or getattr(self, 'setp_hook', None) is not None:
+            for k, p in enumerate(points):
+                cost[k] = self.nllf(p)
+            return cost
+
+        index = numpy.nonzero(self.valid_batch(points))[0]
+        if len(index) == 0:
+            return cost
+        points = points[index]
+        pparameter = self.parameter_nllf_batch(points)
+
+        # Constraints functions look at the parameter values directly, so
+        # they can only be evaluated after setp.
+        pmodel = None
+        if self.constraints is no_constraints:
+            pconstraint = numpy.zeros_like(pparameter)
+            active = (pparameter <= self.soft_limit)
+            try:
+                active_nllf = self.model_nllf_batch(points[active])
+            except KeyboardInterrupt:
+                raise
+            except:
+                # Fall through to point by point evaluation, which will
+                # report the error and set the cost for the bad points.
+                active_nllf = None
+            if active_nllf is not None:
+                pmodel = numpy.empty_like(pparameter)
+                pmodel[active] = active_nllf
+                pmodel[~active] = self.penalty_nllf
+
+        if pmodel is None:
+            pconstraint = numpy.empty_like(pparameter)
+            pmodel = numpy.empty_like(pparameter)
+            for k, p in enumerate(points):
+                pconstraint[k], pmodel[k] = self._nllf_point(p, pparameter[k])
+
+        total = pparameter + pconstraint + pmodel
+        total[isnan(total)] = inf
+        cost[index] = total
+        return cost
+
+    def _nllf_point(self, pvec, pparameter):
+        """
+        Set *pvec* into the model and return its constraints and model nllf.
+        """
+        try:
+            self.setp(pvec)
+            pconstraint = self.constraints_nllf()
+            if pparameter + pconstraint <= self.soft_limit:
+                pmodel = self.model_nllf()
+            else:
+                pmodel = self.penalty_nllf
+        except KeyboardInterrupt:
+            raise
+        except:
+            #TODO: make sure errors get back to the user
+            import traceback
+            traceback.print_exc()
+            print(parameter.summarize(self._parameters))
+            return inf, inf
+        return pconstraint, pmodel
+
+    def model_nllf_batch(self, points):
+        """
+        Negative log likelihood of seeing the data given each model in the
+        population, or None if the fitness function cannot evaluate a
+        population directly.
+        """
+        batch = getattr(self.fitness, 'nllf_batch', None)
+        if batch is None:
+            return None
+        try:
+            return numpy.asarray(batch(self._parameters, points), 'd')
+        except NotImplementedError:
+            return None
+
     def __call__(self, pvec=None):
         """
         Problem cost function.
@@ -578,8 +938,12 @@ class BaseFitProblem(object):
         print(parameter.format(self.model_parameters()))
         print("[chisq=%g, nllf=%g]" % (self.chisq(), self.nllf()))
         print(self.summarize())
-    def summarize(self):
-        return parameter.summarize(self._parameters)
+    def summarize(self, p=None):
+        """
+        Return a table of parameter values and ranges.  If *p* is given,
+        show the values in p without setting them into the model.
+        """
+        return parameter.summarize(self._parameters, values=p)
     def labels(self):
         return [p.name for p in self._parameters]
 
@@ -601,7 +965,7 @@ class BaseFitProblem(object):
             pylab.savefig(figfile+"-model.png", format='png')
 
     def stderr(self):
-        from lsqerror import jacobian, cov, corr, stderr
+        from .lsqerror import jacobian, cov, corr, stderr
         C = cov(jacobian(self))
         return stderr(C), corr(C)
 
@@ -660,38 +1024,108 @@ class MultiFitProblem(BaseFitProblem):
     def model_points(self):
         """Return number of points in all models"""
         return sum(f.model_points() for f in self.models)
+    def model_reset(self):
+        BaseFitProblem.model_reset(self)
+        self._dependencies_prepare()
+    def _dependencies_prepare(self):
+        """
+        Build the model x parameter dependency table.
+
+        Model *i* depends on fitted parameter *k* if the parameter appears
+        in the model, either directly or within a parameter expression, or
+        if it is the free variable for model *i*.
+        """
+        index = dict((id(p), k) for k, p in enumerate(self._parameters))
+        free = self.freevars.parameters()
+        deps = numpy.zeros((len(self._models), len(self._parameters)), bool)
+        for i, f in enumerate(self._models):
+            pars = [f.model_parameters(), [v[i] for v in free.values()]]
+            for p in parameter.unique(pars):
+                k = index.get(id(p), None)
+                if k is not None:
+                    deps[i, k] = True
+        self._dependencies = deps
     def model_update(self):
-        """Let all models know they need to be recalculated"""
-        # TODO: consider an "on changed" signal for model updates.
-        # The update function would be associated with model parameters
-        # rather than always recalculating everything.  This
-        # allows us to set up fits with 'fast' and 'slow' parameters,
-        # where the fit can quickly explore a subspace where the
-        # computation is cheap before jumping to a more expensive
-        # subspace.  SrFit does this.
-        for f in self.models:
-            f.model_update()
+        """
+        Let the models know they need to be recalculated.
+
+        When called from :meth:`setp`, only the models which depend on the
+        changed parameters are updated, with models which only depend on
+        changed fast parameters using the fast update.  Otherwise all models
+        are updated.
+        """
+        changed = self._setp_changed
+        if changed is None:
+            dirty = numpy.ones(len(self._models), bool)
+            slow = dirty
+        else:
+            dirty = numpy.any(self._dependencies[:, changed], axis=1)
+            slow = numpy.any(self._dependencies[:, changed & ~self._fast],
+                             axis=1)
+        for i, f in enumerate(self._models):
+            if dirty[i]:
+                self.freevars.set_model(i)
+                f._fitness_update(fast_only=not slow[i])
+        # Restore the active model after cycling
+        self.freevars.set_model(self._active_model_index)
     def model_nllf(self):
         """Return cost function for all data sets"""
         return sum(f.model_nllf() for f in self.models)
+    def model_nllf_batch(self, points):
+        """
+        Return cost function for all data sets for each point in the
+        population, or None if any model cannot evaluate the population.
+        """
+        # Free variables are substituted into the shared reference parameter
+        # one model at a time, so the reference value is not a column of
+        # the population.
+        if self.freevars.parameters():
+            return None
+        total = numpy.zeros(points.shape[0], 'd')
+        for f in self._models:
+            batch = getattr(f.fitness, 'nllf_batch', None)
+            if batch is None:
+                return None
+            try:
+                total += batch(self._parameters, points)
+            except NotImplementedError:
+                return None
+        return total
     def constraints_nllf(self):
         """Return the cost function for all constraints"""
         return sum(f.constraints_nllf() for f in self.models) \
             + BaseFitProblem.constraints_nllf(self)
     def simulate_data(self, noise=None):
         """Simulate data with added noise"""
+        self.cache.clear()
         for f in self.models: f.simulate_data(noise=noise)
     def resynth_data(self):
         """Resynthesize data with noise from the uncertainty estimates."""
+        self.cache.clear()
         for f in self.models: f.resynth_data()
     def restore_data(self):
         """Restore original data after resynthesis."""
+        self.cache.clear()
         for f in self.models: f.restore_data()
-    def residuals(self):
+    def _model_residuals(self):
         resid = numpy.hstack([w * f.residuals()
                               for w, f in zip(self.weights, self.models)])
         return resid
 
+    def _model_residuals_deriv(self):
+        # Free variables share a reference parameter across the models,
+        # so the model derivatives cannot be mapped to the fitted columns.
+        if self.freevars.parameters():
+            raise NotImplementedError
+        J = numpy.vstack([w * _residuals_deriv(f.fitness, self._parameters)
+                          for w, f in zip(self.weights, self.models)])
+        return J
+    def _model_nllf_deriv(self):
+        if self.freevars.parameters():
+            raise NotImplementedError
+        return sum(_nllf_deriv(f.fitness, self._parameters)
+                   for f in self.models)
+
     def save(self, basename):
         for i, f in enumerate(self.models):
             f.save(basename + "-%d" % (i + 1))
@@ -718,6 +1152,27 @@ class MultiFitProblem(BaseFitProblem):
     def __setstate__(self, state):
         self.__dict__ = state
 
+def _residuals_deriv(fitness, parameters):
+    """
+    Return the residuals derivative for *fitness* as Nresiduals x Nvar,
+    raising NotImplementedError if it has no analytic derivatives.
+    """
+    deriv = getattr(fitness, 'residuals_deriv', None)
+    if deriv is None:
+        raise NotImplementedError
+    return numpy.reshape(deriv(parameters), (-1, len(parameters)))
+
+def _nllf_deriv(fitness, parameters):
+    """
+    Return the nllf gradient for *fitness*, using $J^T r$ if it does not
+    define its own gradient.
+    """
+    deriv = getattr(fitness, 'nllf_deriv', None)
+    if deriv is not None:
+        return numpy.asarray(deriv(parameters), 'd')
+    J = _residuals_deriv(fitness, parameters)
+    return numpy.dot(numpy.ravel(fitness.residuals()), J)
+
 def load_problem(file, options=[]):
     """
     Load a problem definition from a python script file.
@@ -741,3 +1196,125 @@ def load_problem(file, options=[]):
         raise ValueError(file+" does not define 'problem=FitProblem(...)'")
 
     return problem
+
+def _quadratic(x, a, b, c): return a*x**2 + b*x + c
+def test_nllf_batch():
+    from .curve import Curve, PoissonCurve
+    x = numpy.linspace(1, 2, 7)
+    y = _quadratic(x, 1, 2, 3)
+    rng = numpy.random.RandomState(2)
+    def check(problem):
+        lo, hi = problem.bounds()
+        lo, hi = numpy.maximum(lo, -10), numpy.minimum(hi, 10)
+        points = lo + (hi-lo)*rng.rand(20, len(lo))
+        points[3, 0] = hi[0] + 1   # out of bounds
+        batch = problem.nllf_batch(points)
+        serial = [problem.nllf(p) for p in points]
+        assert numpy.allclose(batch, serial, rtol=1e-12, atol=0), (batch, serial)
+        assert batch[3] == inf
+    for vectorized in (False, True):
+        for cls, dy in ((Curve, 0.1*y), (PoissonCurve, None)):
+            kw = {} if dy is None else {'dy': dy}
+            M = cls(_quadratic, x, y, vectorized=vectorized,
+                    a=1, b=(0, 4), c=3, **kw)
+            M.a.range(0, 2)
+            M.c.dev(1)
+            check(FitProblem(M))
+
+            # The hook ties c to b, so every point needs setp.
+            problem = FitProblem(M)
+            def hook():
+                M.c.value = M.b.value + 1
+            problem.setp_hook = hook
+            check(problem)
+
+    # Models sharing a parameter
+    M1 = Curve(_quadratic, x, y, 0.1*y, vectorized=True, a=(0, 2), b=2, c=3)
+    M2 = Curve(_quadratic, x, y, 0.1*y, a=1, b=(0, 4), c=(0, 5))
+    M2.a = M1.a
+    check(FitProblem([M1, M2]))
+
+def test_model_update():
+    from .curve import Curve
+    x = numpy.linspace(1, 2, 7)
+    y = _quadratic(x, 1, 2, 3)
+    M1 = Curve(_quadratic, x, y, 0.1*y, a=(0, 2), b=2, c=3)
+    M2 = Curve(_quadratic, x, y, 0.1*y, a=1, b=(0, 4), c=3)
+    M3 = Curve(_quadratic, x, y, 0.1*y, a=1, b=2, c=3)
+    M3.c = M1.a + 2    # depends on M1.a through an expression
+    updates = []
+    for k, M in enumerate((M1, M2, M3)):
+        def counted(M=M, k=k, update=M.update):
+            updates.append(k)
+            update()
+        M.update = counted
+    problem = FitProblem([M1, M2, M3])
+    assert problem.labels() == ['a', 'b']
+    def changed(p):
+        del updates[:]
+        problem.setp(p)
+        return sorted(updates)
+
+    assert changed([1, 2]) == [0, 1, 2]   # first setp updates everything
+    assert changed([1, 2]) == []
+    assert changed([1.5, 2]) == [0, 2]
+    assert changed([1.5, 3]) == [1]
+    # Changing a parameter outside setp is still detected
+    M2.b.value = 1
+    assert changed([1.5, 3]) == [1]
+    assert M3.theory()[0] == _quadratic(x[0], 1, 2, 3.5)
+    # Direct calls to model_update update every model
+    del updates[:]
+    problem.model_update()
+    assert sorted(updates) == [0, 1, 2]
+
+def test_parameter_cache():
+    import pickle
+    from .curve import Curve
+
+    # Least recently used entries are dropped first
+    cache = ParameterCache(2)
+    a, b, c = [cache.key('nllf', [v, 1.]) for v in (1, 2, 3)]
+    assert cache.get(a) is None
+    cache.put(a, 1.)
+    cache.put(b, 2.)
+    assert cache.get(a) == 1.
+    cache.put(c, 3.)
+    assert cache.get(b) is None and cache.get(a) == 1. and cache.get(c) == 3.
+    assert (cache.hits, cache.misses, len(cache)) == (3, 2, 2)
+    assert cache.key('nllf', [1, 1]) == a and cache.key('residuals', [1, 1]) != a
+    # Values are not pickled
+    copy = pickle.loads(pickle.dumps(cache))
+    assert copy.size == 2 and len(copy) == 0
+    # Size zero disables the cache
+    cache = ParameterCache(0)
+    cache.put(a, 1.)
+    assert cache.get(a) is None and len(cache) == 0 and cache.misses == 0
+
+    x = numpy.linspace(1, 2, 7)
+    y = _quadratic(x, 1, 2, 3)
+    calls = []
+    def counted(x, a, b, c):
+        calls.append(a)
+        return _quadratic(x, a, b, c)
+    M = Curve(counted, x, y, 0.1*y, a=(0, 2), b=(0, 4), c=3)
+    problem = FitProblem(M)
+    problem.set_cache(4)
+    p1, p2 = [1., 2.], [1.5, 2.]
+    f1 = problem.nllf(p1)
+    f2 = problem.nllf(p2)
+    del calls[:]
+    assert problem.nllf(p1) == f1 and problem.nllf(p2) == f2
+    assert calls == []
+    assert problem.cache.hits == 2 and problem.cache.misses == 2
+    # The model is left at the requested point on a hit
+    assert numpy.all(problem.getp() == p2)
+    R = problem.residuals()
+    R[:] = 0
+    assert (problem.residuals() != 0).all()
+    assert calls == [1.5]
+    # Resetting the model invalidates the cache
+    M.c.value = 4
+    problem.model_reset()
+    assert len(problem.cache) == 0
+    assert problem.nllf(p1) != f1
@@ -32,12 +32,10 @@ class ConsoleMonitor(monitor.TimedUpdate):
 
     def show_improvement(self, history):
         #print "step",history.step[0],"chisq",history.value[0]
-        p = self.problem.getp()
-        try:
-            self.problem.setp(history.point[0])
-            print(self.problem.summarize())
-        finally:
-            self.problem.setp(p)
+        # Format the point directly rather than going through setp so
+        # that the model is not updated, and the monitor can run in a
+        # background thread while the fit continues.
+        print(self.problem.summarize(history.point[0]))
         sys.stdout.flush()
 
 
@@ -49,8 +47,12 @@ class StepMonitor(monitor.Monitor):
     *fields* is the list of "step|time|value|point" fields to save
 
     The point field should be last in the list.
+
+    The log records every step, so updates are never dropped when the
+    monitor is run in the background.
     """
     FIELDS = ['step', 'time', 'value', 'point']
+    coalesce = False
 
     def __init__(self, problem, fid, fields=FIELDS):
         if any(f not in self.FIELDS for f in fields):
@@ -83,13 +85,21 @@ class MonitorRunner(object):
             monitors = [ConsoleMonitor(problem)]
         self.monitors = monitors
         self.history = History(time=1, step=1, point=1, value=1,
-                               population_points=1, population_values=1)
+                               population_points=1, population_values=1,
+                               calls=1)
         for M in self.monitors:
             M.config_history(self.history)
         self._start = time.time()
 
     def __call__(self, step, point, value,
-                 population_points=None, population_values=None):
+                 population_points=None, population_values=None,
+                 calls=None):
+        """
+        Record the fit progress and notify the monitors.  If given, *calls*
+        is the number of function evaluations since the last call.
+        """
+        if calls is not None:
+            self.history.accumulate(calls=calls)
         self.history.update(time=time.time() - self._start,
                             step=step, point=point, value=value,
                             population_points=population_points,
@@ -154,6 +164,15 @@ class FitBase(object):
 
 
 class MultiStart(FitBase):
+    """
+    Run the wrapped fitter from several starting points, returning the best.
+
+    With *keep_best* (the default), each start continues from the best point
+    so far, so the starts run one after the other.  Otherwise the first
+    start is from the current point and the remainder are from random
+    points, with the fits run as independent replicates, concurrently on
+    *cpus* processes if cpus > 1.  See :func:`replicate_fits`.
+    """
     name = "Multistart Monte Carlo"
     settings = [('starts', 100)]
 
@@ -164,24 +183,294 @@ class MultiStart(FitBase):
     def solve(self, monitors=None, mapper=None, **options):
         starts = options.pop('starts', 1)
         reset = not options.pop('keep_best', True)
+        cpus = options.pop('cpus', 1)
+        if reset:
+            x0 = self.problem.getp()
+            points = numpy.vstack((x0, self.problem.randomize(max(starts, 1)-1)))
+            results = replicate_fits(self.fitter, points, cpus=cpus,
+                                     monitors=monitors, mapper=mapper,
+                                     **options)
+            if len(results) == 0:
+                raise RuntimeError("all multistart fits failed")
+            best = numpy.argmin(results[:, 0])
+            return results[best, 1:], results[best, 0]
+
         f_best = numpy.inf
         for _ in range(max(starts, 1)):
-            print("round")
             x, fx = self.fitter.solve(monitors=monitors, mapper=mapper,
                                       **options)
             if fx < f_best:
                 x_best, f_best = x, fx
-                print(x_best, fx)
-            if reset:
-                self.problem.randomize()
-            elif 0:
-                # Jitter
-                self.problem.setp(x_best)
-                pop = initpop.eps_init(1, self.problem.getp(), self.problem.bounds(),
-                                       include_current=False, eps=1e-5)
-                self.problem.setp(pop[0])
         return x_best, f_best
 
+
+def replicate_fits(fitter, points, resynth=False, cpus=1, callback=None,
+                   monitors=None, mapper=None, **options):
+    """
+    Run independent fits with *fitter* from each point in *points*.
+
+    Returns an array with one row [nllf, x1, x2, ...] for each replicate
+    which completed, in the order of *points*.
+
+    If *resynth* is True, the data is resynthesized before each fit and
+    restored afterward, giving the fits needed for resynth-refit uncertainty
+    analysis.
+
+    If *cpus* > 1, the replicates are run concurrently on a pool of *cpus*
+    processes.  Each process gets its own copy of the fitter and its
+    problem, with the random number generator seeded separately for each
+    replicate.  The fits within the processes do not use *monitors* or
+    *mapper*.  Otherwise the replicates are run one after the other on
+    *fitter.problem*, which is restored to its initial point afterward.
+
+    *callback(k, x, fx)* is called with the result of replicate *k* as each
+    fit completes, which may be out of order when running in parallel.
+    This can be used to save the results as they are produced.
+
+    A replicate which raises an exception is reported on stderr and
+    skipped without losing the others.  Stopping with KeyboardInterrupt
+    returns the replicates completed so far.
+    """
+    problem = fitter.problem
+    points = numpy.atleast_2d(numpy.asarray(points, 'd'))
+    abort_test = options.pop('abort_test', None)
+    if abort_test is None:
+        abort_test = lambda: False
+    if callback is None:
+        callback = lambda k, x, fx: None
+    results = {}
+    def collect(k, x, fx, error):
+        if error is not None:
+            print("replicate %d failed:\n%s" % (k, error), file=sys.stderr)
+        else:
+            results[k] = numpy.hstack((fx, x))
+            callback(k, x, fx)
+
+    x_init = problem.getp()
+    try:
+        if cpus > 1:
+            _replicate_pool(fitter, points, resynth, cpus, collect, options)
+        else:
+            for k, x0 in enumerate(points):
+                collect(*_replicate_one(fitter, k, x0, resynth, None,
+                                        monitors, abort_test, mapper,
+                                        options))
+                if abort_test(): break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        problem.setp(x_init)
+    if not results:
+        return numpy.empty((0, points.shape[1]+1), 'd')
+    return numpy.array([results[k] for k in sorted(results)])
+
+def _replicate_one(fitter, k, x0, resynth, seed, monitors, abort_test,
+                   mapper, options):
+    """
+    Run replicate *k* from *x0*, returning (k, x, fx, error) where *error*
+    is the formatted traceback if the fit raised an exception.
+    """
+    import traceback
+    problem = fitter.problem
+    if seed is not None:
+        numpy.random.seed(seed)
+    if resynth:
+        try:
+            problem.resynth_data()
+        except Exception:
+            return k, None, None, traceback.format_exc()
+    try:
+        problem.setp(x0)
+        x, fx = fitter.solve(monitors=monitors, abort_test=abort_test,
+                             mapper=mapper, **options)
+        result = k, numpy.asarray(x, 'd'), fx, None
+    except Exception:
+        result = k, None, None, traceback.format_exc()
+    if resynth:
+        # The data is only restored if it was resynthesized.  A replicate
+        # that cannot restore its data is reported as failed, keeping the
+        # error from the fit if there is one.
+        try:
+            problem.restore_data()
+        except Exception:
+            if result[3] is None:
+                result = k, None, None, traceback.format_exc()
+    return result
+
+_REPLICATE_FITTER = _REPLICATE_OPTIONS = None
+def _replicate_init(fitter, options):
+    global _REPLICATE_FITTER, _REPLICATE_OPTIONS
+    _REPLICATE_FITTER, _REPLICATE_OPTIONS = fitter, options
+def _replicate_run(task):
+    k, x0, resynth, seed = task
+    return _replicate_one(_REPLICATE_FITTER, k, x0, resynth, seed,
+                          [], lambda: False, None, _REPLICATE_OPTIONS)
+
+def _replicate_pool(fitter, points, resynth, cpus, collect, options):
+    import multiprocessing
+    seeds = numpy.random.randint(2**31-1, size=len(points))
+    tasks = [(k, x0, resynth, seed)
+             for k, (x0, seed) in enumerate(zip(points, seeds))]
+    pool = multiprocessing.Pool(min(cpus, len(tasks)), _replicate_init,
+                                (fitter, options))
+    try:
+        for result in pool.imap_unordered(_replicate_run, tasks):
+            collect(*result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+class FastSlowFit(FitBase):
+    """
+    Alternate between fitting the fast and the slow parameters.
+
+    Parameters tagged as fast (see :attr:`parameter.Parameter.fast`) are
+    cheap to change since the models can reuse their expensive intermediate
+    results.  Each round runs a full fit over the fast parameters with the
+    slow parameters held fixed, then a short fit of *outer_steps* steps over
+    the slow parameters with the fast parameters held fixed.  The rounds
+    stop after *rounds* rounds, or when a round improves nllf by less
+    than *ftol*.
+
+    The wrapped *fitter* is used for both the inner and the outer fits.
+    """
+    name = "Fast/slow alternation"
+    settings = [('rounds', 10), ('outer_steps', 10)]
+
+    def __init__(self, fitter):
+        self.fitter = fitter
+        self.problem = fitter.problem
+
+    def solve(self, monitors=None, abort_test=None, mapper=None, **options):
+        rounds = options.pop('rounds', 10)
+        outer_steps = options.pop('outer_steps', 10)
+        ftol = options.get('ftol', 1e-8)
+        if mapper is None:
+            mapper = self.problem.nllf_batch
+        if abort_test is None:
+            abort_test = lambda: False
+        fast = self.problem.fast_mask()
+        if fast.all() or not fast.any():
+            return self.fitter.solve(monitors=monitors, abort_test=abort_test,
+                                     mapper=mapper, **options)
+
+        update = MonitorRunner(problem=self.problem, monitors=monitors)
+        x_best = self.problem.getp()
+        f_best = self.problem.nllf(x_best)
+        outer = dict(options, steps=outer_steps)
+        for _ in range(max(rounds, 1)):
+            f_start = f_best
+            for index, opts in ((fast, options), (~fast, outer)):
+                subspace = _Subspace(self.problem, index, x_best, mapper)
+                fitter = self.fitter.__class__(subspace)
+                x, fx = fitter.solve(monitors=[_SubspaceMonitor(subspace, update)],
+                                     abort_test=abort_test, mapper=None,
+                                     **opts)
+                if fx < f_best:
+                    x_best, f_best = subspace.expand(x), fx
+                if abort_test(): break
+            if abort_test() or f_start - f_best < ftol: break
+        self.problem.setp(x_best)
+        return x_best, f_best
+
+
+class _Subspace(object):
+    """
+    Fit problem restricted to the parameters selected by boolean vector
+    *index*, with the remaining parameters held at their values in *x*.
+
+    Points are expanded to the full parameter vector before evaluation, so
+    population evaluation can still use the *mapper* for the full problem.
+    """
+    def __init__(self, problem, index, x, mapper):
+        self.problem = problem
+        self.index = index
+        self.x = numpy.array(x, 'd')
+        self.mapper = mapper
+        self._parameters = [p for p, k in zip(problem._parameters, index) if k]
+        self.dof = problem.dof
+        self.name = problem.name
+        self.problem.setp(self.x)
+
+    def expand(self, p):
+        p = numpy.asarray(p, 'd')
+        full = numpy.empty(p.shape[:-1]+self.x.shape, 'd')
+        full[...] = self.x
+        full[..., self.index] = p
+        return full
+
+    def getp(self):
+        return self.problem.getp()[self.index]
+
+    def setp(self, p):
+        self.problem.setp(self.expand(p))
+
+    def bounds(self):
+        return self.problem.bounds()[:, self.index]
+
+    def randomize(self, N=None):
+        if N is not None:
+            return self.problem.randomize(N)[:, self.index]
+        self.setp([p.bounds.random(1)[0] for p in self._parameters])
+
+    def nllf(self, p=None):
+        return self.problem.nllf(self.expand(p) if p is not None else None)
+
+    def nllf_batch(self, points):
+        return self.mapper(self.expand(points))
+
+    def __call__(self, p=None):
+        return 2*self.nllf(p)/self.dof
+
+    def residuals(self):
+        return self.problem.residuals()
+
+    def parameter_residuals(self):
+        return self.problem.parameter_residuals()
+
+    def parameter_residuals_deriv(self):
+        return self.problem.parameter_residuals_deriv()[:, self.index]
+
+    def residuals_batch(self, points):
+        return self.problem.residuals_batch(self.expand(points))
+
+    @property
+    def bounded(self):
+        return self.problem.bounded
+
+    def constraints_nllf(self):
+        return self.problem.constraints_nllf()
+
+    def chisq(self):
+        return self.problem.chisq()
+
+    def labels(self):
+        return [p.name for p in self._parameters]
+
+    def summarize(self):
+        return parameter.summarize(self._parameters)
+
+
+class _SubspaceMonitor(monitor.Monitor):
+    """
+    Forward the progress of a subspace fit to the monitors for the full
+    problem.
+    """
+    def __init__(self, subspace, update):
+        self.subspace = subspace
+        self.update = update
+        self._step = update.history.step[0] if len(update.history.step) else 0
+
+    def config_history(self, history):
+        history.requires(step=1, point=1, value=1)
+
+    def __call__(self, history):
+        self.update(step=self._step + history.step[0],
+                    point=self.subspace.expand(history.point[0]),
+                    value=history.value[0])
+
+
 class DEFit(FitBase):
     name = "Differential Evolution"
     settings = [('steps', 1000), ('pop', 10), ('CR', 0.9), ('F', 2.0),
@@ -197,7 +486,7 @@ class DEFit(FitBase):
         if mapper is not None:
             _mapper = lambda p, x: mapper(x)
         else:
-            _mapper = lambda p, x: map(self.problem.nllf, x)
+            _mapper = lambda p, x: self.problem.nllf_batch(x)
         resume = hasattr(self, 'state')
         steps = options['steps'] + (self.state['step'][-1] if resume else 0)
         strategy = de.DifferentialEvolution(npop=options['pop'],
@@ -251,18 +540,27 @@ def save_history(path, state):
 
 class BFGSFit(FitBase):
     name = "Quasi-Newton BFGS"
-    settings = [('steps', 3000), ('starts', 1)]
+    settings = [('steps', 3000), ('starts', 1), ('deriv', 'forward'),
+                ('trials', 1)]
 
     def solve(self, monitors=None, abort_test=None, mapper=None, **options):
         _fill_defaults(options, self.settings)
         from .quasinewton import quasinewton, STATUS
         self._update = MonitorRunner(problem=self.problem,
                                      monitors=monitors)
+        x0 = self.problem.getp()
+        grad = self._grad if _has_deriv(self.problem, 'nllf_deriv') else []
+        if mapper is None:
+            mapper = self.problem.nllf_batch
         result = quasinewton(fn=self.problem.nllf,
-                             x0=self.problem.getp(),
+                             x0=x0,
+                             grad=grad,
                              monitor=self._monitor,
                              abort_test=abort_test,
                              itnlimit=options['steps'],
+                             mapper=mapper,
+                             central=(options['deriv'] == 'central'),
+                             trials=options['trials'],
                              )
         self.result = result
         #code = result['status']
@@ -279,6 +577,10 @@ class BFGSFit(FitBase):
     def Hcov(self):
         return lsqerror.chol_cov(self.result['L'])
 
+    def _grad(self, x):
+        self.problem.setp(x)
+        return self.problem.nllf_deriv()
+
     def _monitor(self, step, x, fx):
         self._update(step=step, point=x, value=fx,
                      population_points=[x],
@@ -293,7 +595,7 @@ class PSFit(FitBase):
     def solve(self, monitors=None, mapper=None, **options):
         _fill_defaults(options, self.settings)
         if mapper is None:
-            mapper = lambda x: map(self.problem.nllf, x)
+            mapper = self.problem.nllf_batch
         from .random_lines import particle_swarm
         self._update = MonitorRunner(problem=self.problem,
                                      monitors=monitors)
@@ -325,7 +627,7 @@ class RLFit(FitBase):
     def solve(self, monitors=None, abort_test=None, mapper=None, **options):
         _fill_defaults(options, self.settings)
         if mapper is None:
-            mapper = lambda x: map(self.problem.nllf, x)
+            mapper = self.problem.nllf_batch
         from .random_lines import random_lines
         self._update = MonitorRunner(problem=self.problem,
                                      monitors=monitors)
@@ -357,9 +659,8 @@ class PTFit(FitBase):
     settings = [('steps', 1000), ('nT', 25), ('CR', 0.9),
                 ('burn', 4000), ('Tmin', 0.1), ('Tmax', 10)]
 
-    def solve(self, monitors=None, mapper=None, **options):
+    def solve(self, monitors=None, abort_test=None, mapper=None, **options):
         _fill_defaults(options, self.settings)
-        # TODO: no mapper??
         from .partemp import parallel_tempering
         self._update = MonitorRunner(problem=self.problem,
                                      monitors=monitors)
@@ -374,7 +675,9 @@ class PTFit(FitBase):
                                     CR=options['CR'],
                                     steps=options['steps'],
                                     burn=options['burn'],
-                                    monitor=self._monitor)
+                                    monitor=self._monitor,
+                                    mapper=mapper,
+                                    abort_test=abort_test)
         return history.best_point, history.best
 
     def _monitor(self, step, x, fx, P, E):
@@ -384,13 +687,23 @@ class PTFit(FitBase):
 
 
 class AmoebaFit(FitBase):
+    """
+    Nelder-Mead simplex fit.
+
+    Candidate points are evaluated in batches through *mapper*.  With
+    *vertices* > 1 the worst vertices are updated together so that the
+    batches can be evaluated in parallel.  The default *vertices=0* uses
+    one vertex per processor available to the fit driver.
+    """
     name = "Nelder-Mead Simplex"
-    settings = [('steps', 1000), ('starts', 1), ('radius', 0.15), ('xtol', 1e-6), ('ftol', 1e-8)]
+    settings = [('steps', 1000), ('starts', 1), ('radius', 0.15), ('xtol', 1e-6), ('ftol', 1e-8), ('vertices', 0)]
 
     def solve(self, monitors=None, abort_test=None, mapper=None, **options):
         from .simplex import simplex
         _fill_defaults(options, self.settings)
-        # TODO: no mapper??
+        vertices = options['vertices']
+        if vertices <= 0:
+            vertices = options.get('cpus', 1)
         self._update = MonitorRunner(problem=self.problem,
                                      monitors=monitors)
         #print "bounds",self.problem.bounds()
@@ -401,7 +714,9 @@ class AmoebaFit(FitBase):
                          maxiter=options['steps'],
                          radius=options['radius'],
                          xtol=options['xtol'],
-                         ftol=options['ftol'])
+                         ftol=options['ftol'],
+                         mapper=mapper if mapper else self.problem.nllf_batch,
+                         vertices=vertices)
         # Let simplex propose the starting point for the next amoeba
         # fit in a multistart amoeba context.  If the best is always
         # used, the fit can get stuck in a local minimum.
@@ -415,60 +730,114 @@ class AmoebaFit(FitBase):
         return True
 
 class LevenbergMarquardtFit(FitBase):
+    """
+    Bounded Levenberg-Marquardt fit.
+
+    The residuals are the model residuals plus the parameter prior
+    residuals, with any constraints cost as one extra residual, which is
+    differentiated numerically when the constraints are violated.  The model
+    Jacobian is analytic if the model provides *residuals_deriv*, otherwise
+    it is computed by forward differences with all the perturbed points
+    evaluated in one call to *mapper.residuals*, if the mapper has it, or
+    *problem.residuals_batch*.  The Jacobian at the minimum is kept for
+    :meth:`cov` and :meth:`stderr`.  See :mod:`bumps.levmar`.
+    """
     name = "Levenberg-Marquardt"
     settings = [('steps', 1000), ('ftol', 1.5e-8), ('xtol', 1.5e-8)]
-    # LM also has
-    #    gtol: orthoganality between jacobian columns
-    #    epsfcn: numerical derivative step size
-    #    factor: initial radius
-    #    diag: variable scale factors to bring them near 1
+
     def solve(self, monitors=None, abort_test=None, mapper=None, **options):
-        from scipy import optimize
+        from .levmar import levmar
         _fill_defaults(options, self.settings)
-        self._low,self._high = self.problem.bounds()
         self._update = MonitorRunner(problem=self.problem,
                                      monitors=monitors)
-
-        result = optimize.leastsq(self._bounded_residuals,
-                                  self.problem.getp(),
-                                  ftol=options['ftol'],
-                                  xtol=options['xtol'],
-                                  full_output=1)
-        x, cov_x, info, mesg, success = result
-        self._cov = cov_x
-        # compute one last time with x forced inside the boundary, and using
-        # problem.nllf as returned by other optimizers.  We will ignore the
-        # covariance output and calculate it again ourselves.  Not ideal if
-        # f is expensive, but it will be consistent with other optimizers.
-        self.problem.setp(x + self._stray_delta(x))
-        fx = self.problem.nllf()
+        batch = getattr(mapper, 'residuals', None)
+        if batch is None:
+            batch = self.problem.residuals_batch
+        self._batch = batch
+        self._calls = 0
+
+        # Use the analytic Jacobian if the model provides one, which takes
+        # one evaluation per step rather than one per parameter.
+        x0 = self.problem.getp()
+        self._analytic = _has_deriv(self.problem, 'residuals_deriv')
+        result = levmar(self._residuals, x0,
+                        bounds=self.problem.bounds(),
+                        jac=self._jacobian,
+                        steps=options['steps'],
+                        ftol=options['ftol'],
+                        xtol=options['xtol'],
+                        abort_test=abort_test,
+                        monitor=self._monitor)
+        self.result = result
+        self._cov = None
+        x = result['x']
+        # Report nllf as returned by other optimizers rather than the
+        # sum squared residuals.
+        fx = self.problem.nllf(x)
         return x, fx
 
-    def _bounded_residuals(self, p):
-        from numpy import sum, where
-        # Force the fit point into the valid region
-        stray = self._stray_delta(p)
-        self.problem.setp(p+stray)
-        # treat prior probabilities on the parameters as additional measurements
-        residuals = numpy.hstack((self.problem.residuals().flat,self.problem.parameter_residuals()))
-        # Tally costs for straying outside the boundaries plus other costs
-        extra_cost = numpy.sum(stray**2) + self.problem.constraints_nllf()
-        # Spread the cost over the residuals.  Since we are smoothly increasing
-        # residuals as we leave the boundary, this should push us back into the
-        # boundary (within tolerance) during the lm fit.
-        residuals += numpy.sign(residuals)*(extra_cost/len(residuals))
-        return residuals
-
-    def _stray_delta(self, p):
-        """calculate how far point is outside the distance outside the boundary"""
-        return (numpy.where(p<self._low, self._low-p, 0)
-                 + numpy.where(p>self._high, self._high-p, 0))
+    def _residuals(self, p):
+        self._calls += 1
+        self.problem.setp(p)
+        return self._extend(self.problem.residuals(), p)
+
+    def _extend(self, residuals, p):
+        # Treat prior probabilities on the parameters as additional
+        # measurements, and the constraints cost as one more.
+        constraints = self.problem.constraints_nllf()
+        return numpy.hstack((numpy.asarray(residuals).flat,
+                             self.problem.parameter_residuals(),
+                             numpy.sqrt(2*max(constraints, 0))))
+
+    def _jacobian(self, p, r):
+        from .levmar import fdjac
+        self.problem.setp(p)
+        n = len(p)
+        if self._analytic:
+            self._calls += 1
+            Jmodel = self.problem.residuals_deriv()
+        else:
+            self._calls += n
+            nmodel = len(r) - len(self.problem.bounded) - 1
+            Jmodel = fdjac(self._batch, p, r[:nmodel],
+                                 bounds=self.problem.bounds())
+            self.problem.setp(p)
+        return numpy.vstack((Jmodel,
+                             self.problem.parameter_residuals_deriv(),
+                             self._constraints_deriv(p, r[-1])))
+
+    def _constraints_deriv(self, p, c):
+        # Central difference derivative of the constraints residual.  The
+        # row is left at zero while the constraints are satisfied, so that
+        # unconstrained problems do not pay for the extra setp calls.
+        D = numpy.zeros((1, len(p)))
+        if c > 0:
+            h = 1e-6*numpy.maximum(abs(p), 1)
+            for k, hk in enumerate(h):
+                dp = numpy.zeros(len(p))
+                dp[k] = hk
+                self.problem.setp(p + dp)
+                hi = numpy.sqrt(2*max(self.problem.constraints_nllf(), 0))
+                self.problem.setp(p - dp)
+                lo = numpy.sqrt(2*max(self.problem.constraints_nllf(), 0))
+                D[0, k] = (hi - lo)/(2*hk)
+            self.problem.setp(p)
+        return D
 
+    def _monitor(self, step, x, fx, evals):
+        self._update(step=step, point=x, value=fx,
+                     population_points=[x],
+                     population_values=[fx],
+                     calls=self._calls)
+        self._calls = 0
+        return True
 
     def stderr(self):
-        return numpy.sqrt(numpy.diag(self._cov))
+        return numpy.sqrt(numpy.diag(self.cov()))
 
     def cov(self):
+        if self._cov is None:
+            self._cov = lsqerror.cov(self.result['J'])
         return self._cov
 
 class SnobFit(FitBase):
@@ -506,7 +875,7 @@ class DreamModel(MCMCModel):
         self.bounds = self.problem.bounds()
         self.labels = self.problem.labels()
 
-        self.mapper = mapper if mapper else lambda p: map(self.nllf, p)
+        self.mapper = mapper if mapper else self.problem.nllf_batch
 
     def log_density(self, x):
         return -self.nllf(x)
@@ -525,7 +894,8 @@ class DreamModel(MCMCModel):
 
 class DreamFit(FitBase):
     name = "DREAM"
-    settings = [('steps', 400), ('burn', 100), ('pop', 10), ('init', 'eps'), ('thin', 1)]
+    settings = [('steps', 400), ('burn', 100), ('pop', 10), ('init', 'eps'), ('thin', 1),
+                ('history', 0)]
 
     def __init__(self, problem):
         self.dream_model = DreamModel(problem)
@@ -543,11 +913,18 @@ class DreamFit(FitBase):
         population = initpop.generate(self.dream_model.problem, **options)
         pop_size = population.shape[0]
         population = population[None, :, :]
+        # Stream the samples to the output store as they are collected so
+        # that an interrupted fit can be resumed.  With the samples on disk,
+        # only the last *history* thinned generations are kept in memory.
+        stream = getattr(self.dream_model.problem, 'output_path', None)
+        history = options['history'] if options['history'] > 0 else None
         sampler = dream.Dream(model=self.dream_model, population=population,
                               draws=pop_size * options['steps'],
                               burn=pop_size * options['burn'],
                               thinning=options['thin'],
                               monitor=self._monitor,
+                              stream=stream,
+                              stream_history=history,
                               DE_noise=1e-6)
 
         self.state = sampler.sample(state=self.state, abort_test=abort_test)
@@ -590,7 +967,9 @@ class DreamFit(FitBase):
         self.state = dream.state.load_state(input_path, report=100)
 
     def save(self, output_path):
-        self.state.save(output_path)
+        # If the state was streamed to output_path, this updates the
+        # stream rather than writing the chains a second time.
+        self.state.save(output_path, binary=True)
 
     def plot(self, output_path):
         self.state.show(figfile=output_path)
@@ -634,33 +1013,28 @@ def _resampler(fitter, xinit, samples=100, restart=False, **options):
     up an array in Result.samples which contains the best fit to the
     resynthesized data.  *samples* is the number of samples to generate.
     *fitter* is the (local) optimizer to use. **kw are the parameters
-    for the optimizer.
+    for the optimizer.  Use *cpus* > 1 to run the refits in parallel.
     """
-    x = xinit
-    points = []
-    try:  # TODO: some solvers already catch KeyboardInterrupt
-        for _ in range(samples):
-            #print "== resynth %d of %d" % (i, samples)
-            fitter.problem.resynth_data()
-            if restart:
-                fitter.problem.randomize()
-            else:
-                fitter.problem.setp(x)
-            x, fx = fitter.solve(**options)
-            points.append(numpy.hstack((fx, x)))
-            #print self.problem.summarize()
-            #print "[chisq=%g]" % (nllf*2/self.problem.dof)
-    except KeyboardInterrupt:
-        pass
+    cpus = options.pop('cpus', 1)
+    if restart:
+        starts = fitter.problem.randomize(samples)
+    else:
+        starts = numpy.tile(numpy.asarray(xinit, 'd'), (samples, 1))
+    try:
+        points = replicate_fits(fitter, starts, resynth=True, cpus=cpus,
+                                **options)
     finally:
         # Restore the state of the problem
-        fitter.problem.restore_data()
         fitter.problem.setp(xinit)
         fitter.problem.model_update()
-    return points
+    return list(points)
 
 
 class FitDriver(object):
+    # Number of processes for independent replicate fits such as multistart
+    # and resynth.  The fits within each process are serial.
+    cpus = 1
+
     def __init__(self, fitclass=None, problem=None, monitors=None, abort_test=None,
                  mapper=None, **options):
         self.fitclass = fitclass
@@ -668,52 +1042,111 @@ class FitDriver(object):
         self.options = options
         self.monitors = monitors
         self.abort_test = abort_test
-        self.mapper = mapper if mapper else lambda p: map(problem.nllf, p)
+        self.mapper = mapper if mapper else problem.nllf_batch
 
-    def fit(self, resume=None):
+    def _fitter(self, resume=None):
         fitter = self.fitclass(self.problem)
         if resume:
             fitter.load(resume)
+        if self.options.get('rounds', 0) > 0:
+            fitter = FastSlowFit(fitter)
+        return fitter
+
+    def fit(self, resume=None):
+        fitter = self._fitter(resume)
         starts = self.options.get('starts', 1)
+        options = dict(self.options, cpus=self.cpus)
         if starts > 1:
             fitter = MultiStart(fitter)
         t0 = time.clock()
-        x, fx = fitter.solve(monitors=self.monitors,
-                             abort_test=self.abort_test,
-                             mapper=self.mapper,
-                             **self.options)
+        try:
+            x, fx = fitter.solve(monitors=self.monitors,
+                                 abort_test=self.abort_test,
+                                 mapper=self.mapper,
+                                 **options)
+        finally:
+            self._flush_monitors()
         self.fitter = fitter
         self.time = time.clock() - t0
         self.result = x, fx
         self.problem.setp(x)
         return x, fx
 
-    def cov(self):
+    def resynth(self, samples, callback=None):
+        """
+        Refit *samples* resynthesized data sets starting from the current
+        point, returning an array of [nllf, x1, x2, ...] for each refit.
+
+        The refits run concurrently on *cpus* processes if cpus > 1.
+        *callback(k, x, fx)* is called as each refit completes.  See
+        :func:`replicate_fits`.
         """
+        options = dict(self.options)
+        fitter = self._fitter()
+        if options.get('starts', 1) > 1:
+            fitter = MultiStart(fitter)
+        points = numpy.tile(self.problem.getp(), (samples, 1))
+        try:
+            return replicate_fits(fitter, points, resynth=True,
+                                  cpus=self.cpus, callback=callback,
+                                  monitors=self.monitors, mapper=self.mapper,
+                                  **options)
+        finally:
+            self._flush_monitors()
+
+    def _flush_monitors(self):
+        # Wait for any monitors running in the background to catch up,
+        # and stop their threads even if the fit fails.
+        for M in (self.monitors or []):
+            if hasattr(M, 'flush'): M.flush()
+
+    def cov(self):
+        r"""
         Return an estimate of the covariance of the fit.
 
         Depending on the fitter and the problem, this may be computed from
         existing evaluations within the fitter, or from numerical
         differentiation around the minimum.  The numerical differentiation
-        will use the Hessian estimated from nllf.   If the problem uses
+        will use the Hessian estimated from nllf.  With a parallel mapper,
+        the perturbed points are evaluated as a batch using the mapper,
+        otherwise numdifftools is used if it is available.   If the problem uses
         $\chi^2/2$ as its nllf, then you may want to instead compute
         the covariance from the Jacobian::
 
-            J = lsqerror.jacobian(fitdriver.result[0])
+            J = lsqerror.jacobian(problem, fitdriver.result[0],
+                                  mapper=fitdriver.mapper)
             cov = lsqerror.cov(J)
 
         This should be faster and more accurate than the Hessian of nllf
-        when you can use it.
+        when you can use it.  If the model provides analytic derivatives
+        (see :meth:`fitproblem.Fitness.residuals_deriv`), then the
+        covariance is computed from $J^T J$ using the analytic Jacobian.
         """
         if not hasattr(self, '_cov'):
             if hasattr(self.fitter, 'cov'):
                 self._cov = self.fitter.cov()
+            elif _has_deriv(self.problem, 'residuals_deriv', self.result[0]):
+                # Gauss-Newton approximation to the Hessian from the
+                # analytic Jacobian, including the parameter priors.
+                J = numpy.vstack((self.problem.residuals_deriv(),
+                                  self.problem.parameter_residuals_deriv()))
+                H,L = lsqerror.perturbed_hessian(numpy.dot(J.T, J))
+                self._cov = lsqerror.chol_cov(L)
             else:
-                H = lsqerror.hessian(self.problem, self.result[0])
+                H = lsqerror.hessian(self.problem, self.result[0],
+                                     mapper=self._parallel_mapper())
                 H,L = lsqerror.perturbed_hessian(H)
                 self._cov = lsqerror.chol_cov(L)
         return self._cov
 
+    def _parallel_mapper(self):
+        """
+        Return the fit mapper, or None if it evaluates points serially
+        with the problem itself.
+        """
+        serial = getattr(self.problem, 'nllf_batch', None)
+        return None if self.mapper == serial else self.mapper
+
     def stderr(self):
         """
         Return an estimate of the standard error of the fit.
@@ -758,6 +1191,22 @@ class FitDriver(object):
             self.fitter.plot(output_path=output_path)
 
 
+def _has_deriv(problem, method, p=None):
+    """
+    Return True if *problem.method()* provides analytic derivatives at *p*,
+    or at the current point if *p* is None.  The problem is left at *p*.
+    """
+    deriv = getattr(problem, method, None)
+    if deriv is None:
+        return False
+    if p is not None:
+        problem.setp(p)
+    try:
+        deriv()
+    except NotImplementedError:
+        return False
+    return True
+
 def _fill_defaults(options, settings):
     for field, value in settings:
         if field not in options:
@@ -773,6 +1222,7 @@ class FitOptions(object):
         ftol   = ("Minimum population flatness", "float"),
         stop   = ("Stopping criteria", "str"),
         thin   = ("Thinning",        "int"),
+        history = ("Generations kept in memory", "int"),
         burn   = ("Burn-in Steps",   "int"),
         pop    = ("Population",      "float"),
         init   = ("Initializer",     ("eps", "lhs", "cov", "random")),
@@ -782,6 +1232,11 @@ class FitOptions(object):
         Tmin   = ("Min Temperature", "float"),
         Tmax   = ("Max Temperature", "float"),
         radius = ("Simplex Radius",  "float"),
+        vertices = ("Parallel vertices", "int"),
+        rounds = ("Fast/slow rounds", "int"),
+        outer_steps = ("Slow steps per round", "int"),
+        deriv  = ("Gradient",        ("forward", "central")),
+        trials = ("Line search trials", "int"),
         )
 
     def __init__(self, fitclass):
@@ -790,7 +1245,12 @@ class FitOptions(object):
 
     def set_from_cli(self, opts):
         # Convert supplied options to the correct types and save them in value
-        for field, reset_value in self.fitclass.settings:
+        fields = [field for field, _ in self.fitclass.settings]
+        # The fast/slow alternation wraps any fitter (see FitDriver), so
+        # its options are accepted for all of them.
+        fields += [field for field, _ in FastSlowFit.settings
+                   if field not in fields]
+        for field in fields:
             value = getattr(opts, field, None)
             dtype = FitOptions.FIELDS[field][1]
             if value is not None:
@@ -816,10 +1276,223 @@ FIT_OPTIONS = dict(
     dream   = FitOptions(DreamFit),
     newton  = FitOptions(BFGSFit),
     #ps      = FitOptions(PSFit),
-    #pt      = FitOptions(PTFit),
+    pt      = FitOptions(PTFit),
     #rl      = FitOptions(RLFit),
     #snobfit = FitOptions(SnobFit),
     lm      = FitOptions(LevenbergMarquardtFit),
     )
 
 FIT_DEFAULT = 'amoeba'
+
+
+def _peak(x, center=1, width=0.5):
+    return numpy.exp(-0.5*(x-center)**2/width**2)
+def _scaled(x, theory, scale=2, background=0.1):
+    return scale*theory + background
+def test_fast_slow():
+    from .curve import Curve
+    from .fitproblem import FitProblem
+    x = numpy.linspace(0, 2, 21)
+    y = _scaled(x, _peak(x, 1.2, 0.4), 3, 0.2)
+    M = Curve(_peak, x, y, 0.01, fast=_scaled,
+              center=(0, 2), width=(0.1, 1), scale=(0, 5), background=(0, 1))
+    problem = FitProblem(M)
+    problem.setp([0.1, 1, 2, 0.5])
+
+    # The fast/slow options are accepted on the command line for any fitter
+    class Opts: rounds, outer_steps = "50", "100"
+    fitopts = FitOptions(BFGSFit)
+    fitopts.set_from_cli(Opts)
+    assert fitopts.options['rounds'] == 50
+    assert fitopts.options['outer_steps'] == 100
+    driver = FitDriver(fitopts.fitclass, problem=problem, **fitopts.options)
+    fitter = driver._fitter()
+    assert isinstance(fitter, FastSlowFit)
+    x, fx = fitter.solve(monitors=[], **driver.options)
+    assert numpy.allclose(x, [0.2, 1.2, 3, 0.4], atol=1e-3), x
+    assert abs(fx - problem.nllf()) < 1e-10
+
+def _line(x, m, b): return m*x + b
+def _decay(x, A, k, B):
+    return A*numpy.exp(-k*x) + B
+def test_de():
+    from .curve import Curve
+    from .fitproblem import FitProblem
+    # DE keeps the better of the parents and trials in the history, so
+    # the population converges rather than drifting away.
+    numpy.random.seed(1)
+    x = numpy.linspace(0, 5, 21)
+    M = Curve(_decay, x, _decay(x, 2, 1.3, 0.7), 0.01,
+              A=(0, 5), k=(0, 5), B=(0, 2))
+    problem = FitProblem(M)
+    fitter = DEFit(problem)
+    x, fx = fitter.solve(monitors=[], **dict(DEFit.settings))
+    target = dict(A=2, k=1.3, B=0.7)
+    assert numpy.allclose(x, [target[p] for p in problem.labels()],
+                          atol=1e-4), x
+    assert fx < 1e-6
+def test_dream_history():
+    import os, shutil, tempfile
+    from .curve import Curve
+    from .fitproblem import FitProblem
+    from .dream.state import load_state
+    x = numpy.linspace(-1, 2, 7)
+    problem = FitProblem(Curve(_line, x, 2*x + 1, 0.1, m=(0, 4), b=(-5, 5)))
+    options = dict(DreamFit.settings)
+    options.update(steps=50, burn=10, history=8)
+    path = tempfile.mkdtemp()
+    try:
+        problem.output_path = os.path.join(path, 'fit')
+        # Only the window is kept in memory, with the chain on disk
+        fitter = DreamFit(problem)
+        fitter.solve(monitors=[], abort_test=lambda: False, **options)
+        assert fitter.state.Nthin == 8
+        # Saving finishes the stream rather than writing another copy
+        fitter.save(problem.output_path)
+        assert not any(f.endswith('.npy') for f in os.listdir(path))
+        loaded = load_state(problem.output_path)
+        Nthin = loaded.Nthin
+        assert Nthin > 8
+        assert numpy.all(loaded.chains()[2][-8:] == fitter.state.chains()[2])
+        # Resuming from the stream keeps the earlier generations on disk
+        resumed = DreamFit(problem)
+        resumed.load(problem.output_path)
+        options.update(steps=100)
+        resumed.solve(monitors=[], abort_test=lambda: False, **options)
+        resumed.save(problem.output_path)
+        assert resumed.state.Nthin == 8
+        assert load_state(problem.output_path).Nthin > Nthin
+    finally:
+        shutil.rmtree(path)
+def test_cov():
+    from .curve import Curve
+    from .fitproblem import FitProblem
+    x = numpy.linspace(-1, 2, 7)
+    dy = 0.1 + 0.05*x**2
+    problem = FitProblem(Curve(_line, x, 2*x + 1, dy, m=(0, 4), b=(-5, 5)))
+    J = numpy.vstack((1/dy, x/dy)).T
+    target = numpy.linalg.inv(numpy.dot(J.T, J))
+    batched = []
+    def mapper(points):
+        batched.append(len(points))
+        return problem.nllf_batch(points)
+    # The batched stencil is only used for a parallel mapper; the serial
+    # problem mapper leaves the Hessian to numdifftools when available.
+    for fit_mapper, parallel in ((None, False), (mapper, True)):
+        driver = FitDriver(BFGSFit, problem=problem, mapper=fit_mapper)
+        assert (driver._parallel_mapper() is not None) == parallel
+        driver.fitter = BFGSFit(problem)
+        driver.result = numpy.array([1., 2.]), 0.
+        assert numpy.allclose(driver.cov(), target, rtol=1e-5)
+        assert bool(batched) == parallel
+
+def test_levmar_constraints():
+    from .curve import Curve
+    from .fitproblem import FitProblem
+    x = numpy.linspace(-1, 2, 7)
+    y = 2*x + 1
+    M = Curve(_line, x, y, 0.1, m=(0, 4), b=(-5, 5))
+    k = 100.
+    constraints = lambda: k*max(M.m.value - 1.5, 0)**2
+    problem = FitProblem(M, constraints=constraints)
+    fitter = LevenbergMarquardtFit(problem)
+    xbest, fbest = fitter.solve(monitors=[], steps=100)
+    # The active constraint adds the residual sqrt(2k)(m-1.5), so the
+    # minimum is the linear least squares solution with one more row.
+    A = numpy.vstack((numpy.vstack((numpy.ones_like(x), x)).T/0.1,
+                      [0, numpy.sqrt(2*k)]))
+    rhs = numpy.hstack((y/0.1, 1.5*numpy.sqrt(2*k)))
+    target = numpy.linalg.lstsq(A, rhs, rcond=None)[0]
+    assert numpy.allclose(xbest, target, rtol=1e-6), (xbest, target)
+    J = fitter._jacobian(xbest, fitter._residuals(xbest))
+    assert numpy.allclose(J[-1], [0, numpy.sqrt(2*k)], rtol=1e-4)
+
+# Fitter for test_replicate_fits, at module level so that it can be sent
+# to the replicate processes.
+class _FailingFit(LevenbergMarquardtFit):
+    def solve(self, **kw):
+        if self.problem.getp()[0] < -4:
+            raise ValueError("bad start")
+        return LevenbergMarquardtFit.solve(self, **kw)
+
+def test_replicate_fits():
+    from .curve import Curve
+    from .fitproblem import FitProblem
+    x = numpy.linspace(-1, 2, 7)
+    y = 2*x + 1
+    problem = FitProblem(Curve(_line, x, y, 0.1, m=(0, 4), b=(-5, 5)))
+    x_init = problem.getp()
+    starts = [[0, 1], [-4.5, 3], [3, 0.5], [-1, 2]]
+    for cpus in (1, 2):
+        done = []
+        results = replicate_fits(_FailingFit(problem), starts, cpus=cpus,
+                                 callback=lambda k, x, fx: done.append(k),
+                                 monitors=[])
+        # The failed replicate is skipped and the others are kept in order
+        assert sorted(done) == [0, 2, 3]
+        assert results.shape == (3, 3)
+        assert numpy.allclose(results[:, 1:], [1, 2], atol=1e-6)
+        assert numpy.allclose(results[:, 0], 0, atol=1e-10)
+        assert numpy.all(problem.getp() == x_init)
+
+    # Resynthesized fits scatter about the minimum, leaving the data alone
+    class ResynthCurve(Curve):
+        def resynth_data(self):
+            self._y = self.y
+            self.y = self.y + self.dy*numpy.random.randn(*self.y.shape)
+        def restore_data(self):
+            self.y = self._y
+    M = ResynthCurve(_line, x, y, 0.1, m=(0, 4), b=(-5, 5))
+    problem = FitProblem(M)
+    numpy.random.seed(1)
+    results = replicate_fits(LevenbergMarquardtFit(problem), starts[:1]*20,
+                             resynth=True, monitors=[])
+    assert numpy.all(M.y == y)
+    assert len(set(results[:, 1])) == 20
+    assert numpy.allclose(results[:, 1:].mean(axis=0), [1, 2], atol=0.05)
+    # Replicates which cannot resynthesize or restore the data are
+    # reported and skipped rather than stopping the others
+    class RestoreFailsCurve(ResynthCurve):
+        def restore_data(self):
+            ResynthCurve.restore_data(self)
+            if self.fail.pop(0):
+                raise RuntimeError("cannot restore")
+    bad = RestoreFailsCurve(_line, x, y, 0.1, m=(0, 4), b=(-5, 5))
+    for cpus in (1, 2):
+        plain = FitProblem(Curve(_line, x, y, 0.1, m=(0, 4), b=(-5, 5)))
+        results = replicate_fits(LevenbergMarquardtFit(plain), starts,
+                                 resynth=True, cpus=cpus, monitors=[])
+        assert results.shape == (0, 3)
+    bad.fail = [False, True, False, False]
+    results = replicate_fits(LevenbergMarquardtFit(FitProblem(bad)), starts,
+                             resynth=True, monitors=[])
+    assert results.shape == (3, 3)
+    # Each resynth refit keeps the number of starts
+    fits = []
+    class CountingFit(LevenbergMarquardtFit):
+        def solve(self, **kw):
+            fits.append(1)
+            return LevenbergMarquardtFit.solve(self, **kw)
+    driver = FitDriver(CountingFit, problem=problem, monitors=[], starts=3)
+    assert driver.resynth(2).shape == (2, 3)
+    assert len(fits) == 6
+
+    # Multistart replicates are only run in parallel without keep_best
+    problem = FitProblem(Curve(_line, x, y, 0.1, m=(0, 4), b=(-5, 5)))
+    fitter = MultiStart(LevenbergMarquardtFit(problem))
+    class Mapper(object):
+        def __init__(self):
+            self.calls = []
+        def __call__(self, points):
+            return problem.nllf_batch(points)
+        def residuals(self, points):
+            self.calls.append(len(points))
+            return problem.residuals_batch(points)
+    for keep_best in (True, False):
+        mapper = Mapper()
+        calls = mapper.calls
+        xbest, fbest = fitter.solve(monitors=[], mapper=mapper, starts=3,
+                                    cpus=2, keep_best=keep_best)
+        assert numpy.allclose(xbest, [1, 2], atol=1e-6)
+        # The serial starts use the mapper, the replicate processes do not
+        assert bool(calls) == keep_best
@@ -40,7 +40,7 @@ After three updates we see that only two values are kept:
     >>> h.update(value=1,point=[1,0.5,1])
     >>> h.update(value=0.5,point=[1,0.5,0.9])
     >>> print(h.value)
-    Trace value: 0.5, 1
+    Trace value: 0.5, 1.0
     >>> print(len(h.value))
     2
 
@@ -63,6 +63,8 @@ For example:
     2
 """
 
+import numpy
+
 # Design questions:
 # 1. Can optimizer function evaluators add traces?  Can they use traces?
 # 2. Do we want to support a skip option on traces, so that only every nth
@@ -156,15 +158,20 @@ class History(object):
         traces = sorted(self._traces(), lambda x,y: cmp(x.name,y.name))
         return "\n".join(str(l) for l in traces)
 
-    def snapshot(self):
+    def snapshot(self, binary=False):
         """
         Return a dictionary of traces { 'name':  [v[n], v[n-1], ..., v[0]] }
+
+        If *binary* is True, each trace is a numpy array rather than a list,
+        suitable for saving with numpy.savez.
         """
-        return dict((trace.name,trace.snapshot()) for trace in self._traces())
+        return dict((trace.name,trace.snapshot(binary=binary))
+                    for trace in self._traces())
 
     def restore(self, state):
         """
-        Restore history to the state returned by a call to snapshot
+        Restore history to the state returned by a call to snapshot,
+        with either list or binary traces.
         """
         for k,v in state.items():
             try:
@@ -182,25 +189,32 @@ class Trace(object):
 
     len(trace) returns the number of items in the trace
     trace[i] returns the ith previous element in the history
+    trace.window(n) returns a view of the last n elements, most recent first
     trace.requires(n) says how much history to keep
     trace.put(value) stores value
+    trace.replace(value) replaces the most recent value
     trace.accumulate(value) adds value to the previous value before storing
-    state = trace.snapeshot() returns the values as a stack, most recent last
+    state = trace.snapshot() returns the values as a stack, most recent last
     trace.restore(state) restores a snapshot
 
     Note that snapshot/restore uses lists to represent numpy arrays, which may cause
-    problems if the trace is capturing lists.
+    problems if the trace is capturing lists.  Use snapshot(binary=True) to
+    capture the trace as a numpy array instead.
     """
     # Implementation note:
-    # Traces are stored in reverse order because append is faster than insert.
-    # This detail is hidden from the caller since __getitem__ returns the
-    # appropriate value.
-    # TODO: convert to circular buffer unless keeping the full trace
-    # TODO: use numpy arrays for history
+    # Traces are stored in a preallocated numpy array of 2*keep items,
+    # typed and shaped from the first value.  Each value is written twice,
+    # at index i and at index i+keep, so that the most recent n values
+    # always form a contiguous slice and window(n) can return a view.
+    # Values that are not numeric, or which change shape, are stored in
+    # an object array.  Numeric values are promoted to a wider type as
+    # needed, so an integer trace becomes a float trace when a float is put.
     def __init__(self, keep=1, name="trace"):
         self.keep = keep
-        self._storage = []
         self.name = name
+        self._storage = None
+        self._next = 0
+        self._count = 0
     def requires(self, n):
         """
         Set the trace length to be at least n.
@@ -208,59 +222,211 @@ class Trace(object):
         # Note: never shorten the trace, since another algorithm/condition/monitor
         # may still require the longer trace.
         if n > self.keep:
-            self.keep = n
+            if self._storage is not None:
+                self._reallocate(self._storage.dtype, self._storage.shape[1:],
+                                 keep=n)
+            else:
+                self.keep = n
     def accumulate(self, value):
         if self.keep < 1: return
-        try:
-            value = self._storage[-1] + value
-        except IndexError:
-            pass # Value is 0 + value => 0
+        if self._count > 0:
+            value = self[0] + value
         self.put(value)
     def put(self, value):
         """
-        Add an item to the trace, shifting off from the beginning
-        when the trace is full.
+        Add an item to the trace, dropping the oldest item when the trace
+        is full.
         """
         if self.keep < 1: return
-        if len(self._storage) == self.keep:
-            self._storage = self._storage[1:]
-        self._storage.append(value)
+        value = self._check_type(value)
+        storage, k = self._storage, self._next
+        storage[k] = storage[k+self.keep] = value
+        self._next = (k+1)%self.keep
+        if self._count < self.keep:
+            self._count += 1
+    def replace(self, value):
+        """
+        Replace the most recent item in the trace.
+
+        Use this rather than modifying trace[0] in place, since trace[i]
+        returns a copy of array values.
+        """
+        if self.keep < 1: return
+        if self._count == 0:
+            raise IndexError(self.name + " has not accumulated enough history")
+        value = self._check_type(value)
+        k = (self._next - 1)%self.keep
+        self._storage[k] = self._storage[k+self.keep] = value
+    def window(self, n=None):
+        """
+        Return the last *n* values as an array, with the most recent first.
+
+        The array is a view into the trace storage, so it is only valid
+        until the next put.  Default is all values in the trace.
+        """
+        if n is None:
+            n = self._count
+        elif n > self._count:
+            raise IndexError(self.name + " has not accumulated enough history")
+        if self._storage is None:
+            return numpy.empty(0)
+        end = self._next + self.keep
+        return self._storage[end-n:end][::-1]
+    def _check_type(self, value):
+        """
+        Make sure the storage can hold value, converting it if necessary.
+        """
+        if self._storage is None:
+            dtype, shape = _trace_type(value)
+            self._storage = numpy.empty((2*self.keep,)+shape, dtype)
+        dtype = self._storage.dtype
+        if dtype.char == 'O':
+            return value
+        dtype_v, shape_v = _trace_type(value)
+        if shape_v != self._storage.shape[1:] or dtype_v.char == 'O':
+            self._reallocate(numpy.dtype('O'), ())
+            return value
+        if not numpy.can_cast(dtype_v, dtype):
+            self._reallocate(numpy.promote_types(dtype_v, dtype),
+                             self._storage.shape[1:])
+        return value
+    def _reallocate(self, dtype, shape, keep=None):
+        values = list(reversed([self[i] for i in range(self._count)]))
+        if keep is not None:
+            self.keep = keep
+        self._storage = numpy.empty((2*self.keep,)+shape, dtype)
+        self._next = self._count = 0
+        for v in values[-self.keep:]:
+            self.put(v)
     def __len__(self):
-        return len(self._storage)
+        return self._count
     def __getitem__(self, key):
         if key < 0:
             raise IndexError(self.name
                              + " can only be accessed from the beginning")
-        try:
-            return self._storage[-key-1]
-        except IndexError:
+        if key >= self._count:
             raise IndexError(self.name + " has not accumulated enough history")
+        value = self._storage[self._next + self.keep - key - 1]
+        if isinstance(value, numpy.ndarray):
+            return value.copy()
+        elif isinstance(value, numpy.generic):
+            return value.item()
+        else:
+            return value
     def __setitem__(self, key, value):
         raise TypeError("cannot write directly to a trace; use put instead")
     def __str__(self):
         return ("Trace " + self.name + ": "
-                + ", ".join([str(k) for k in reversed(self._storage)]))
-    def snapshot(self):
+                + ", ".join([str(self[k]) for k in range(self._count)]))
+    def snapshot(self, binary=False):
         """
         Capture state of the trace.
 
-        Numpy arrays are converted to lists so that the trace can be easily converted to json.
+        Numpy arrays are converted to lists so that the trace can be easily
+        converted to json.  If *binary* is True, return the trace as a
+        numpy array instead, with the first axis indexing the values.
         """
-        import numpy
-        if isinstance(self._storage[0], numpy.ndarray):
-            return [v.tolist() for v in self._storage]
+        values = self.window()[::-1]
+        if binary:
+            return values.copy()
+        elif values.dtype.char == 'O':
+            return [v.tolist() if isinstance(v, numpy.ndarray) else v
+                    for v in values]
         else:
-            return self._storage[:]
+            return values.tolist()
     def restore(self, state):
         """
         Restore a trace from a captured snapshot.
 
         Lists are converted to numpy arrays.
         """
-        import numpy
+        self._storage = None
+        self._next = self._count = 0
+        if self.keep < 1 or len(state) == 0:
+            return
         if isinstance(state[0], list):
             state = [numpy.asarray(v) for v in state]
-        if len(state) > self.keep:
-            self._storage = state[-self.keep:]
-        else:
-            self._storage = state[:]
+        for v in state[-self.keep:]:
+            self.put(v)
+
+def _trace_type(value):
+    """
+    Return the dtype and shape for storing value in a trace.
+    """
+    if isinstance(value, numpy.ndarray):
+        array = value
+    elif isinstance(value, (int, float, complex, bool, numpy.generic, list)):
+        try:
+            array = numpy.asarray(value)
+        except ValueError:  # ragged list
+            return numpy.dtype('O'), ()
+    else:
+        return numpy.dtype('O'), ()
+    if array.dtype.kind not in 'biufc':
+        return numpy.dtype('O'), ()
+    return array.dtype, array.shape
+
+def test_trace():
+    # Wraparound keeps the most recent values, most recent first
+    t = Trace(keep=3, name='x')
+    for v in range(7):
+        t.put(v)
+    assert len(t) == 3 and [t[k] for k in range(3)] == [6, 5, 4]
+    assert t.window().tolist() == [6, 5, 4]
+    assert t.window(2).tolist() == [6, 5]
+    try:
+        t.window(4)
+    except IndexError:
+        pass
+    else:
+        raise AssertionError("expected IndexError for a long window")
+    # The window is a view which is only valid until the next put
+    w = t.window(3)
+    assert w.base is not None
+    t.put(7)
+    assert t.window().tolist() == [7, 6, 5]
+    # Values are promoted as needed, and accumulate adds to the last value
+    t.put(0.5)
+    t.accumulate(1)
+    assert t.window().tolist() == [1.5, 0.5, 7.0]
+    # Growing the trace keeps the history
+    t.requires(5)
+    t.put(2)
+    assert t.window().tolist() == [2, 1.5, 0.5, 7.0]
+
+    # Vector values and snapshots, as lists or as arrays
+    h = History()
+    h.provides(step=2, point=3, value=0)
+    for k in range(5):
+        h.update(step=k, point=numpy.array([k, -k], 'd'))
+    assert h.point.window().tolist() == [[4, -4], [3, -3], [2, -2]]
+    state = h.snapshot()
+    assert state['point'] == [[2, -2], [3, -3], [4, -4]]
+    assert state['step'] == [3, 4] and state['value'] == []
+    binary = h.snapshot(binary=True)
+    assert isinstance(binary['point'], numpy.ndarray)
+    assert binary['point'].shape == (3, 2)
+    for snapshot in (state, binary):
+        copy = History()
+        copy.provides(step=2, point=3, value=0)
+        copy.restore(snapshot)
+        assert copy.point.window().tolist() == h.point.window().tolist()
+        assert copy.step.window().tolist() == [4, 3]
+        assert isinstance(copy.point[0], numpy.ndarray)
+    # A binary snapshot is a copy rather than a view
+    binary['point'][:] = 0
+    assert h.point[0].tolist() == [4, -4]
+    # Array values are returned as copies, so the newest value is changed
+    # with replace, which keeps the window in step across wraparound
+    h.point[0][:] = 0
+    assert h.point[0].tolist() == [4, -4]
+    h.point.replace(numpy.array([5, -5], 'd'))
+    h.update(point=numpy.array([6, -6], 'd'))
+    assert h.point.window().tolist() == [[6, -6], [5, -5], [3, -3]]
+
+    # Values which change shape move the trace to object storage
+    t = Trace(keep=2, name='ragged')
+    t.put([1, 2])
+    t.put([1, 2, 3])
+    assert list(t[0]) == [1, 2, 3] and list(t[1]) == [1, 2]
+    assert t.snapshot() == [[1, 2], [1, 2, 3]]
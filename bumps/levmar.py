@@ -0,0 +1,250 @@
+# This program is public domain
+# Author: Paul Kienzle
+r"""
+Bounded Levenberg-Marquardt optimizer.
+
+The interface is through the :func:`levmar` function, which minimizes
+$\tfrac12 \lVert r(x) \rVert^2$ for a residuals function *r(x)* subject
+to box constraints $lo \le x \le hi$.
+
+Each iteration computes the Jacobian once, then solves the damped normal
+equations
+
+.. math::
+
+    (J^T J + \lambda D) s = -J^T r
+
+for trial steps $s$, adjusting the damping $\lambda$ according to the
+ratio of the actual to predicted reduction in cost as described by
+Nielsen (1999) [#Nielsen]_.  The scale $D$ is the running maximum of the
+diagonal of $J^T J$, as in MINPACK.
+
+Bounds are handled with an active set.  Parameters sitting on a bound
+whose gradient points out of the feasible region are held fixed for the
+step, and the trial point for the remaining parameters is projected back
+onto the box.  The predicted reduction uses the projected step, so the
+trust region adapts to steps truncated by the bounds.
+
+The Jacobian defaults to forward differences.  The perturbed points are
+formed up front and evaluated with a single call to *mapper*, which may
+evaluate them in parallel.  Points on the upper bound are perturbed
+downward so that the model is never evaluated outside the box.
+
+.. [#Nielsen] Nielsen, H. B. (1999). Damping parameter in Marquardt's
+    method.  Technical Report IMM-REP-1999-05, Technical University of
+    Denmark.
+"""
+from __future__ import division
+
+__all__ = ["levmar", "fdjac"]
+
+import numpy
+from numpy import (asarray, clip, dot, sqrt, inf, diag, zeros, maximum,
+                   isfinite, finfo)
+from numpy.linalg import norm, solve, LinAlgError
+
+STATUS = {
+    1: "Relative reduction in cost < ftol",
+    2: "Relative step size < xtol",
+    3: "Projected gradient < gtol",
+    4: "Iterations exceeded",
+    5: "User abort",
+    6: "Damping too large; no further improvement possible",
+    }
+
+_EPS = finfo('d').eps
+
+def levmar(fn, x0, bounds=None, jac=None, mapper=None,
+           steps=1000, ftol=1.5e-8, xtol=1.5e-8, gtol=0.,
+           abort_test=None, monitor=lambda **kw: True):
+    r"""
+    Run a bounded Levenberg-Marquardt minimization of $\tfrac12 |r(x)|^2$.
+
+    *fn(x)* returns the residuals vector at x.
+
+    *x0* is the initial point.  It is moved within *bounds* if necessary.
+
+    *bounds* is the pair of vectors (lo, hi), which may be infinite.
+    Default: None, which is unbounded.
+
+    *jac(x, r)* returns the Jacobian $J_{ij} = \partial r_i/\partial x_j$
+    at x, with residuals r already computed at x.  Default: None, which uses
+    :func:`fdjac` with *mapper*.
+
+    *mapper(points)* returns the residuals vector for each point.  This is
+    used for the finite difference Jacobian.  Default: None, which calls
+    fn for each point in turn.
+
+    *steps* is the maximum number of Jacobian evaluations.  Default: 1000
+
+    *ftol* stops the fit when the actual and predicted relative reduction
+    in cost are both below ftol.  Default: 1.5e-8
+
+    *xtol* stops the fit when the relative size of the scaled step is
+    below xtol.  Default: 1.5e-8
+
+    *gtol* stops the fit when the largest projected gradient is no more
+    than gtol.  Default: 0
+
+    *abort_test()* returns True if the user has requested abort.
+
+    *monitor(step,x,fx,evals)* is called after each accepted step, with
+    *evals* the number of residuals evaluations used so far.  Return False
+    to stop the fit.  Default: lambda **kw: True
+
+    Returns the fit result as a dictionary:
+
+    *status* is a status code indicating why the fit terminated.  Turn the
+    status code into a string with *STATUS[result.status]*.
+
+    *x* is the minimum point and *fx* is the cost $\tfrac12 |r(x)|^2$
+
+    *r* is the residuals vector at x
+
+    *J* is the Jacobian at x, which can be used for the covariance
+
+    *iterations* is the number of Jacobian evaluations
+
+    *evals* is the number of residuals evaluations, including those for
+    the finite difference Jacobians, with each call to a user supplied
+    *jac* counted as one evaluation
+    """
+    x0 = asarray(x0, 'd')
+    n = len(x0)
+    if bounds is None:
+        lo, hi = -inf*numpy.ones(n), inf*numpy.ones(n)
+    else:
+        lo, hi = (asarray(v, 'd') for v in bounds)
+    if mapper is None:
+        mapper = lambda points: [fn(p) for p in points]
+    if jac is None:
+        def jac(x, r):
+            return fdjac(mapper, x, r, bounds=(lo, hi))
+        jac_evals = n
+    else:
+        jac_evals = 1
+
+    x = clip(x0, lo, hi)
+    r = asarray(fn(x), 'd').flatten()
+    cost = 0.5*dot(r, r)
+    evals = 1
+    J = asarray(jac(x, r), 'd')
+    evals += jac_evals
+    iterations = 1
+    g = dot(J.T, r)
+    JTJ = dot(J.T, J)
+    D = diag(JTJ).copy()
+    D[D == 0] = 1
+    lam, nu = 1e-3, 2
+
+    status = 0
+    while status == 0:
+        # Projected gradient test, treating bounds as active.
+        pg = x - clip(x - g, lo, hi)
+        if norm(pg, inf) <= gtol:
+            status = 3
+            break
+
+        # Hold parameters on a bound fixed if the gradient points outward.
+        free = ~(((x <= lo) & (g > 0)) | ((x >= hi) & (g < 0)))
+        s = zeros(n)
+        A = JTJ[free][:, free] + lam*diag(D[free])
+        try:
+            s[free] = solve(A, -g[free])
+        except LinAlgError:
+            s[free] = -g[free]/diag(A)
+        xt = clip(x + s, lo, hi)
+        s = xt - x
+
+        # Predicted reduction from the linear model: cost - |r + J s|^2/2
+        pred = -(dot(g, s) + 0.5*dot(s, dot(JTJ, s)))
+        rt = asarray(fn(xt), 'd').flatten()
+        evals += 1
+        cost_t = 0.5*dot(rt, rt)
+        actual = cost - cost_t if isfinite(cost_t) else -inf
+        rho = actual/pred if pred > 0 else -1.
+
+        if rho > 1e-4:
+            x, r, cost = xt, rt, cost_t
+            lam *= max(1./3, 1 - (2*rho - 1)**3)
+            nu = 2
+            J = asarray(jac(x, r), 'd')
+            evals += jac_evals
+            iterations += 1
+            g = dot(J.T, r)
+            JTJ = dot(J.T, J)
+            D = maximum(D, diag(JTJ))
+            if not monitor(step=iterations, x=x, fx=cost, evals=evals):
+                status = 5
+        else:
+            lam *= nu
+            nu *= 2
+
+        # Stopping conditions
+        sD = sqrt(D)
+        if status != 0:
+            pass
+        elif abs(actual) <= ftol*cost and pred <= ftol*cost and rho <= 2:
+            status = 1
+        elif norm(sD*s) <= xtol*(norm(sD*x) + xtol):
+            status = 2
+        elif abort_test is not None and abort_test():
+            status = 5
+        elif iterations >= steps:
+            status = 4
+        elif lam > 1e16:
+            status = 6
+
+    return dict(status=status, x=x, fx=cost, r=r, J=J,
+                iterations=iterations, evals=evals)
+
+def fdjac(mapper, x, r, bounds=None, step=None):
+    r"""
+    Forward difference Jacobian of the residuals at x.
+
+    *mapper(points)* returns the residuals vector for each point, and is
+    called once with all n perturbed points.  *r* is the residuals vector
+    at x.  *step* is the relative step size, which defaults to
+    $\sqrt\epsilon$.  Steps which would go above the upper bound in
+    *bounds* are taken downward instead.
+    """
+    x = asarray(x, 'd')
+    if step is None: step = sqrt(_EPS)
+    h = step*abs(x)
+    h[h == 0] = step
+    if bounds is not None:
+        h[x + h > bounds[1]] *= -1
+    h = (x + h) - x
+    points = x + diag(h)
+    rp = asarray(mapper(points), 'd').reshape(len(x), -1)
+    return ((rp - asarray(r, 'd').flatten()[None, :])/h[:, None]).T
+
+def test():
+    from numpy import exp, linspace, allclose
+    t = linspace(0, 3, 30)
+    model = lambda p: p[0]*exp(-p[1]*t) + p[2]
+    y = model([2., 1.3, 0.7])
+    fn = lambda p: model(p) - y
+
+    # unbounded fit recovers the parameters
+    result = levmar(fn, [1., 1., 0.])
+    assert result['status'] in (1, 2, 3), STATUS.get(result['status'])
+    assert allclose(result['x'], [2., 1.3, 0.7], rtol=1e-5)
+
+    # the final Jacobian is available for the covariance
+    J = fdjac(lambda P: [fn(p) for p in P], result['x'], result['r'])
+    assert allclose(result['J'], J)
+
+    # bounded fit stops at the bound and never leaves the box
+    seen = []
+    def bounded_fn(p):
+        seen.append(p)
+        return fn(p)
+    bounds = ([0, 0, 0.8], [10, 10, 2])
+    result = levmar(bounded_fn, [1., 1., 1.], bounds=bounds)
+    assert abs(result['x'][2] - 0.8) < 1e-12
+    seen = numpy.array(seen)
+    assert (seen >= bounds[0]).all() and (seen <= bounds[1]).all()
+
+if __name__ == "__main__":
+    test()
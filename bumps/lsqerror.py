@@ -6,23 +6,30 @@ is differentiable at the minimum, the parameter uncertainty can be estimated
 from the covariance matrix at the minimum.  The model and data are wrapped in
 a problem object, which must define the following methods:
 
-    ============== =================================================
-    getp()         get the current value of the model
-    setp(p)        set a new value in the model
-    nllf(p)        negative log likelihood function
-    residuals(p)   residuals around its current value
-    bounds()       get the bounds on the parameter p     [optional]
-    ============== =================================================
+    ================== =================================================
+    getp()             get the current value of the model
+    setp(p)            set a new value in the model
+    nllf(p)            negative log likelihood function
+    residuals()        residuals around its current value
+    bounds()           get the bounds on the parameter p     [optional]
+    nllf_batch(P)      nllf for each point in population P   [optional]
+    residuals_batch(P) residuals for each point in P         [optional]
+    residuals_deriv()  analytic Jacobian of the residuals    [optional]
+    ================== =================================================
 
 :func:`jacobian` computes the Jacobian matrix $J$ using numerical
 differentiation on residuals. Derivatives are computed using the center
-point formula, with two evaluations per dimension.  If the problem has
-analytic derivatives with respect to the fitting parameters available,
-then these should be used to compute the Jacobian instead.
+point formula, with two evaluations per dimension.  The perturbed points
+are generated up front and evaluated as a single batch, which can be
+spread across processors using a mapper.  If the problem has
+analytic derivatives with respect to the fitting parameters available
+through *residuals_deriv*, then these are used instead.
 
 :func:`hessian` computes the Hessian matrix $H$ using numerical
 differentiation on nllf.  This uses the center point formula, with
-two evaluations for each (i,j) combination.
+four evaluations for each (i,j) combination, two for each diagonal
+element, and one for the center point.  As with the Jacobian, the
+evaluations are done as a batch.
 
 :func:`cov` takes the Jacobian and computes the covariance matrix $C$.
 
@@ -49,130 +56,190 @@ estimate step size.
 import numpy
 
 
-def jacobian(problem, p=None, step=None):
+def jacobian(problem, p=None, step=None, mapper=None):
     """
     Returns the derivative wrt the fit parameters at point p.
 
     Numeric derivatives are calculated based on step, where step is
     the portion of the total range for parameter j, or the portion of
     point value p_j if the range on parameter j is infinite.
+
+    All the perturbed points are evaluated as one batch.  If *mapper*
+    provides a *residuals(points)* method, such as the mappers returned
+    by :class:`mapper.MPMapper` and :class:`mapper.SharedMapper`, then
+    the residuals are computed in parallel.  Otherwise they are computed
+    one after the other with *problem.residuals_batch*.
+
+    If the problem provides analytic derivatives with *residuals_deriv()*,
+    then these are used and no perturbed points are evaluated.
     """
     p_init = problem.getp()
     if p is None: p = p_init
-    p = numpy.asarray(p)
-    try:
-        import numdifftools as nd
-        J = nd.Jacobian(problem.residuals)(p)
-    except ImportError:
+    p = numpy.asarray(p, 'd')
+    J = _analytic_jacobian(problem, p)
+    if J is None:
         bounds = getattr(problem, 'bounds', lambda: None)()
-        J = _simple_jacobian(problem.residuals, p, step=step, bounds=bounds)
+        J = _simple_jacobian(_residuals_mapper(problem, mapper), p,
+                             step=step, bounds=bounds)
     problem.setp(p_init)
     return J
 
-def hessian(problem, p=None, step=None):
+def _analytic_jacobian(problem, p):
+    deriv = getattr(problem, 'residuals_deriv', None)
+    if deriv is None:
+        return None
+    problem.setp(p)
+    try:
+        return numpy.asarray(deriv(), 'd')
+    except NotImplementedError:
+        return None
+
+def hessian(problem, p=None, step=None, mapper=None):
     """
     Returns the derivative wrt to the fit parameters at point p.
+
+    If *mapper* is given, the nllf for the complete set of perturbed
+    points is evaluated as one batch using the mapper, which may evaluate
+    them in parallel.  Otherwise the numdifftools library is used if it
+    is available, or the batch is evaluated with *problem.nllf_batch*.
     """
     p_init = problem.getp()
     if p is None: p = p_init
-    p = numpy.asarray(p)
-    try:
-        import numdifftools as nd
+    p = numpy.asarray(p, 'd')
+    bounds = getattr(problem, 'bounds', lambda: None)()
+    nd = _numdifftools() if mapper is None else None
+    if nd is not None:
         H = nd.Hessian(problem.nllf)(p)
-        #bounds = getattr(problem, 'bounds', lambda: None)()
-        #H2 = _simple_hessian(problem.nllf, p, step=step, bounds=bounds)
-        #print(H-H2)
-    except:
-        bounds = getattr(problem, 'bounds', lambda: None)()
-        H = _simple_hessian(problem.nllf, p, step=step, bounds=bounds)
-        raise NotImplementedError("install the numdifftools library or fix _simple_hessian so it gives good enough results")
+    else:
+        H = _simple_hessian(_nllf_mapper(problem, mapper), p,
+                            step=step, bounds=bounds)
     problem.setp(p_init)
     return H
 
-def hessian_diag(problem, p=None, step=None):
+def hessian_diag(problem, p=None, step=None, mapper=None):
     """
     Returns the derivative wrt to the fit parameters at point p.
+
+    See :func:`hessian` for details.
     """
     p_init = problem.getp()
     if p is None: p = p_init
-    p = numpy.asarray(p)
-    try:
-        import numdifftools as nd
+    p = numpy.asarray(p, 'd')
+    bounds = getattr(problem, 'bounds', lambda: None)()
+    nd = _numdifftools() if mapper is None else None
+    if nd is not None:
         H = nd.Hessdiag(problem.nllf)(p)
-        #bounds = getattr(problem, 'bounds', lambda: None)()
-        #H2 = _simple_hessian(problem.nllf, p, step=step, bounds=bounds)
-        #print(H-H2)
-    except:
-        bounds = getattr(problem, 'bounds', lambda: None)()
-        H = _simple_hdiag(problem.nllf, p, step=step, bounds=bounds)
-        raise NotImplementedError("install the numdifftools library or fix _simple_hessian so it gives good enough results")
+    else:
+        H = _simple_hdiag(_nllf_mapper(problem, mapper), p,
+                          step=step, bounds=bounds)
     problem.setp(p_init)
     return H
 
+def _numdifftools():
+    try:
+        import numdifftools as nd
+    except ImportError:
+        nd = None
+    return nd
+
+def _nllf_mapper(problem, mapper):
+    if mapper is None:
+        mapper = getattr(problem, 'nllf_batch', None)
+    if mapper is None:
+        mapper = lambda points: [problem.nllf(p) for p in points]
+    return lambda points: numpy.asarray(mapper(points), 'd')
+
+def _residuals_mapper(problem, mapper):
+    mapper = getattr(mapper, 'residuals', None)
+    if mapper is None:
+        mapper = getattr(problem, 'residuals_batch', None)
+    if mapper is None:
+        def mapper(points):
+            result = []
+            for p in points:
+                problem.setp(p)
+                result.append(problem.residuals())
+            return result
+    return lambda points: numpy.asarray(mapper(points), 'd')
+
+# Note: The numerical derivatives below build the full stencil of perturbed
+# points up front and evaluate it with a single call to the mapper, *fn*,
+# which takes an array of points and returns a value (or for the Jacobian,
+# a residuals vector) for each point.  The mapper may evaluate the points in
+# parallel.  We are not checking that the varied parameter in numeric
+# differentiation is indeed feasible in the interval of interest.
+
+# Relative step size for second derivatives.  Roughly eps**(1/4), which
+# balances truncation error against rounding error in the center
+# point formula.
+_HESSIAN_STEP = 1e-4
+
 def _simple_jacobian(fn, p, step=None, bounds=None):
-    # We are being lazy here.  We can precompute the bounds, we can
-    # use the residuals_deriv from the sub-models which have analytic
-    # derivatives and we need only recompute the models which depend
-    # on the varying parameters.
-    # Meanwhile, let's compute the numeric derivative using the
-    # three point formula.
-    # We are not checking that the varied parameter in numeric
-    # differentiation is indeed feasible in the interval of interest.
-    # Gather the residuals
-    d = _delta(p, bounds, step)
-    r = []
-    for k,v in enumerate(p):
-        # Center point formula:
-        #     df/dv = lim_{h->0} ( f(v+h)-f(v-h) ) / ( 2h )
-        h = d[k]
-        p[k] = v + h
-        rk = fn(p)
-        p[k] = v - h
-        rk -= fn(p)
-        r.append(rk/(2*h))
-        p[k] = v
-    # return the jacobian
-    return numpy.vstack(r).T
+    # Center point formula:
+    #     df/dv = lim_{h->0} ( f(v+h)-f(v-h) ) / ( 2h )
+    n = len(p)
+    h = _delta(p, bounds, step)
+    points = numpy.vstack((p + numpy.diag(h), p - numpy.diag(h)))
+    r = fn(points)
+    return ((r[:n] - r[n:]) / (2*h)[:, None]).T
 
 def _simple_hessian(fn, p, step=None, bounds=None):
-    Hdiag = _simple_hdiag(fn, p, step, bounds)
-    H = _simple_hoff(fn, p, step, bounds)
-    for i,vi in enumerate(Hdiag): H[i,i] = vi
+    # Evaluate the diagonal and off-diagonal stencils as one batch, sharing
+    # the center point.
+    n = len(p)
+    h = _delta(p, bounds, _HESSIAN_STEP if step is None else step)
+    diag, fdiag = _hdiag_stencil(p, h)
+    off, foff = _hoff_stencil(p, h)
+    f = fn(numpy.vstack((diag, off)))
+    H = foff(f[len(diag):])
+    H[numpy.arange(n), numpy.arange(n)] = fdiag(f[:len(diag)])
     return H
 
 def _simple_hdiag(fn, p, step=None, bounds=None):
+    h = _delta(p, bounds, _HESSIAN_STEP if step is None else step)
+    points, fdiag = _hdiag_stencil(p, h)
+    return fdiag(fn(points))
+
+def _hdiag_stencil(p, h):
+    """
+    Return the points for the diagonal of the Hessian, and a function to
+    compute the diagonal from the values at those points.
+    """
     # center point formula
-    h = _delta(p, bounds, step)
-    Hdiag = numpy.empty(len(p),'d')
-    f = fn(p)
-    for i,vi in enumerate(p):
-        hi = h[i]
-        p[i] = vi + hi
-        ri_plus = fn(p)-f
-        p[i] = vi - hi
-        ri_minus = fn(p)-f
-        #print("%s + %s"%(ri_plus,ri_minus))
-        Hdiag[i] = (ri_plus+ri_minus)/(hi*hi)
-    return Hdiag
+    #     d2f/dv2 = ( f(v+h) - 2f(v) + f(v-h) ) / h^2
+    n = len(p)
+    points = numpy.vstack((p, p + numpy.diag(h), p - numpy.diag(h)))
+    def hdiag(f):
+        f0, fplus, fminus = f[0], f[1:n+1], f[n+1:]
+        return ((fplus-f0) + (fminus-f0))/(h*h)
+    return points, hdiag
+
+def _hoff_stencil(p, h):
+    """
+    Return the points for the off-diagonal elements of the Hessian, and
+    a function to compute the Hessian from the values at those points.
+    """
+    # center point formula
+    #     d2f/dvidvj = ( f(+,+) + f(-,-) - f(-,+) - f(+,-) ) / ( 4 hi hj )
+    n = len(p)
+    i, j = numpy.tril_indices(n, -1)
+    m = len(i)
+    points = numpy.tile(p, (4*m, 1))
+    for k, (si, sj) in enumerate(((1, 1), (-1, -1), (-1, 1), (1, -1))):
+        rows = numpy.arange(k*m, (k+1)*m)
+        points[rows, i] += si*h[i]
+        points[rows, j] += sj*h[j]
+    def hoff(f):
+        fpp, fmm, fmp, fpm = f[:m], f[m:2*m], f[2*m:3*m], f[3*m:]
+        H = numpy.zeros((n, n), 'd')
+        H[i, j] = H[j, i] = (fpp + fmm - fmp - fpm) / (4*h[i]*h[j])
+        return H
+    return points, hoff
 
 def _simple_hoff(fn, p, step=None, bounds=None):
-    # center point formula
-    h = _delta(p, bounds, step)
-    H = numpy.empty([len(p),len(p)], 'd')
-    for i,vi in enumerate(p):
-        hi = h[i]
-        for j,vj in enumerate(p[:i]):
-            hj = h[j]
-            p[i], p[j] = vi+hi, vj+hj
-            rij = fn(p)
-            p[i], p[j] = vi-hi, vj-hj
-            rij += fn(p)
-            p[i], p[j] = vi-hi, vj+hj
-            rij -= fn(p)
-            p[i], p[j] = vi+hi, vj-hj
-            rij -= fn(p)
-            H[j,i] = H[i,j] = rij / (4*hi*hj)
-    return H
+    h = _delta(p, bounds, _HESSIAN_STEP if step is None else step)
+    points, hoff = _hoff_stencil(p, h)
+    return hoff(fn(points))
 
 
 def _delta(p, bounds, step):
@@ -250,8 +317,8 @@ def corr(C):
     Uses $R = D^{-1} C D^{-1}$ where $D$ is the square root of the diagonal
     of the covariance matrix, or the standard error of each variable.
     """
-    Dinv = 1./stderr(cov)
-    return numpy.dot(Dinv, numpy.dot(cov, Dinv))
+    Dinv = 1./stderr(C)
+    return C * Dinv[:, None] * Dinv[None, :]
 
 def max_correlation(Rsq):
     """
@@ -279,3 +346,31 @@ def stderr(C):
     correction, whereas scipy.optimize.leastsq never does.
     """
     return numpy.sqrt(numpy.diag(C))
+
+def _line(x, m, b): return m*x + b
+def test_hessian():
+    from .curve import Curve
+    from .fitproblem import FitProblem
+    x = numpy.linspace(-1, 2, 7)
+    dy = 0.1 + 0.05*x**2
+    M = Curve(_line, x, 2*x + 1, dy, m=(0, 4), b=(-5, 5))
+    problem = FitProblem(M)
+    p = numpy.array([1.5, 2.5])
+    # nllf is quadratic in (b, m) with Hessian J^T J
+    J = numpy.vstack((1/dy, x/dy)).T
+    target = numpy.dot(J.T, J)
+
+    batched = []
+    def mapper(points):
+        batched.append(len(points))
+        return problem.nllf_batch(points)
+    H_batch = hessian(problem, p, mapper=mapper)
+    assert batched and all(n > 1 for n in batched)
+    assert numpy.allclose(H_batch, target, rtol=1e-6)
+    assert numpy.allclose(hessian_diag(problem, p, mapper=mapper),
+                          numpy.diag(target), rtol=1e-6)
+    if _numdifftools() is not None:
+        H_nd = hessian(problem, p)
+        assert numpy.allclose(H_nd, target, rtol=1e-6)
+        assert numpy.allclose(H_nd, H_batch, rtol=1e-6)
+    assert numpy.all(problem.getp() == [0, 2])
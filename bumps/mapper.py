@@ -41,7 +41,7 @@ class SerialMapper(object):
         pass
     @staticmethod
     def start_mapper(problem, modelargs):
-        return lambda points: map(problem.nllf, points)
+        return problem.nllf_batch
     @staticmethod
     def stop_mapper(mapper):
         pass
@@ -56,7 +56,25 @@ def _MP_set_problem(problem):
 def _MP_run_problem(point):
     global _problem
     return _problem.nllf(point)
-    
+def _MP_run_residuals(point):
+    global _problem
+    _problem.setp(point)
+    return _problem.residuals()
+
+class _MPMap(object):
+    """
+    Map points to nllf values using the multiprocessing pool.
+
+    *mapper.residuals(points)* returns the residual vector for each point.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+    def __call__(self, points):
+        return self.pool.map(_MP_run_problem, points)
+    def residuals(self, points):
+        import numpy
+        return numpy.array(self.pool.map(_MP_run_residuals, points))
+
 class MPMapper(object):
     pool = None
     
@@ -73,13 +91,256 @@ class MPMapper(object):
             MPMapper.pool.terminate()
         #MPMapper.pool = multiprocessing.Pool(cpus,_MP_load_problem,modelargs)
         MPMapper.pool = multiprocessing.Pool(cpus,_MP_set_problem, (problem,))
-        mapper = lambda points: MPMapper.pool.map(_MP_run_problem, points)
+        mapper = _MPMap(MPMapper.pool)
         return mapper
         
     @staticmethod
     def stop_mapper(mapper):
         pass
 
+def _SM_worker(conn, problem, counter, points, results):
+    """
+    Shared memory worker loop.
+
+    The problem is given to the worker when it is created, so on systems
+    which fork it is inherited rather than pickled.  This allows problems
+    defined in a model script, whose functions cannot be imported by the
+    worker, to be evaluated in parallel.
+
+    The population is read from the shared *points* buffer and the costs
+    (or other per point results, such as residual vectors) are written to
+    the shared *results* buffer.  Only the size of the population is sent
+    through *conn*.  Workers pull chunks of the population by incrementing
+    the shared *counter* until the population is exhausted, then report
+    the number of points they evaluated and the time it took.
+    """
+    import time
+    import traceback
+    import numpy
+    nice()
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        npoints, nvar, chunk, method, width = request
+        try:
+            X = numpy.frombuffer(points, 'd', npoints*nvar).reshape(npoints, nvar)
+            R = numpy.frombuffer(results, 'd', npoints*width).reshape(npoints, width)
+            fn = getattr(problem, method)
+            count, t0 = 0, time.time()
+            while True:
+                with counter.get_lock():
+                    start = counter.value
+                    counter.value = start + chunk
+                if start >= npoints:
+                    break
+                stop = min(start + chunk, npoints)
+                R[start:stop] = numpy.reshape(fn(X[start:stop]), (stop-start, width))
+                count += stop - start
+            conn.send((count, time.time() - t0))
+        except KeyboardInterrupt:
+            raise
+        except:
+            conn.send((-1, traceback.format_exc()))
+
+class _SharedPool(object):
+    """
+    Process pool with shared memory buffers for the population and costs.
+
+    The worker processes are started when the problem is set, and are
+    reused for every population evaluated for that problem.  Setting a
+    new problem restarts the workers.
+    """
+    # Target time per chunk.  Chunks are small enough to balance the load
+    # across the workers but large enough that the per chunk overhead
+    # is small compared to the evaluation time.
+    chunk_time = 0.01
+
+    def __init__(self, cpus=None, capacity=0):
+        import multiprocessing
+        if cpus is None:
+            cpus = multiprocessing.cpu_count()
+        self.cpus = cpus
+        self._problem = None
+        self._eval_time = None
+        # Leave room for a reasonable population so that we don't
+        # restart the pool for every small increase.
+        self._capacity = max(capacity, 4096)
+        self._pipes = []
+        self._processes = []
+
+    def _start(self, capacity):
+        import multiprocessing
+        self._capacity = capacity
+        self._counter = multiprocessing.Value('l', 0)
+        self._points = multiprocessing.RawArray('d', capacity)
+        self._results = multiprocessing.RawArray('d', capacity)
+        self._pipes = []
+        self._processes = []
+        for _ in range(self.cpus):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_SM_worker,
+                args=(child, self._problem,
+                      self._counter, self._points, self._results))
+            process.daemon = True
+            process.start()
+            self._pipes.append(parent)
+            self._processes.append(process)
+
+    def alive(self):
+        """
+        Return True if all the worker processes are running.
+        """
+        return bool(self._processes) and all(p.is_alive()
+                                              for p in self._processes)
+
+    def restart(self):
+        """
+        Replace the workers, keeping the buffers at their current size.
+        """
+        self.close()
+        self._start(self._capacity)
+
+    def close(self):
+        for conn in self._pipes:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for process in self._processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self._pipes, self._processes = [], []
+
+    def set_problem(self, problem):
+        self._problem = problem
+        self._nresiduals = None
+        self._eval_time = None
+        self.restart()
+
+    def _chunk_size(self, npoints):
+        # Until we know how long an evaluation takes, split the population
+        # into a few chunks per worker.
+        most = max(1, -(-npoints//self.cpus))
+        if self._eval_time is None:
+            return max(1, most//4)
+        best = int(self.chunk_time/self._eval_time) if self._eval_time > 0 else most
+        return min(max(best, 1), most)
+
+    def map(self, points, method='nllf_batch', width=1):
+        """
+        Evaluate *method* for each point in the population, returning one
+        value per point, or a row of *width* values per point if width > 1.
+
+        Raises RuntimeError if the evaluation fails in any of the workers.
+        If a worker process dies, the points it was evaluating are lost,
+        so the workers are restarted before the error is raised.
+        """
+        import numpy
+        points = numpy.ascontiguousarray(points, 'd')
+        if points.ndim == 1:
+            points = points[None, :]
+        npoints, nvar = points.shape
+        size = npoints*max(nvar, width)
+        if size > self._capacity:
+            self.close()
+            self._start(2*size)
+        X = numpy.frombuffer(self._points, 'd', npoints*nvar)
+        X[:] = points.flat
+        self._counter.value = 0
+        chunk = self._chunk_size(npoints)
+        # Collect every reply before reporting a failure, otherwise the
+        # unread replies would be taken as the results of the next map.
+        replies, lost = [], []
+        for k, conn in enumerate(self._pipes):
+            try:
+                conn.send((npoints, nvar, chunk, method, width))
+            except (EOFError, IOError, OSError):
+                lost.append(k)
+        for k, conn in enumerate(self._pipes):
+            if k in lost:
+                continue
+            try:
+                replies.append(conn.recv())
+            except (EOFError, IOError, OSError):
+                lost.append(k)
+        if lost:
+            k = lost[0]
+            process = self._processes[k]
+            process.join(1)
+            message = ("worker %d (pid %s) stopped with exit code %s"
+                       % (k, process.pid, process.exitcode))
+            self.restart()
+            raise RuntimeError(message)
+        errors = [elapsed for count, elapsed in replies if count < 0]
+        if errors:
+            raise RuntimeError("worker failed\n"+errors[0])
+        busy = sum(elapsed for _, elapsed in replies)
+        # Running estimate of the time per evaluation across the workers.
+        t = busy/npoints
+        self._eval_time = t if self._eval_time is None else 0.5*(self._eval_time + t)
+        result = numpy.frombuffer(self._results, 'd', npoints*width).copy()
+        return result.reshape(npoints, width) if width > 1 else result
+
+    def residuals(self, points):
+        """
+        Return the residual vector for each point in the population.
+        """
+        if self._nresiduals is None:
+            self._nresiduals = len(self._problem.residuals())
+        result = self.map(points, method='residuals_batch',
+                          width=self._nresiduals)
+        return result.reshape(-1, self._nresiduals)
+
+class _SharedMap(object):
+    """
+    Map points to nllf values using the shared memory pool.
+
+    *mapper.residuals(points)* returns the residual vector for each point.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+    def __call__(self, points):
+        return self.pool.map(points)
+    def residuals(self, points):
+        return self.pool.residuals(points)
+
+class SharedMapper(object):
+    """
+    Multiprocessing mapper using shared memory.
+
+    Like :class:`MPMapper`, the worker processes are started with the
+    problem for each fit.  Points and costs are exchanged through shared
+    memory buffers rather than being pickled, and the size of the chunk
+    handed to each worker adapts to the measured evaluation time.
+    """
+    pool = None
+
+    @staticmethod
+    def start_worker(problem):
+        pass
+
+    @staticmethod
+    def start_mapper(problem, modelargs, cpus=None):
+        pool = SharedMapper.pool
+        if pool is not None and cpus is not None and cpus != pool.cpus:
+            pool.close()
+            pool = None
+        if pool is None:
+            import atexit
+            pool = SharedMapper.pool = _SharedPool(cpus)
+            atexit.register(pool.close)
+        pool.set_problem(problem)
+        return _SharedMap(pool)
+
+    @staticmethod
+    def stop_mapper(mapper):
+        # Workers are replaced when the next fit starts, and shut down
+        # when the program exits.
+        pass
+
 def _MPI_set_problem(comm, problem, root=0):
     global _problem
     _problem = comm.bcast(problem)
@@ -204,3 +465,94 @@ class AMQPMapper(object):
         for pipe in mapper.pipes:
             pipe.terminate()
 
+
+class _SquareProblem(object):
+    # Problem for the shared mapper tests.  Points with a negative first
+    # coordinate stop the worker process.
+    def __init__(self, fail=False):
+        self.fail = fail
+    def nllf_batch(self, points):
+        import numpy
+        if self.fail:
+            raise ValueError("bad point")
+        if (points[:, 0] < 0).any():
+            os._exit(3)
+        return numpy.sum(points**2, axis=1)
+
+_SM_MODEL = """
+import numpy
+from bumps.curve import Curve
+from bumps.fitproblem import FitProblem
+def line(x, m, b):
+    return m*x + b
+x = numpy.linspace(0, 1, 5)
+problem = FitProblem(Curve(line, x, 2*x + 1, 0.1, m=(0, 4), b=(0, 4)))
+"""
+
+def test_shared_mapper():
+    import numpy
+    import tempfile
+    from .fitproblem import load_problem
+    points = numpy.arange(60.).reshape(20, 3)
+    expected = numpy.sum(points**2, axis=1)
+
+    pool = _SharedPool(cpus=2)
+    try:
+        # A failure in one worker is reported only after every reply is
+        # read, so the next map is not out of step.
+        pool.set_problem(_SquareProblem(fail=True))
+        try:
+            pool.map(points)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("worker failure was not reported")
+        pool.set_problem(_SquareProblem())
+        assert numpy.allclose(pool.map(points), expected)
+
+        # A worker which dies during a map is named in the error, and the
+        # pool is restarted for the next map.
+        bad = points.copy()
+        bad[-1, 0] = -1
+        try:
+            pool.map(bad)
+        except RuntimeError as exc:
+            assert "worker" in str(exc) and "exit code 3" in str(exc), exc
+        else:
+            raise AssertionError("dead worker was not reported")
+        assert pool.alive()
+        assert numpy.allclose(pool.map(points), expected)
+
+        # Problems from a model script cannot be pickled since the workers
+        # cannot import the script, but they are inherited by the workers.
+        fd, path = tempfile.mkstemp(suffix='.py')
+        try:
+            with os.fdopen(fd, 'w') as fid:
+                fid.write(_SM_MODEL)
+            problem = load_problem(path)
+        finally:
+            os.unlink(path)
+        line = numpy.array([[2., 1.], [1., 3.], [0.5, 0.5]])
+        pool.set_problem(problem)
+        assert numpy.allclose(pool.map(line), problem.nllf_batch(line))
+        assert numpy.allclose(pool.residuals(line),
+                              problem.residuals_batch(line))
+    finally:
+        pool.close()
+
+    # The mapper reuses the pool, with workers started for each problem.
+    old_pool = SharedMapper.pool
+    try:
+        SharedMapper.pool = None
+        mapper = SharedMapper.start_mapper(_SquareProblem(), [], cpus=2)
+        pool = SharedMapper.pool
+        pool._processes[0].terminate()
+        pool._processes[0].join()
+        assert not pool.alive()
+        mapper = SharedMapper.start_mapper(_SquareProblem(), [], cpus=2)
+        assert SharedMapper.pool is pool and pool.alive()
+        assert numpy.allclose(mapper(points), expected)
+    finally:
+        if SharedMapper.pool is not None:
+            SharedMapper.pool.close()
+        SharedMapper.pool = old_pool
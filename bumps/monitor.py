@@ -4,15 +4,32 @@ Process monitors.
 
 Process monitors accept a history object each cycle and
 perform some sort of work on it.
+
+Monitors normally run within the fit loop.  Wrap them in a
+:class:`BackgroundMonitor` to run them in a separate thread so that
+slow reporting does not hold up the fit.
 """
 from __future__ import print_function
 
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy
 from numpy import inf
 
+from .history import History
+
 class Monitor(object):
     """
     Generic monitor.
+
+    Set *coalesce* to False if the monitor needs to see every update when
+    it is run in the background.
     """
+    coalesce = True
     def config_history(self, history):
         """
         Indicate which fields are needed by the monitor and for what duration.
@@ -98,3 +115,182 @@ class TimedUpdate(Monitor):
             self.improved = False
             self.improvement_time = t
             self.show_improvement(history)
+
+
+class BackgroundMonitor(Monitor):
+    """
+    Run a set of monitors in a background thread.
+
+    Each cycle the latest value of every trace needed by the monitors is
+    copied onto a queue of at most *queue_size* updates.  A background
+    thread takes the updates from the queue, records them in a private
+    history and calls the monitors.  Attributes of the history which are
+    not traces, such as the DREAM uncertainty state, are not passed to the
+    background monitors since the fit continues to change them.
+
+    If the queue is full, the oldest pending update is dropped in favour
+    of the new one, so slow monitors only see some of the steps.  If any
+    of the monitors has *coalesce* set to False, the fit instead waits for
+    the monitors to catch up.
+
+    Call :meth:`flush` to wait for the monitors to process the pending
+    updates and stop the thread, or :meth:`final` to also close out the
+    monitors.  The thread is restarted when the monitor is configured for
+    the next fit.  An exception raised by a monitor is raised in the fit
+    on the following cycle.
+    """
+    def __init__(self, monitors, queue_size=16):
+        self.monitors = monitors
+        self.queue_size = queue_size
+        self.coalesce = all(getattr(M, 'coalesce', True) for M in monitors)
+        self._thread = None
+        self._error = None
+
+    def config_history(self, history):
+        self.flush()
+        keep = dict((trace.name, trace.keep) for trace in history._traces())
+        self._history = History(**keep)
+        for M in self.monitors:
+            M.config_history(self._history)
+        self._fields = [trace.name for trace in self._history._traces()
+                        if trace.keep > 0]
+        history.requires(**dict((name, 1) for name in self._fields))
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, history):
+        self._check_error()
+        values = dict((name, getattr(history, name)[0])
+                      for name in self._fields
+                      if len(getattr(history, name)) > 0)
+        self._post(values)
+
+    def _post(self, update):
+        if not self.coalesce:
+            self._queue.put(update)
+            return
+        while True:
+            try:
+                self._queue.put_nowait(update)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _run(self):
+        history = self._history
+        while True:
+            update = self._queue.get()
+            if update is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                history.update(**update)
+                for M in self.monitors:
+                    M(history)
+            except Exception as exc:
+                self._error = exc
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def flush(self):
+        """
+        Wait for the monitors to process the pending updates and stop the
+        background thread.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._check_error()
+
+    def final(self):
+        """
+        Close out the monitors.
+        """
+        self.flush()
+        for M in self.monitors:
+            if hasattr(M, 'final'):
+                M.final()
+
+def test_background():
+    import time
+    class Recorder(Monitor):
+        def __init__(self, gate=None, fail_at=None, coalesce=True):
+            self.gate, self.fail_at, self.coalesce = gate, fail_at, coalesce
+            self.steps, self.extra = [], []
+        def config_history(self, history):
+            history.requires(step=1)
+        def __call__(self, history):
+            if self.gate is not None:
+                self.gate.wait()
+            if history.step[0] == self.fail_at:
+                raise ValueError("monitor failed")
+            self.steps.append(history.step[0])
+            self.extra.append(hasattr(history, 'uncertainty_state'))
+    def run(monitor, n, queue_size=2):
+        history = History(step=1, value=1)
+        background = BackgroundMonitor([monitor], queue_size=queue_size)
+        background.config_history(history)
+        history.uncertainty_state = object()
+        for k in range(n):
+            history.update(step=k, value=float(k))
+            background(history)
+        return background
+
+    # A slow monitor sees the latest updates, with older ones dropped
+    gate = threading.Event()
+    monitor = Recorder(gate)
+    background = run(monitor, 20)
+    gate.set()
+    background.flush()
+    assert monitor.steps == sorted(monitor.steps)
+    assert monitor.steps[-2:] == [18, 19] and len(monitor.steps) <= 4
+    # Other attributes of the history are not shared with the thread
+    assert not any(monitor.extra)
+
+    # Without coalesce the fit waits for every update
+    gate = threading.Event()
+    threading.Timer(0.1, gate.set).start()
+    monitor = Recorder(gate, coalesce=False)
+    run(monitor, 20).flush()
+    assert monitor.steps == list(range(20))
+
+    # Monitor errors are raised in the fit, once
+    monitor = Recorder(fail_at=3)
+    try:
+        background = run(monitor, 5, queue_size=16)
+        time.sleep(0.1)
+        background(background._history)
+        raise AssertionError("expected the monitor error")
+    except ValueError:
+        pass
+    background.flush()
+    assert monitor.steps == [0, 1, 2]
+
+    # The background thread is stopped after resynth
+    from .curve import Curve
+    from .fitproblem import FitProblem
+    from .fitters import FitDriver, LevenbergMarquardtFit
+    x = numpy.linspace(-1, 2, 7)
+    class ResynthCurve(Curve):
+        def resynth_data(self):
+            self._y, self.y = self.y, self.y + 0.1*numpy.random.randn(len(x))
+        def restore_data(self):
+            self.y = self._y
+    M = ResynthCurve(lambda x, m, b: m*x + b, x, 2*x + 1, 0.1,
+                     m=(0, 4), b=(-5, 5))
+    monitor = Recorder()
+    background = BackgroundMonitor([monitor])
+    driver = FitDriver(LevenbergMarquardtFit, problem=FitProblem(M),
+                       monitors=[background])
+    driver.resynth(2)
+    assert background._thread is None and len(monitor.steps) > 0
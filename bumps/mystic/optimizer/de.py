@@ -250,6 +250,8 @@ class DifferentialEvolution(solver.Strategy):
             worse = newval > oldval
             newpop[worse] = oldpop[worse]
             newval[worse] = oldval[worse]
+            history.population_points.replace(newpop)
+            history.population_values.replace(newval)
 
 #minimizer_function(strategy=DifferentialEvolution,
 #                   success=stop.Df(1e-5,n=10),
@@ -211,6 +211,10 @@ class Minimizer:
         self.history.accumulate(step=1,calls=len(points))
 
         self.strategy.update(self.history)
+        # The strategy may have replaced members of the population
+        if len(self.history.population_points) > 0:
+            points = self.history.population_points[0]
+            values = self.history.population_values[0]
 
         minidx = numpy.argmin(values)
         self.history.update(
@@ -187,13 +187,15 @@ class Dx(Condition):
         self.n = n
         self.scaled = scaled
     def _scaled_condition(self, history):
-        x1,x2 = history.point[0], history.point[self.n]
+        points = history.point.window(self.n+1)
+        x1,x2 = points[0], points[self.n]
         scale = history.upper_bound - history.lower_bound
         scale[isinf(scale)] = ((abs(x1)+abs(x2))/2)[isinf(scale)]
         scale[scale == 0] = 1
         return self.norm((x2-x1)/scale)
     def _raw_condition(self, history):
-        x1,x2 = history.point[0], history.point[self.n]
+        points = history.point.window(self.n+1)
+        x1,x2 = points[0], points[self.n]
         return self.norm(x2-x1)
     def config_history(self, history):
         """
@@ -518,7 +520,7 @@ class Rx(Condition):
         self.radius = radius
         self.scaled = scaled
     def _scaled_condition(self, history):
-        P = numpy.asarray(history.population_points[0])
+        P = numpy.asarray(history.population_points.window(1)[0])
         scale = history.upper_bound - history.lower_bound
         idx = isinf(scale)
         if any(idx):
@@ -529,7 +531,7 @@ class Rx(Condition):
         #print "Rx=%g, scale=%g"%(r,scale)
         return r
     def _raw_condition(self, history):
-        P = numpy.asarray(history.population_points[0])
+        P = numpy.asarray(history.population_points.window(1)[0])
         r = self.radius(P, history.point[0], scale=1.)
         #print "Rx=%g"%r
         return r
@@ -11,7 +11,6 @@ Users can also perform calculations with parameters, tying together different
 parts of the model, or different models.
 """
 #__all__ = [ 'Parameter']
-from six.moves import reduce
 
 from copy import copy
 
@@ -20,14 +19,19 @@ import numpy
 from numpy import inf
 from . import bounds as mbounds
 
-# TODO: avoid evaluation of subexpressions if parameters do not change.
-# This is especially important if the subexpression invokes an expensive
-# calculation via a parameterized function.  This will require a restructuring
-# of the parameter class.  The park-1.3 solution is viable: given a parameter
-# set, figure out which order the expressions need to be evaluated by
-# building up a dependency graph.  With a little care, we can check which
-# parameters have actually changed since the last calculation update, and
-# restrict the dependency graph to just them.
+# Subexpressions are not evaluated again if their parameters do not change.
+# Each change to a parameter value increments a global version number.
+# Expression nodes remember the version at which their value was computed,
+# and reuse that value until some parameter changes.  Given a parameter
+# set, :func:`compile_expressions` figures out the order in which the
+# expressions need to be evaluated by building up a dependency graph, then
+# updates all the expressions in one pass, only recalculating those for
+# which the parameters have actually changed since the last update.
+_VERSION = [0]
+def _touch():
+    """Signal that a parameter value has changed."""
+    _VERSION[0] += 1
+
 # TODO: support full aliasing, so that floating point model attributes can
 # be aliased to a parameter.  The same technique as subexpressions applies:
 # when the parameter is changed, the model will be updated and will need
@@ -43,6 +47,13 @@ class BaseParameter(object):
     fixed = True
     fittable = False
     discrete = False
+    # Parameters which are cheap to update, such as scale and background,
+    # can be tagged as fast.  Models can then reuse their expensive
+    # intermediate results when only fast parameters change.
+    fast = False
+    # Cached value for parameter expressions; see compile_expressions.
+    _cacheable = False
+    _cache_version = -1
     _bounds = mbounds.Unbounded()
     name = None
 
@@ -207,6 +218,9 @@ class Parameter(BaseParameter):
 
     Other properties can decorate the parameter, such as tip for tool tip
     and units for units.
+
+    Set *fast* to True if the models can update quickly when only this
+    parameter changes, such as for scale and background.
     """
     fittable = True
     @classmethod
@@ -230,7 +244,23 @@ class Parameter(BaseParameter):
         low,high = self.bounds.limits
         self.value = min(max(value,low),high)
 
-    def __init__(self, value=None, bounds=None, fixed=None, name=None, **kw):
+    @property
+    def value(self):
+        return self._value
+    @value.setter
+    def value(self, value):
+        self._value = value
+        _touch()
+
+    def __setstate__(self, state):
+        # Parameters pickled before value became a property store it in
+        # the instance dictionary, where the property would hide it.
+        if 'value' in state:
+            state['_value'] = state.pop('value')
+        self.__dict__.update(state)
+
+    def __init__(self, value=None, bounds=None, fixed=None, name=None,
+                 fast=False, **kw):
         # UI nicities:
         # 1. check if we are started with value=range or bounds=range; if we are given bounds, then assume
         # this is a fitted parameter, otherwise the parameter defaults to fixed; if value is not set, use 
@@ -262,6 +292,7 @@ class Parameter(BaseParameter):
                               clip(self.bounds.limits[1],*limits))
         self.value = value
         self.fixed = fixed
+        self.fast = fast
         self.name = name
 
     def rand(self, rng=mbounds.RNG):
@@ -300,6 +331,7 @@ class Reference(Parameter):
     @value.setter
     def value(self, value):
         setattr(self.obj, self.attr, value)
+        _touch()
 
 class ParameterSet(object):
     """
@@ -504,11 +536,24 @@ class Operator%(name)s(BaseParameter):
         if isinstance(b,BaseParameter): pars += b.parameters()
         self._parameters = pars
         self.name = str(self)
+    _fn = staticmethod(lambda a, b: a %(op)s b)
     def parameters(self):
         return self._parameters
     def _value(self):
-        return float(self.a) %(op)s float(self.b)
+        if self._cache_version == _VERSION[0]:
+            return self._cache
+        value = float(self.a) %(op)s float(self.b)
+        if self._cacheable:
+            self._cache, self._cache_version = value, _VERSION[0]
+        return value
     value = property(_value)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_cache', None)
+        state.pop('_cache_version', None)
+        return state
+    def __setstate__(self, state):
+        self.__dict__ = state
     def _dvalue(self):
         return float(self.a)
     dvalue = property(_dvalue)
@@ -521,6 +566,7 @@ exec(_gen_binop('Sub','-'))
 exec(_gen_binop('Mul','*'))
 exec(_gen_binop('Div','/'))
 exec(_gen_binop('Pow','**'))
+_OPERATORS = (OperatorAdd, OperatorSub, OperatorMul, OperatorDiv, OperatorPow) #@UndefinedVariable autogenerated
 
 
 def substitute(a):
@@ -562,10 +608,15 @@ class Function(BaseParameter):
         for p in deps: res.extend(p.parameters())
         return res
     def _value(self):
+        if self._cache_version == _VERSION[0]:
+            return self._cache
         # Expand args and kw, replacing instances of parameters
         # with their values
         #return self.op(*[float(v) for v in self.args], **self.kw)
-        return self.op(*substitute(self.args), **substitute(self.kw))
+        value = self.op(*substitute(self.args), **substitute(self.kw))
+        if self._cacheable:
+            self._cache, self._cache_version = value, _VERSION[0]
+        return value
     value = property(_value)
     def __getstate__(self):
         return self.name, self.op, self.args, self.kw
@@ -599,16 +650,25 @@ _abs = function(abs)
 
 
 def flatten(s):
+    """
+    Return the list of parameters in the structure *s*, walking lists,
+    tuples and dicts (in key order) recursively.
+    """
+    result = []
+    _flatten(s, result)
+    return result
+
+def _flatten(s, result):
     if isinstance(s, (tuple,list)):
-        return reduce(lambda a,b: a + flatten(b), s, [])
+        for v in s: _flatten(v, result)
     elif isinstance(s, set):
         raise TypeError("parameter flattening cannot order sets")
     elif isinstance(s, dict):
-        return reduce(lambda a,b: a + flatten(s[b]), sorted(s.keys()), [])
+        for k in sorted(s.keys()): _flatten(s[k], result)
     elif isinstance(s, BaseParameter):
-        return [s]
+        result.append(s)
     elif s is None:
-        return []
+        pass
     else:
         raise TypeError("don't understand type %s for %s"%(type(s), s))
 
@@ -656,25 +716,30 @@ def format(p, indent=0):
     else:
         return "None"
 
-def summarize(pars, sorted=False):
+def summarize(pars, sorted=False, values=None):
     """
     Return a stylized list of parameter names and values with range bars
     suitable for printing.
 
     If sorted, then print the parameters sorted alphabetically by name.
+
+    If *values* is given, show these values instead of the current
+    parameter values.
     """
     output = []
-    if sorted: pars = sorted(pars, cmp=lambda x,y: cmp(x.name,y.name))
-    for p in pars:
-        if not numpy.isfinite(p.value):
+    if values is None: values = [p.value for p in pars]
+    pairs = list(zip(pars, values))
+    if sorted: pairs.sort(key=lambda pair: pair[0].name)
+    for p,value in pairs:
+        if not numpy.isfinite(value):
             bar = "*invalid* "
         else:
-            position = int(p.bounds.get01(p.value)*9.999999999)
+            position = int(p.bounds.get01(value)*9.999999999)
             bar = ['.']*10
             if position < 0: bar[0] = '<'
             elif position > 9: bar[9] = '>'
             else: bar[position] = '|'
-        output.append("%40s %s %10g in %s"%(p.name,"".join(bar),p.value,p.bounds))
+        output.append("%40s %s %10g in %s"%(p.name,"".join(bar),value,p.bounds))
     return "\n".join(output)
 
 def unique(s):
@@ -686,22 +751,20 @@ def unique(s):
     """
     # Walk structures such as dicts and lists
     pars = flatten(s)
-    #print "====== flattened"
-    #print "\n".join("%s:%s"%(id(p),p) for p in pars)
     # Also walk parameter expressions
     pars = pars + flatten([p.parameters() for p in pars])
-    #print "====== extended"
-    #print "\n".join("%s:%s"%(id(p),p) for p in pars)
 
-    # TODO: implement n log n rather than n^2 uniqueness algorithm
-    # problem is that the sorting has to be unique across a pickle.
+    # Parameters are compared by identity, so keep an ordered set keyed
+    # by id.  The ordering depends only on the structure, and so it is
+    # the same across a pickle.
+    seen = set()
     result = []
     for p in pars:
-        if not any(p is q for q in result):
+        key = id(p)
+        if key not in seen:
+            seen.add(key)
             result.append(p)
 
-    #print "====== unique"
-    #print "\n".join("%s:%s"%(id(p),p) for p in result)
     # Return the complete set of parameters
     return result
 
@@ -731,12 +794,191 @@ def randomize(s):
 def current(s):
     return [p.value for p in s]
 
+def compile_expressions(s):
+    """
+    Return the evaluation plan for the parameter expressions in *s*.
+
+    Call *plan.update()* after setting new parameter values to evaluate
+    all the expressions in one pass.  See :class:`Expressions`.
+    """
+    return Expressions(s)
+
+class Expressions(object):
+    """
+    Evaluation plan for a set of parameter expressions.
+
+    The expression trees are flattened into a list of operations over a
+    vector of values, sorted so that each operation follows its inputs.
+    :meth:`update` reads the current parameter values into the vector,
+    recalculates the operations whose inputs have changed, and caches the
+    results in the expression nodes so that *expr.value* does not need
+    to walk the tree again until the next parameter change.
+
+    Expressions which depend on parameters which do not signal changes
+    to their values are left out of the plan and are evaluated when
+    their value is requested, as usual.
+    """
+    def __init__(self, s):
+        # Reference values live in the underlying model, which can change
+        # them without notice, so they are not versioned.
+        versioned = set((Parameter.value, Constant.value,
+                         IntegerParameter.value))
+        self._source = s
+        self.leaves = []  # (slot, parameter)
+        self.plan = []    # (slot, node, evaluator, input slots)
+        self._slot = {}
+        self._nslots = 0
+        self._versioned = versioned
+        for p in flatten(s):
+            self._visit(p)
+        del self._slot, self._versioned
+        self.values = [None]*self._nslots
+        self._changed = [True]*self._nslots
+
+    # The plan holds evaluation functions, so rebuild it after a pickle.
+    def __getstate__(self):
+        return self._source
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def _visit(self, p):
+        """
+        Add *p* to the plan, returning its slot, or None if its value
+        cannot be cached.
+        """
+        key = id(p)
+        if key in self._slot:
+            return self._slot[key]
+        if isinstance(p, _OPERATORS):
+            a, b = [x if isinstance(x, BaseParameter) else Constant(x)
+                    for x in (p.a, p.b)]
+            inputs = [self._visit(a), self._visit(b)]
+            evaluate = self._operator(p._fn)
+        elif isinstance(p, Function):
+            inputs = [self._visit(x) for x in flatten((p.args, p.kw))]
+            evaluate = self._function(p)
+        elif isinstance(p, BaseParameter):
+            if getattr(type(p), 'value', None) not in self._versioned:
+                return None
+            slot = self._slot[key] = self._new_slot()
+            self.leaves.append((slot, p))
+            return slot
+        else:
+            raise TypeError("don't understand type %s for %s"%(type(p), p))
+
+        if any(k is None for k in inputs):
+            p._cacheable = False
+            slot = self._slot[key] = None
+        else:
+            p._cacheable = True
+            slot = self._slot[key] = self._new_slot()
+            self.plan.append((slot, p, evaluate, inputs))
+        return slot
+
+    def _new_slot(self):
+        self._nslots += 1
+        return self._nslots - 1
+
+    @staticmethod
+    def _operator(fn):
+        return lambda values, a, b: fn(float(values[a]), float(values[b]))
+
+    @staticmethod
+    def _function(node):
+        # Function arguments may be nested structures; their parameters
+        # and subexpressions already hold the current values.
+        return lambda values, *inputs: node.op(*substitute(node.args),
+                                               **substitute(node.kw))
+
+    def update(self):
+        """
+        Evaluate the expressions for the current parameter values.
+        """
+        version = _VERSION[0]
+        values, changed = self.values, self._changed
+        for k, p in self.leaves:
+            v = p.value
+            changed[k] = changed[k] or not (v == values[k])
+            values[k] = v
+        for k, node, evaluate, inputs in self.plan:
+            if any(changed[i] for i in inputs):
+                values[k] = evaluate(values, *inputs)
+                changed[k] = True
+            node._cache, node._cache_version = values[k], version
+        for k in range(len(changed)):
+            changed[k] = False
+
+def _line(x, m, b): return m*x + b
+def test_pickle():
+    import pickle
+    a = Parameter(2, name='a')
+    b = Parameter(3, name='b')
+    expr = a*b + 1
+    plan = compile_expressions([a, expr])
+    plan.update()
+    plan2 = pickle.loads(pickle.dumps(plan))
+    a2, expr2 = plan2._source
+    a2.value = 5
+    plan2.update()
+    assert expr2.value == 16 and expr.value == 7
+
+    # Parameters pickled when value was a plain attribute
+    old = Parameter.__new__(Parameter)
+    state = dict(a.__dict__)
+    state['value'] = state.pop('_value')
+    old.__setstate__(state)
+    assert old.value == 2 and 'value' not in old.__dict__
+
+    # Models sharing a parameter, as sent to the mappers
+    from .curve import Curve
+    from .fitproblem import MultiFitProblem
+    x = numpy.linspace(0, 1, 5)
+    M1 = Curve(_line, x, 2*x+1, numpy.ones_like(x), m=2, b=1)
+    M2 = Curve(_line, x, 2*x+3, numpy.ones_like(x), m=2, b=3)
+    M2.m = M1.m
+    M1.m.range(0, 4)
+    M1.b.range(0, 5)
+    M2.b.range(0, 5)
+    problem = MultiFitProblem([M1, M2])
+    problem.setp([0.5, 1.5, 2.5])
+    copy = pickle.loads(pickle.dumps(problem))
+    assert copy.nllf() == problem.nllf()
+    copy.setp([1, 2, 3])
+    assert copy.nllf() == 0
+
+def _benchmark_unique(sizes=(1000, 10000, 100000)):
+    """
+    Time :func:`unique` for models with many parameters, some shared
+    between models and some tied together by expressions.
+    """
+    import time
+    for n in sizes:
+        pars = [Parameter(i, name="p%d"%i) for i in range(n)]
+        models = [{'a': pars[i:i+10], 'tie': pars[i]+pars[i+1]}
+                  for i in range(0, n, 5)]
+        t0 = time.time()
+        result = unique(models)
+        dt = time.time() - t0
+        assert len(result) == n + len(models)
+        print("unique n=%-7d %8.3f s"%(n, dt))
+
+def test():
+    a, b, c = [Parameter(v, name=n) for v, n in ((1, 'a'), (2, 'b'), (3, 'c'))]
+    expr = a*c
+    pars = unique({'y': [b, expr], 'x': [a, b], 'z': None})
+    assert [str(p) for p in pars] == ['a', 'b', '(a * c)', 'c']
+    assert [str(p) for p in varying(pars)] == []
+    b.range(0, 5)
+    assert varying(pars) == [b]
+
 # ========= trash ===================
 
 class IntegerParameter(Parameter):
     discrete = True
     def _get_value(self): return self._value
-    def _set_value(self, value): self._value = int(value)
+    def _set_value(self, value):
+        self._value = int(value)
+        _touch()
     value = property(_get_value, _set_value)
 
 class Alias(object):
@@ -6,24 +6,30 @@ Parallel tempering for continuous function optimization and uncertainty analysis
 The program performs Markov chain Monte Carlo exploration of a probability
 density function using a combination of random and differential evolution
 updates.
+
+Each step updates the whole population at once, with one chain per
+temperature.  The proposals for all chains are formed as a single array
+and evaluated with one call to the mapper, which may evaluate them in
+parallel.  The history of accepted points is kept in preallocated arrays.
 """
 from __future__ import division, print_function
 
 __all__ = ["parallel_tempering"]
 
 import numpy
-from numpy import asarray, zeros, ones, exp, diff, std, inf, \
-    array, nonzero, sqrt, zeros_like
-from numpy.linalg import norm
-from numpy.random import rand,randn, randint, permutation
+from numpy import asarray, zeros, ones, exp, diff, inf, \
+    sqrt, arange, where
+from numpy.random import rand, randn, randint
 
 def every_ten(step,x,fx,P,E):
-    if step%10: print(step, fx[step], x[step])
+    if step%10 == 0: print(step, fx, x)
 
 def parallel_tempering(nllf, p, bounds, T=None, steps=1000,
                        CR=0.9, burn=1000,
                        monitor=every_ten,
-                       logfile=None):
+                       logfile=None,
+                       mapper=None,
+                       abort_test=None):
     r"""
     Perform a MCMC walk using multiple temperatures in parallel.
 
@@ -61,100 +67,99 @@ def parallel_tempering(nllf, p, bounds, T=None, steps=1000,
         ratio to use when computing step size and direction.  Use a small
         value to step through the dimensions one at a time, or a large value
         to step through all at once.
-    *monitor* = every_ten : function(int step, vector x, float fx) -> None
+    *monitor* = every_ten : function(int step, vector x, float fx, P, E)
         Function to called at every iteration with the step number the
-        best point and the best value.
+        best point and the best value, and the current points and values
+        for each temperature.
     *logfile* = None : string
         Name of the file which will log the history of every accepted step.
         Note that this includes all of the burn steps, so it can get very
         large.
+    *mapper* = None : function(array P) -> vector
+        Evaluate nllf for each row of P, possibly in parallel.  The
+        default calls nllf for each point in turn.
+    *abort_test* = None : function() -> bool
+        Return True to stop the walk early.
 
     :Returns:
 
     *history* : History
-        Structure containing *best*, *best_point* and *buffer*.  *best* is
-        the best nllf value seen and *best_point* is the parameter vector
-        which yielded *best*.  The list *buffer* contains lists of tuples
-        (step, temperature, nllf, x) for each temperature.
+        Structure containing *best*, *best_point*, and the arrays
+        *step*, *energy* and *point* with the accepted points for each
+        temperature.  See :class:`History`.
     """
+    if mapper is None:
+        mapper = lambda points: [nllf(p) for p in points]
+    T = asarray(T, 'd')
     N = len(T)
-    history = History(logfile=logfile, streams=N, size=steps)
+    p = asarray(p, 'd')
+    history = History(logfile=logfile, streams=N, size=steps, dim=len(p))
     bounder = ReflectBounds(*bounds)
-    #stepper = RandStepper(bounds, tol=0.2/T[-1])
     stepper = Stepper(bounds, history)
-    dT = diff(1./asarray(T))
-    P = asarray([p]*N)   # Points
-    E = ones(N)*nllf(p)  # Values
+    dT = diff(1./T)
+    P = ones((N, 1))*p          # Points
+    E = ones(N)*nllf(p)         # Values
     history.save(step=0, temperature=T, energy=E, point=P)
-    total_accept = zeros(N)
-    total_swap = zeros(N-1)
     for step in range(1,steps+burn):
         # Take a step
         R = rand()
         if step < 20 or R < 0.2:
             #action = 'jiggle'
-            Pnext = [stepper.jiggle(p,0.01*t/T[-1]) for p,t in zip(P,T)]
+            Pnext = stepper.jiggle(P, 0.01*T/T[-1])
         elif R < 0.4:
             #action = 'direct'
-            Pnext = [stepper.direct(p, i) for i,p in enumerate(P)]
+            Pnext = stepper.direct(P)
         else:
             #action = 'diffev'
-            Pnext = [stepper.diffev(p, i, CR=CR) for i,p in enumerate(P)]
+            Pnext = stepper.diffev(P, CR=CR)
 
         # Test constraints
-        Pnext = asarray([bounder.apply(p) for p in Pnext])
+        Pnext = bounder.apply(Pnext)
 
         # Temperature dependent Metropolis update
-        Enext = asarray([nllf(p) for p in Pnext])
-        accept = exp(-(Enext-E)/T) > rand(N)
-        #print step,action
-        #print "dP"," ".join("%.6f"%norm((pn-p)/stepper.step) for pn,p in zip(P,Pnext))
-        #print "dE"," ".join("%.1f"%(en-e) for en,e in zip(E,Enext))
-        #print "En"," ".join("%.1f"%e for e in Enext)
-        #print "accept",accept
+        Enext = asarray(mapper(Pnext), 'd')
+        with numpy.errstate(over='ignore', invalid='ignore'):
+            accept = exp(-(Enext-E)/T) > rand(N)
         E[accept] = Enext[accept]
         P[accept] = Pnext[accept]
-        total_accept += accept
 
         # Accumulate history for population based methods
         history.save(step, temperature=T, energy=E, point=P, changed=accept)
-        #print "best",history.best
-
-        # Swap chains across temperatures
-        # Note that we are are shuffling from high to low so that if a good
-        # point is found at a high temperature which push it immediately as
-        # low as we can go rather than risk losing it at the next high temp
-        # step.
-        swap = zeros(N-1)
-        for i in range(N-2,-1,-1):
-            #print "swap",E[i+1]-E[i],dT[i],exp((E[i+1]-E[i])*dT[i])
-            if exp((E[i+1]-E[i])*dT[i]) > rand():
-                swap[i] = 1
-                E[i+1],E[i] = E[i],E[i+1]
-                P[i+1],P[i] = P[i]+0,P[i+1]+0
-        total_swap += swap
-        #assert nllf(P[0]) == E[0]
+
+        # Swap chains across temperatures.  Alternate between the even and
+        # the odd neighbour pairs so that all swaps in a sweep are
+        # independent and can be tested at once.
+        i = arange(step%2, N-1, 2)
+        with numpy.errstate(over='ignore', invalid='ignore'):
+            swap = exp((E[i+1]-E[i])*dT[i]) > rand(len(i))
+        i = i[swap]
+        E[i], E[i+1] = E[i+1], E[i].copy()
+        P[i], P[i+1] = P[i+1], P[i].copy()
 
         # Monitoring
         monitor(step, history.best_point, history.best, P, E)
-        interval = 100
-        if 0 and step%interval == 0:
-            print("max r",max(["%.1f"%numpy.linalg.norm(p-P[0]) for p in  P[1:]]))
-            #print "min AR",argmin(total_accept),min(total_accept)
-            #print "min SR",argmin(total_swap),min(total_swap)
-            print("AR",total_accept)
-            print("SR",total_swap)
-            print("s(d)",[int(std([p[i] for p in P])) for i in (3,7,11,-1)])
-            total_accept *= 0
-            total_swap *= 0
+        if abort_test is not None and abort_test():
+            break
 
     return history
 
 class History(object):
-    def __init__(self, streams=None, size=1000, logfile=None):
+    """
+    Accepted points for each temperature.
+
+    The last *size* accepted points for each of the *streams* temperatures
+    are stored in the circular buffers *step*, *energy* and *point*, with
+    *count* giving the number of points stored for each stream.
+    """
+    def __init__(self, streams=None, size=1000, logfile=None, dim=None):
         # Allocate buffers
         self.size = size
-        self.buffer = [[] for _ in range(streams)]
+        self.step = zeros((streams, size), 'i')
+        self.temperature = zeros((streams, size), 'd')
+        self.energy = zeros((streams, size), 'd')
+        self.point = zeros((streams, size, dim), 'd')
+        self.count = zeros(streams, 'i')
+        self._next = zeros(streams, 'i')
         # Prepare log file
         if logfile != None:
             self.log = open(logfile,'w')
@@ -163,125 +168,117 @@ class History(object):
             self.log = None
         # Track the optimum
         self.best = inf
+        self.best_point = None
     def save(self, step, temperature, energy, point, changed=None):
-        if changed is None: changed = ones(len(temperature),'b')
-        for i,a in enumerate(changed):
-            if a:
-                self._save_point(step,i,temperature[i],energy[i],point[i]+0)
-    def _save_point(self, step, i, T, E, P):
+        if changed is None: changed = ones(len(temperature), bool)
+        i = numpy.flatnonzero(changed)
+        if len(i) == 0: return
         # Save in buffer
-        S = self.buffer[i]
-        if len(S) >= self.size: S.pop(0)
-        if len(S) > 0:
-            #print "P",P
-            #print "S",S[-1][3]
-            assert norm(P-S[-1][3]) != 0
-        S.append( (step,T,E,P) )
-        #print "stream",i,"now len",len(S)
+        k = self._next[i]
+        self.step[i, k] = step
+        self.temperature[i, k] = temperature[i]
+        self.energy[i, k] = energy[i]
+        self.point[i, k] = point[i]
+        self._next[i] = (k + 1) % self.size
+        self.count[i] = numpy.minimum(self.count[i] + 1, self.size)
         # Track of the optimum
-        if E < self.best:
-            self.best = E
-            self.best_point = P
+        j = i[numpy.argmin(energy[i])]
+        if energy[j] < self.best:
+            self.best = energy[j]
+            self.best_point = point[j] + 0
         # Log to file
         if self.log:
-            point_str = " ".join("%.6g"%v for v in P)
-            print(step,T,E,point_str, file=self.log)
+            for j in i:
+                point_str = " ".join("%.6g"%v for v in point[j])
+                print(step,temperature[j],energy[j],point_str, file=self.log)
             self.log.flush()
 
-    def draw(self, stream, k):
+    def draw(self, k):
         """
-        Return a list of k items drawn from the given stream.
+        Return an array of k distinct buffer indices for each stream.
 
-        If the stream is too short, fewer than n items may be returned.
+        Streams must have at least k points.
         """
-        S = self.buffer[stream]
-        n = len(S)
-        return [S[i] for i in choose(n,k)] if n > k else S[:]
+        # Rank random keys for the stored points; unused slots sort last.
+        keys = rand(len(self.count), self.size)
+        keys[arange(self.size)[None, :] >= self.count[:, None]] = 2
+        return numpy.argpartition(keys, k-1, axis=1)[:, :k]
 
+    def points(self, stream):
+        """
+        Return the points for *stream* ordered from oldest to newest.
+        """
+        n, k = self.count[stream], self._next[stream]
+        idx = (arange(k-n, k)) % self.size
+        return self.point[stream, idx]
 
 
 class Stepper(object):
+    """
+    Proposal generator for the whole population.
+
+    Each method takes the Nstreams x Nvar array of current points and
+    returns an array of proposed points.  Streams which have not yet
+    accumulated enough history for a population step are jiggled instead.
+    """
+    MIN_HISTORY = 20
+    MAX_PAIRS = 4
     def __init__(self, bounds, history):
         low, high = bounds
-        self.offset = low
-        self.step = (high-low)
+        self.offset = asarray(low, 'd')
+        self.step = asarray(high, 'd') - self.offset
         self.history = history
 
-    def diffev(self, p, stream, CR=0.8, noise=0.05):
-        if len(self.history.buffer[stream]) < 20:
-            #print "jiggling",stream,stream,len(self.history.buffer[stream])
-            return self.jiggle(p,1e-6)
+    def diffev(self, P, CR=0.8, noise=0.05):
         # Ideas incorporated from DREAM by Vrugt
-        N = len(p)
+        Nstreams, N = P.shape
+        ready = self.history.count >= max(self.MIN_HISTORY, 2*self.MAX_PAIRS)
+        if not ready.any():
+            return self.jiggle(P, 1e-6)
+        rows = arange(Nstreams)[:, None]
         # Select to number of vector pair differences to use in update
         # using k ~ discrete U[1,max pairs]
-        k = randint(4)+1
+        k = randint(self.MAX_PAIRS, size=Nstreams) + 1
 
         # Select 2*k members at random
-        parents = [v[3] for v in self.history.draw(stream, 2*k)]
-        k = len(parents)//2  # May not have enough parents
-        pop = array(parents)
-        #print "k",k
-        #print "parents",parents
-        #print "pop",pop
+        idx = self.history.draw(2*self.MAX_PAIRS)
+        pop = self.history.point[rows, idx]
+        use = arange(self.MAX_PAIRS)[None, :] < k[:, None]
+        step = numpy.sum((pop[:, :self.MAX_PAIRS] - pop[:, self.MAX_PAIRS:])
+                         * use[:, :, None], axis=1)
 
         # Select the dims to update based on the crossover ratio, making
-        # sure at least one significant dim is selected
-        while True:
-            vars = nonzero(rand(N) < CR)
-            if len(vars) == 0: vars = [randint(N)]
-            step = numpy.sum(pop[:k]-pop[k:], axis=0)
-            if norm(step[vars]) > 0: break
+        # sure at least one dim is selected
+        vars = rand(Nstreams, N) < CR
+        vars[rows[:, 0], randint(N, size=Nstreams)] |= ~vars.any(axis=1)
 
         # Weight the size of the jump inversely proportional to the
         # number of contributions, both from the parameters being
         # updated and from the population defining the step direction.
-        gamma = 2.38/sqrt(2 * len(vars) * k)
+        gamma = 2.38/sqrt(2 * numpy.sum(vars, axis=1) * k)
 
         # Apply that step with F scaling and noise
-        eps = 1 + noise * (2 * rand(N) - 1)
-        #print "j",j
-        #print "gamma",gamma
-        #print "step",step.shape
-        #print "vars",vars.shape
-        delta = zeros_like(p)
-        delta[vars] = gamma*(eps*step)[vars]
-        assert norm(delta) != 0
-        return p + delta
-
-    def direct(self, p, stream):
-        if len(self.history.buffer[stream]) < 20:
-            #print "jiggling",stream,len(self.history.buffer[stream])
-            return self.jiggle(p,1e-6)
-        pair = self.history.draw(stream, 2)
-        delta = pair[0][3] - pair[1][3]
-        if norm(delta) == 0:
-            print("direct should never return identical points!!")
-            return self.random(p)
-        assert norm(delta) != 0
-        return p + delta
-
-    def jiggle(self, p, noise):
-        delta = randn(len(p))*self.step*noise
-        assert norm(delta) != 0
-        return p + delta
-
-    def random(self, p):
-        delta = rand(len(p))*self.step + self.offset
-        assert norm(delta) != 0
-        return p + delta
-
-    def subspace_jiggle(self, p, noise, k):
-        n = len(self.step)
-        if n < k:
-            idx = slice(None)
-            k = n
-        else:
-            idx = choose(n,k)
-        delta = zeros_like(p)
-        delta[idx] = randn(k)*self.step[idx]*noise
-        assert norm(delta) != 0
-        return p + delta
+        eps = 1 + noise * (2 * rand(Nstreams, N) - 1)
+        delta = where(vars, gamma[:, None]*eps*step, 0)
+        # Fall back to jiggle for streams without history or without
+        # movement in the selected dimensions
+        moved = ready & (abs(delta).sum(axis=1) > 0)
+        return where(moved[:, None], P + delta, self.jiggle(P, 1e-6))
+
+    def direct(self, P):
+        ready = self.history.count >= self.MIN_HISTORY
+        if not ready.any():
+            return self.jiggle(P, 1e-6)
+        rows = arange(P.shape[0])
+        idx = self.history.draw(2)
+        delta = (self.history.point[rows, idx[:, 0]]
+                 - self.history.point[rows, idx[:, 1]])
+        moved = ready & (abs(delta).sum(axis=1) > 0)
+        return where(moved[:, None], P + delta, self.jiggle(P, 1e-6))
+
+    def jiggle(self, P, noise):
+        noise = numpy.broadcast_to(noise, P.shape[:1])
+        return P + randn(*P.shape)*self.step*noise[:, None]
 
 class ReflectBounds(object):
     """
@@ -292,32 +289,46 @@ class ReflectBounds(object):
 
     def apply(self, y):
         """
-        Update x so all values lie within bounds
+        Update y so all values lie within bounds.  y may be a single point
+        or an array with one point per row.
 
-        Returns x for convenience.  E.g., y = bounds.apply(x+0)
+        Returns y for convenience.  E.g., y = bounds.apply(x+0)
         """
-        minn, maxn = self.low, self.high
+        minn = numpy.broadcast_to(self.low, y.shape)
+        maxn = numpy.broadcast_to(self.high, y.shape)
         # Reflect points which are out of bounds
         idx = y < minn; y[idx] = 2*minn[idx] - y[idx]
         idx = y > maxn; y[idx] = 2*maxn[idx] - y[idx]
 
         # Randomize points which are still out of bounds
         idx = (y < minn) | (y > maxn)
-        y[idx] = minn[idx] + rand(sum(idx))*(maxn[idx]-minn[idx])
+        y[idx] = minn[idx] + rand(numpy.sum(idx))*(maxn[idx]-minn[idx])
         return y
 
-def choose(n, k):
-    """
-    Return an array of k things selected from a pool of n without replacement.
-    """
-    # At k == n/4, need to draw an extra 15% to get k unique draws
-    if k > n/4 or n<100:
-        idx = permutation(n)[:k]
-    else:
-        s = set(randint(n,size=k))
-        while len(s) < k:
-            s.add(randint(n))
-        idx = array([si for si in s])
-    if len(set(idx)) != len(idx):
-        print("choose(n,k) contains dups!!",n,k)
-    return idx
+def test():
+    # Double well in the first dimension; the walk should find the
+    # deeper well on the right from a start in the shallow well on the left.
+    def nllf(p):
+        x = p[..., 0]
+        return 10*(x**2-1)**2 - 2*x + 0.5*numpy.sum(p[..., 1:]**2, axis=-1)
+    numpy.random.seed(1)
+    T = numpy.logspace(-1, 1, 8)
+    calls = []
+    def mapper(points):
+        calls.append(len(points))
+        return nllf(asarray(points))
+    history = parallel_tempering(nllf, [-1., 0.5, 0.5], ([-3]*3, [3]*3),
+                                 T=T, steps=200, burn=200, mapper=mapper,
+                                 monitor=lambda *args: None)
+    assert all(n == len(T) for n in calls)
+    assert history.best_point[0] > 0
+    assert (history.count <= 200).all()
+    # every stored point is within bounds and its energy matches
+    for i in range(len(T)):
+        pts = history.points(i)
+        assert (abs(pts) <= 3).all()
+    n = history.count[0]
+    assert numpy.allclose(history.energy[0, :n], nllf(history.point[0, :n]))
+
+if __name__ == "__main__":
+    test()
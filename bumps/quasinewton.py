@@ -52,8 +52,9 @@ from __future__ import print_function
 
 __all__ = [ "quasinewton" ]
 
-from numpy import inf, sqrt, isnan, isinf, finfo
+from numpy import inf, sqrt, isnan, isinf, finfo, where, errstate
 from numpy import diag, zeros, ones, array, linalg, inner, outer, dot, amax, maximum
+from numpy import arange, asarray, vstack, flatnonzero
 
 STATUS = {
     1: "Gradient < tolerance",
@@ -70,14 +71,18 @@ STATUS = {
 def quasinewton(fn, x0 = [], grad = [], Sx = [], typf = 1, macheps = [], eta = [],
               maxstep = 100, gradtol = 1e-6, steptol = 1e-12, itnlimit = 2000,
               abort_test = None,
-              monitor = lambda **kw: True) :
-    """
+              monitor = lambda **kw: True,
+              mapper = None, central = False, trials = 1) :
+    r"""
     Run a quasinewton optimization on the problem.
 
     *fn(x)* is the cost function, which takes a point x and returns a scalar fx.
 
     *x0* is the initial point
 
+    *grad(x)* is the analytic gradient of fn at x.  Default: [], which uses
+    forward differences to estimate the gradient.
+
     *Sx* is a scale vector indicating the typical values for parameters in
     the fitted result. This is used for a variety of things such as setting
     the step size in the finite difference approximation to the gradient, and
@@ -112,6 +117,20 @@ def quasinewton(fn, x0 = [], grad = [], Sx = [], typf = 1, macheps = [], eta = [
     *monitor(x,fx,step)* is called every iteration so that a user interface
     function can monitor the progress of the fit.  Default: lambda **kw: True
 
+    *mapper(points)* evaluates fn for each point in a list, returning the
+    list of values.  The points for the finite difference gradient are
+    evaluated in one call to the mapper, which may evaluate them in
+    parallel.  Default: None, which calls fn for each point in turn.
+
+    *central* is True if the finite difference gradient should use
+    central differences, with 2n evaluations per gradient rather than n.
+    This is more accurate, and with a parallel mapper may be no slower.
+    Default: False
+
+    *trials* is the number of step lengths $1, 1/2, 1/4, \ldots$ to try
+    together at the start of each line search.  Set this to the number of
+    parallel workers when using a parallel mapper.  Default: 1
+
 
     Returns the fit result as a dictionary:
 
@@ -143,7 +162,7 @@ def quasinewton(fn, x0 = [], grad = [], Sx = [], typf = 1, macheps = [], eta = [
     # the parameters before this parameter are specified, in this case fn, x0, grad,
     # and Sx if you want to have default values for grad and Sx, for each enter [].
     n = len(x0)            # important for also computing fcount (function count)
-    if x0 == [] :
+    if n == 0 :
         x0 = zeros(n)
 
     if grad == [] :
@@ -176,8 +195,8 @@ def quasinewton(fn, x0 = [], grad = [], Sx = [], typf = 1, macheps = [], eta = [
         fcount = fcount + 1
     else :
         fc = fn(x0)
-        gc = fdgrad(n, x0, fc, fn, Sx, eta)
-        fcount = fcount + n + 1
+        gc = fdgrad(n, x0, fc, fn, Sx, eta, mapper=mapper, central=central)
+        fcount = fcount + (2*n if central else n) + 1
 
 
 
@@ -219,7 +238,8 @@ def quasinewton(fn, x0 = [], grad = [], Sx = [], typf = 1, macheps = [], eta = [
         #print "calling linesearch",xc,fc,gc,sN,Sx,H,L,middle_step_v
         #print "linesearch",xc,fc
         retcode, xp, fp, maxtaken, fcnt \
-            = linesearch(fn, n, xc, fc, gc, sN, Sx, maxstep, steptol)
+            = linesearch(fn, n, xc, fc, gc, sN, Sx, maxstep, steptol,
+                         mapper=mapper, trials=trials)
         fcount = fcount + fcnt
         fcount_ls = fcount_ls + fcnt
         #plot(xp(1), xp(2), 'g.')
@@ -228,15 +248,15 @@ def quasinewton(fn, x0 = [], grad = [], Sx = [], typf = 1, macheps = [], eta = [
         if analgrad == 1 :
             gp = grad(xp)
         else :
-            gp = fdgrad(n, xp, fp, fn, Sx, eta)
-            fcount = fcount + n
+            gp = fdgrad(n, xp, fp, fn, Sx, eta, mapper=mapper, central=central)
+            fcount = fcount + (2*n if central else n)
 
         # Check stopping criteria (alg.7.2.1)
         consecmax = consecmax+1 if maxtaken else 0
         termcode = umstop(n, xc, xp, fp, gp, Sx, typf, retcode, gradtol,
                           steptol, itncount, itnlimit, consecmax)
 
-        if abort_test(): termcode = 6
+        if abort_test is not None and abort_test(): termcode = 6
         
         # STEP 10.6
         # If termcode is larger than zero, we found a point satisfying one of the
@@ -384,36 +404,41 @@ def choldecomp(n, H, maxoffl, macheps):
 # First evaluate function at xc + hj * ej and then estimate jth entry of
 # the gradient.
 
-def fdgrad(n, xc, fc, fn, Sx, eta) :
-
-    # create memory for gradient
-    g = zeros(n)
-
-    sqrteta = sqrt(eta)
-    for j in range(1, n+1) :
-        #--- FIND STEP SIZE hj
-        if xc[j-1] >= 0 :
-            signxcj = 1
-        else :
-            signxcj = -1                # 1.a
-
-        hj = sqrteta * max(abs(xc[j-1]), 1/Sx[j-1]) * signxcj                # 1.b
-
-        tempj = xc[j-1]                                                                # 1.c
-        xc[j-1] = xc[j-1] + hj
-        hj = xc[j-1] - tempj
-
-        #--- EVALUATE APPR. GRADIENT
-        fj = fn(xc)
-        # PAK: hack for infeasible region: point the other way
-        if isinf(fj): fj = fc+hj
-        g[j-1] = (fj - fc)/hj
-        #if isinf(g[j-1]):
-        #    print "fc,fj,hj,Sx,xc",fc,fj,hj,Sx[j-1],xc[j-1]
-
-        # now reset the current
-        xc[j-1] = tempj
-
+#
+# PAK: all the perturbed points are formed first and evaluated with a single
+# call to mapper, which may evaluate them in parallel.  With central=True,
+# the gradient uses central differences on 2n points, with the step size
+# scaled by eta^(1/3) rather than eta^(1/2) since the error is O(h^2).
+
+def fdgrad(n, xc, fc, fn, Sx, eta, mapper=None, central=False) :
+
+    if mapper is None:
+        mapper = lambda points: [fn(x) for x in points]
+    xc = asarray(xc, 'd')
+
+    #--- FIND STEP SIZE hj
+    signxc = where(xc >= 0, 1., -1.)                                    # 1.a
+    rel = eta**(1./3) if central else sqrt(eta)
+    h = rel * maximum(abs(xc), 1./asarray(Sx, 'd')) * signxc           # 1.b
+    h = (xc + h) - xc                                                   # 1.c
+
+    #--- EVALUATE APPR. GRADIENT
+    if central:
+        f = array(mapper(vstack((xc + diag(h), xc - diag(h)))), 'd')
+        fplus, fminus = f[:n], f[n:]
+    else:
+        fplus = array(mapper(xc + diag(h)), 'd')
+    # PAK: hack for infeasible region: point the other way
+    bad_plus = isinf(fplus)
+    fplus = where(bad_plus, fc + h, fplus)
+    if not central:
+        return (fplus - fc)/h
+
+    # Use one sided differences at the edge of the feasible region
+    with errstate(invalid='ignore'):
+        g = (fplus - fminus)/(2*h)
+        g = where(bad_plus, (fc - fminus)/h, g)
+        g = where(isinf(fminus), (fplus - fc)/h, g)
     return g
 
 
@@ -430,7 +455,8 @@ def inithessunfac(n, f, typf, Sx):
 
 #------------------------------------------------------------------------------
 
-def linesearch(cost_func, n, xc, fc, g, p, Sx, maxstep, steptol):
+def linesearch(cost_func, n, xc, fc, g, p, Sx, maxstep, steptol,
+               mapper=None, trials=1):
     '''
 % ALGORITHM 6.3.1
 %
@@ -462,6 +488,9 @@ def linesearch(cost_func, n, xc, fc, g, p, Sx, maxstep, steptol):
 %    Sx : scale factors (Rn)
 %    maxstep : maximum step size allowed (R)
 %    steptol : step tolerance in order to break infinite loop in line search (R)
+%    mapper : evaluates cost_func for a list of points [optional]
+%    trials : number of step lengths 1, 1/2, 1/4, ... to evaluate together
+%       with the mapper before backtracking (N) [optional]
 
 % OUTPUTS
 %    retcode : boolean indicating a new point xp found (0) or not (1)    (N).
@@ -500,9 +529,25 @@ def linesearch(cost_func, n, xc, fc, g, p, Sx, maxstep, steptol):
 
     lambdaM = 1.0
 
+    # PAK: evaluate a ladder of step lengths together, and start from the
+    # longest acceptable step.  If none are acceptable, continue backtracking
+    # from the two shortest steps.
+    fcount = 0
+    fpending = None
+    if mapper is not None and trials > 1:
+        ladder = 0.5**arange(trials)
+        ladder = ladder[ladder >= min(minlambda, 1.0)]
+        fladder = array(mapper(xc + ladder[:, None]*p), 'd')
+        fladder[isinf(fladder)] = 2*fc # PAK: infeasible region hack
+        fcount = fcount + len(ladder)
+        accept = flatnonzero(fladder <= fc + alfa * ladder * initslope)
+        k = accept[0] if len(accept) else len(ladder)-1
+        if k > 0:
+            lambda_prev, fp_prev = ladder[k-1], fladder[k-1]
+        lambdaM, fpending = ladder[k], fladder[k]
+
     # In this loop, we try to find an acceptable next point xp = xc + lambda * p by
     # finding an optimal lambda based on one dimensional quadratic and cubic models
-    fcount = 0
     while True:                # 10 starts.
         xp = xc + lambdaM * p                                    # next point candidate
         #print "linesearch",fcount,xp,xc,lambdaM,p
@@ -516,9 +561,12 @@ def linesearch(cost_func, n, xc, fc, g, p, Sx, maxstep, steptol):
             retcode = 2
             xp,fp = xc,fc
             break
-        fp = cost_func(xp)                                        # function value at xp
-        if isinf(fp): fp = 2*fc # PAK: infeasible region hack
-        fcount = fcount + 1
+        if fpending is not None:
+            fp, fpending = fpending, None
+        else:
+            fp = cost_func(xp)                                    # function value at xp
+            if isinf(fp): fp = 2*fc # PAK: infeasible region hack
+            fcount = fcount + 1
         if fp <= fc + alfa * lambdaM * initslope:
             # satisfactory xp is found
             retcode = 0
@@ -810,5 +858,59 @@ def example_call():
     print('\n\nInitial point x0 = ', x0, ', f(x0) = ', fn(x0))
     for k in sorted(result.keys()): print(k,"=",result[k])
 
+def test_fdgrad():
+    fn = lambda x: x[0]**3 + 2*x[0]*x[1] + x[1]**2
+    grad = lambda x: array([3*x[0]**2 + 2*x[1], 2*x[0] + 2*x[1]])
+    xc = array([1.5, -0.5])
+    Sx, eta = ones(2), machineeps()
+    calls = []
+    def mapper(points):
+        calls.append(len(points))
+        return [fn(x) for x in points]
+    forward = fdgrad(2, xc, fn(xc), fn, Sx, eta, mapper=mapper)
+    central = fdgrad(2, xc, fn(xc), fn, Sx, eta, mapper=mapper, central=True)
+    # All the perturbed points are evaluated in a single call
+    assert calls == [2, 4]
+    assert linalg.norm(forward - grad(xc)) < 1e-6
+    assert linalg.norm(central - grad(xc)) < 1e-9
+    assert linalg.norm(central - grad(xc)) < linalg.norm(forward - grad(xc))
+    # At the edge of the feasible region, use the one sided difference
+    edge = lambda x: fn(x) if x[0] <= 1.5 else inf
+    central = fdgrad(2, xc, fn(xc), edge, Sx, eta, central=True)
+    assert linalg.norm(central - grad(xc)) < 1e-4
+
+def test_linesearch():
+    fn = lambda x: inner(x, x)
+    xc = array([1., 1.])
+    fc, g = fn(xc), 2*xc
+    Sx = ones(2)
+    calls = []
+    def mapper(points):
+        calls.append(len(points))
+        return [fn(x) for x in points]
+    # Steps of 1 and 1/2 are not acceptable, so backtracking finds 1/4,
+    # and the ladder starts from it.
+    p = -4*xc
+    serial = linesearch(fn, 2, xc, fc, g, p, Sx, 100, 1e-12)
+    ladder = linesearch(fn, 2, xc, fc, g, p, Sx, 100, 1e-12,
+                        mapper=mapper, trials=4)
+    assert calls == [4]
+    assert serial[0] == ladder[0] == 0
+    assert linalg.norm(serial[1]) < 1e-12 and linalg.norm(ladder[1]) < 1e-12
+    assert (serial[4], ladder[4]) == (2, 4)
+    # If no step in the ladder is acceptable, backtracking continues
+    del calls[:]
+    retcode, xp, fp, _, fcount = linesearch(fn, 2, xc, fc, g, -100*xc, Sx, 1e3,
+                                            1e-12, mapper=mapper, trials=3)
+    assert calls == [3] and fcount > 3
+    assert retcode == 0 and fp < fc
+
+    # The parallel options reach the same minimum of the Rosenbrock function
+    rosen = lambda p: (1-p[0])**2 + 100*(p[1]-p[0]**2)**2
+    x0 = array([2.320894, -0.534223])
+    for kw in ({}, dict(mapper=lambda points: [rosen(x) for x in points],
+                        central=True, trials=4)):
+        result = quasinewton(fn=rosen, x0=x0, **kw)
+        assert linalg.norm(result['x'] - [1, 1]) < 1e-4, (kw, result['x'])
 
 if __name__ == "__main__": example_call()
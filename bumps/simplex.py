@@ -37,6 +37,27 @@ def wrap_function(function, bounds):
             return function(x)
     return ncalls, function_wrapper
 
+def wrap_mapper(mapper, bounds, ncalls):
+    """
+    Wrap *mapper(points)* so that points outside the bounds are given a
+    value of inf without being evaluated.  Calls are counted in *ncalls*.
+    """
+    if bounds is not None:
+        lo, hi = [numpy.asarray(v) for v in bounds]
+    def mapper_wrapper(points):
+        points = numpy.asarray(points)
+        ncalls[0] += len(points)
+        result = numpy.empty(len(points), 'd')
+        result[:] = numpy.inf
+        if bounds is not None:
+            valid = ~numpy.any((points<lo)|(points>hi), axis=1)
+        else:
+            valid = numpy.ones(len(points), bool)
+        if valid.any():
+            result[valid] = mapper(points[valid])
+        return result
+    return mapper_wrapper
+
 class Result:
     """
     Results from the fit.
@@ -66,7 +87,8 @@ def dont_abort(): return False
 
 def simplex(f, x0=None, bounds=None, radius=0.05,
             xtol=1e-4, ftol=1e-4, maxiter=None,
-            update_handler=None, abort_test=dont_abort):
+            update_handler=None, abort_test=dont_abort,
+            mapper=None, vertices=1):
     """
     Minimize a function using Nelder-Mead downhill simplex algorithm.
 
@@ -122,14 +144,35 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
             where k is the current iteration, n is the maximum
             iteration, xk is the simplex and fxk is the value of
             the simplex vertices.  xk[0],fxk[0] is the current best.
+        mapper : callable mapper(points)
+            Evaluate f at each point in a list, possibly in parallel.  If
+            given, the initial simplex and each batch of candidate points
+            are evaluated with one call to the mapper.
+        vertices : int=1
+            Number of worst vertices to update on each iteration.  Set this
+            to the number of parallel workers when using a parallel mapper.
+            At most a third of the N+1 vertices are updated at once.
 
     *Notes*
 
         Uses a Nelder-Mead simplex algorithm to find the minimum of
         function of one or more variables.
 
+        With *vertices* k > 1, each iteration updates the k worst vertices
+        at once using the parallel Nelder-Mead algorithm of Lee and Wiswall
+        (2007).  Each worst vertex is reflected through the centroid of the
+        remaining vertices, with the reflections evaluated as one batch.
+        Any expansions and contractions needed are then evaluated as a
+        second batch, and the simplex is shrunk only if none of the k
+        vertices improves.
+
     """
+    if abort_test is None:
+        abort_test = dont_abort
     fcalls, func = wrap_function(f, bounds)
+    if mapper is None:
+        mapper = lambda points: [f(x) for x in points]
+    fmap = wrap_mapper(mapper, bounds, fcalls)
     x0 = numpy.asfarray(x0).flatten()
     #print "x0",x0
     N = len(x0)
@@ -139,6 +182,9 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
 
     if maxiter is None:
         maxiter = N * 200
+    # Updating most of the simplex at once lets it collapse onto a subspace,
+    # so keep at least two thirds of the vertices fixed on each iteration.
+    vertices = max(1, min(vertices, (N+1)//3))
 
     rho = 1; chi = 2; psi = 0.5; sigma = 0.5;
 
@@ -148,7 +194,6 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
         sim = numpy.zeros((N+1,N), dtype=x0.dtype)
     fsim = numpy.zeros((N+1,), float)
     sim[0] = x0
-    fsim[0] = func(x0)
 
     # Metropolitan simplex: simplex has vertices at x0 and at
     # x0 + j*radius for each unit vector j.  Radius is a percentage
@@ -190,7 +235,7 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
         y = x0+0
         y[k] = val[k]
         sim[k+1] = y
-        fsim[k+1] = func(y)
+    fsim[:] = fmap(sim)
 
     #print sim
     ind = numpy.argsort(fsim)
@@ -206,6 +251,17 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
             #print abs(sim[1:]-sim[0])
             break
 
+        if vertices > 1:
+            _parallel_step(fmap, sim, fsim, vertices, rho, chi, psi, sigma)
+            ind = numpy.argsort(fsim)
+            sim = numpy.take(sim,ind,0)
+            fsim = numpy.take(fsim,ind,0)
+            if update_handler is not None:
+                update_handler(iterations, maxiter, sim, fsim)
+            iterations += 1
+            if abort_test(): break
+            continue
+
         xbar = numpy.sum(sim[:-1],0) / N
         xr = (1+rho)*xbar - rho*sim[-1]
         #print "xbar" ,xbar,rho,sim[-1],N
@@ -250,9 +306,8 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
                         doshrink = 1
 
                 if doshrink:
-                    for j in range(1,N+1):
-                        sim[j] = sim[0] + sigma*(sim[j] - sim[0])
-                        fsim[j] = func(sim[j])
+                    sim[1:] = sim[0] + sigma*(sim[1:] - sim[0])
+                    fsim[1:] = fmap(sim[1:])
 
         ind = numpy.argsort(fsim)
         sim = numpy.take(sim,ind,0)
@@ -267,6 +322,42 @@ def simplex(f, x0=None, bounds=None, radius=0.05,
     res.next_start = sim[numpy.random.randint(N)]
     return res
 
+def _parallel_step(fmap, sim, fsim, k, rho, chi, psi, sigma):
+    """
+    Update the *k* worst vertices of the sorted simplex in place.
+    """
+    keep = len(sim) - k
+    xbar = numpy.sum(sim[:keep],0) / keep
+    worst, fworst = sim[keep:], fsim[keep:]
+    xr = (1+rho)*xbar - rho*worst
+    fxr = fmap(xr)
+
+    # Decide the next candidate for each vertex from its reflection.
+    expand = fxr < fsim[0]
+    accept = ~expand & (fxr < fsim[keep-1])
+    outside = ~expand & ~accept & (fxr < fworst)
+    inside = ~expand & ~accept & ~outside
+    x2 = numpy.empty_like(xr)
+    x2[expand] = (1+rho*chi)*xbar - rho*chi*worst[expand]
+    x2[outside] = (1+psi*rho)*xbar - psi*rho*worst[outside]
+    x2[inside] = (1-psi)*xbar + psi*worst[inside]
+    second = ~accept
+    fx2 = numpy.empty_like(fxr)
+    fx2[second] = fmap(x2[second]) if second.any() else []
+
+    # Expansion: keep the better of the expansion and the reflection
+    # Outside contraction: accept if no worse than the reflection
+    # Inside contraction: accept if better than the current vertex
+    use_r = accept | (expand & ~(fx2 < fxr))
+    use_2 = (expand & (fx2 < fxr)) | (outside & (fx2 <= fxr)) \
+        | (inside & (fx2 < fworst))
+    if not (use_r | use_2).any():
+        sim[1:] = sim[0] + sigma*(sim[1:] - sim[0])
+        fsim[1:] = fmap(sim[1:])
+        return
+    worst[use_r], fworst[use_r] = xr[use_r], fxr[use_r]
+    worst[use_2], fworst[use_2] = x2[use_2], fx2[use_2]
+
 def main():
     import time
     def rosen(x):  # The Rosenbrock function
@@ -334,5 +425,34 @@ def main():
     print(x)
     print("Time:",time.time() - start)
 
+def test():
+    def rosen(x):
+        return numpy.sum(100.0*(x[1:]-x[:-1]**2.0)**2.0 + (1-x[:-1])**2.0,axis=0)
+    x0 = [0.8,1.2,0.7,1.1,0.9,1.0]
+    serial = simplex(rosen,x0,xtol=1e-8,ftol=1e-10,maxiter=5000)
+    assert numpy.allclose(serial.x, 1, atol=1e-3)
+
+    # parallel vertices with a batch mapper find the same minimum
+    batches = []
+    def mapper(points):
+        batches.append(len(points))
+        return [rosen(p) for p in points]
+    result = simplex(rosen,x0,xtol=1e-8,ftol=1e-10,maxiter=5000,
+                     mapper=mapper,vertices=2)
+    assert numpy.allclose(result.x, 1, atol=1e-3)
+    assert result.calls == sum(batches)
+    assert max(batches) == len(x0)+1 and len(result.next_start) == len(x0)
+
+    # points outside the bounds are never evaluated
+    lo,hi = numpy.array([0]*6), numpy.array([0.9]*6)
+    seen = []
+    def bounded_mapper(points):
+        seen.extend(points)
+        return [rosen(p) for p in points]
+    result = simplex(rosen,x0,bounds=(lo,hi),mapper=bounded_mapper,vertices=2)
+    seen = numpy.array(seen)
+    assert (seen >= lo).all() and (seen <= hi).all()
+    assert (result.x >= lo).all() and (result.x <= hi).all()
+
 if __name__ == "__main__":
     main()